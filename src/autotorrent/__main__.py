@@ -1,8 +1,10 @@
 import hashlib
+import json
 import logging
 import os
 import re
 import shlex
+import time
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
@@ -11,24 +13,29 @@ import toml
 from libtc import (
     BTFailure,
     FailedToExecuteException,
-    bdecode,
-    bencode,
     parse_clients_from_toml_dict,
 )
 from libtc.utils import get_tracker_domain
 
 from .__version__ import __version__
+from .bencode import bdecode_torrent
 from .db import Database
+from .hashing import PieceHashCache, ProbePolicy, hash_pieces
 from .exceptions import FailedToCreateLinkException
 from .indexer import Indexer
-from .matcher import Matcher
+from .iobudget import IOBudget, set_idle_io_priority
+from .matcher import DynamicMatchResult, Matcher, is_relative_to
 from .rw_cache import ReadWriteFileCache
+from .scrub import find_store_paths, load_store_torrent, scrub_torrents
+from .verify import verify_torrent
 from .utils import (
     FailedToParseTorrentException,
     PathRewriter,
+    add_libtorrent_resume,
     add_status_formatter,
     create_link_path,
     humanize_bytes,
+    humanize_duration,
     parse_torrent,
     filter_torrents,
 )
@@ -47,6 +54,17 @@ fast_resume = false
 ignore_file_patterns = [ ]
 ignore_directory_patterns = [ ]
 scan_hardlinks = false
+cache_matches = false
+cache_matches_piece_hashes = true
+cache_piece_hashes = false
+first_piece_hash_min_size = 0
+fingerprint_min_size = 0
+hash_probe_confidence = "normal"
+io_max_read_rate = 0
+io_max_concurrent_reads = 0
+io_idle_priority = false
+scrub_days = 30
+scrub_max_read_rate = 0
 """
 
 BASE_CONFIG_FILE = """[autotorrent]
@@ -72,6 +90,17 @@ fast_resume = false
 ignore_file_patterns = [ ]
 ignore_directory_patterns = [ ]
 scan_hardlinks = false
+cache_matches = false
+cache_matches_piece_hashes = true
+cache_piece_hashes = false
+first_piece_hash_min_size = 0
+fingerprint_min_size = 0
+hash_probe_confidence = "normal"
+io_max_read_rate = 0
+io_max_concurrent_reads = 0
+io_idle_priority = false
+scrub_days = 30
+scrub_max_read_rate = 0
 
 [clients]
 
@@ -86,6 +115,11 @@ def parse_config_file(path, utf8_compat_mode=False):
     parsed_config = base_config["autotorrent"]
     parsed_config.update(config["autotorrent"])
 
+    try:
+        probe_policy = ProbePolicy(parsed_config["hash_probe_confidence"])
+    except ValueError as e:
+        raise click.ClickException(f"{e}, in config file {path!s}")
+
     clients = parsed_config["clients"] = parse_clients_from_toml_dict(config)
 
     database_path = path.parent / Path(parsed_config["database_path"])
@@ -93,15 +127,31 @@ def parse_config_file(path, utf8_compat_mode=False):
         database_path,
         utf8_compat_mode=utf8_compat_mode,
     )
+    parsed_config["io_budget"] = io_budget = IOBudget(
+        max_read_rate=parsed_config["io_max_read_rate"] * 1_000_000,
+        max_concurrent_reads=parsed_config["io_max_concurrent_reads"],
+    )
     parsed_config["indexer"] = indexer = Indexer(
         db,
         ignore_file_patterns=parsed_config["ignore_file_patterns"],
         ignore_directory_patterns=parsed_config["ignore_directory_patterns"],
         include_inodes=parsed_config["scan_hardlinks"],
+        first_piece_hash_min_size=parsed_config["first_piece_hash_min_size"],
+        fingerprint_min_size=parsed_config["fingerprint_min_size"],
+        io_budget=io_budget,
     )
     parsed_config["rewriter"] = rewriter = PathRewriter(parsed_config["same_paths"])
+    if parsed_config["cache_piece_hashes"]:
+        parsed_config["piece_cache"] = piece_cache = PieceHashCache(db)
+    else:
+        parsed_config["piece_cache"] = piece_cache = None
     parsed_config["matcher"] = matcher = Matcher(
-        rewriter, db, include_inodes=parsed_config["scan_hardlinks"]
+        rewriter,
+        db,
+        include_inodes=parsed_config["scan_hardlinks"],
+        io_budget=io_budget,
+        piece_cache=piece_cache,
+        probe_policy=probe_policy,
     )
 
     rw_file_cache_chown = parsed_config.get("rw_file_cache_chown")
@@ -111,6 +161,7 @@ def parse_config_file(path, utf8_compat_mode=False):
             parsed_config["rw_file_cache_path"],
             parsed_config["rw_file_cache_ttl"],
             rw_file_cache_chown,
+            io_budget=io_budget,
         )
     else:
         parsed_config["rw_cache"] = None
@@ -122,6 +173,12 @@ def parse_config_file(path, utf8_compat_mode=False):
     return parsed_config
 
 
+def use_idle_io_priority(ctx):
+    """Set the idle I/O priority if configured, for the commands reading torrent data."""
+    if ctx.obj["io_idle_priority"]:
+        set_idle_io_priority()
+
+
 def validate_config_path(ctx, param, value):
     if value is not None:  # check given path first
         config_path = Path(value)
@@ -189,6 +246,63 @@ def cli(ctx, config, verbose, utf8_compat_mode):
     ctx.obj.update(parse_config_file(config, utf8_compat_mode=utf8_compat_mode))
 
 
+def get_command_paths(ctx, path, from_index):
+    """
+    Paths given as arguments, or the paths in the current directory without any.
+    With from_index, the paths are not checked and the current directory is listed
+    from the index so no files are looked at.
+    """
+    if from_index:
+        if path:
+            return [Path(p) for p in path]
+        file_names, directory_names = ctx.obj["matcher"].list_path_from_index(
+            Path(os.path.abspath("."))
+        )
+        return [Path(name) for name in file_names + directory_names]
+
+    if not path:
+        return list(Path(".").iterdir())
+
+    path_type = click.Path(exists=True)
+    path_param = next(param for param in ctx.command.params if param.name == "path")
+    return [Path(path_type.convert(p, path_param, ctx)) for p in path]
+
+
+def get_path_mapper(ctx, from_index, directory_sizes=False):
+    """
+    Map paths to clients with the files or the index, saying how old the index is.
+    With directory_sizes, directories are mapped with the directory sizes only.
+    The mapper takes a list of paths and yields a map result for each of them.
+    """
+    matcher = ctx.obj["matcher"]
+    if not from_index:
+        return matcher.map_paths_to_clients
+
+    db = ctx.obj["db"]
+    files_scanned = db.get_scanned("files") or "never"
+    client_files_scanned = db.get_scanned("client_files") or "never"
+    click.echo(
+        f"Using the index, files last scanned: {files_scanned}, clients last scanned: {client_files_scanned}",
+        err=True,
+    )
+
+    def map_paths_to_clients(paths):
+        for path in paths:
+            if directory_sizes:
+                map_result = matcher.map_directory_to_clients_from_index(path)
+                if map_result is not None:
+                    yield map_result
+                    continue
+            map_result = matcher.map_path_to_clients_from_index(path)
+            if not map_result.files:
+                click.echo(
+                    f"No files in the index for {path}, is it scanned?", err=True
+                )
+            yield map_result
+
+    return map_paths_to_clients
+
+
 @cli.command(help="See what is seeded for a given path.")
 @click.option(
     "-s",
@@ -205,9 +319,15 @@ def cli(ctx, config, verbose, utf8_compat_mode):
     flag_value=True,
     default=False,
 )
-@click.argument("path", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--from-index",
+    help="Use the scanned files and client files instead of looking at the files, paths must be scanned.",
+    flag_value=True,
+    default=False,
+)
+@click.argument("path", nargs=-1, type=click.Path())
 @click.pass_context
-def ls(ctx, summary, depth, include_indirect_seeded, path):
+def ls(ctx, summary, depth, include_indirect_seeded, from_index, path):
     if include_indirect_seeded and not ctx.obj["scan_hardlinks"]:
         raise click.BadOptionUsage(
             option_name="include_indirect_seeded",
@@ -215,12 +335,10 @@ def ls(ctx, summary, depth, include_indirect_seeded, path):
             ctx=ctx,
         )
 
-    if path:
-        paths = [Path(p) for p in path]
-    else:
-        paths = Path(".").iterdir()
+    paths = get_command_paths(ctx, path, from_index)
 
     matcher = ctx.obj["matcher"]
+    map_paths_to_clients = get_path_mapper(ctx, from_index, directory_sizes=True)
 
     stats = {
         "count": 0,
@@ -228,54 +346,95 @@ def ls(ctx, summary, depth, include_indirect_seeded, path):
         "total_size": 0,
     }
 
-    def scan_paths(paths):
-        for path in paths:
-            p = Path(os.path.abspath(path))
-            map_result = matcher.map_path_to_clients(p)
-            seeded_size = map_result.seeded_size + (
-                include_indirect_seeded and map_result.indirect_seeded_size or 0
-            )
-            percent = (
-                map_result.total_size
-                and int((seeded_size / map_result.total_size) * 100)
-                or 0
-            )
-            if map_result.total_size == seeded_size and map_result.total_size > 0:
-                color = "green"
-            elif seeded_size:
-                color = "yellow"
-                if percent == 0:
-                    percent = 1
-                if percent == 100:
-                    percent = 99
-            else:
-                color = "red"
+    def echo_path(path, sizes):
+        seeded_size = sizes.seeded_size + (
+            include_indirect_seeded and sizes.indirect_seeded_size or 0
+        )
+        percent = sizes.total_size and int((seeded_size / sizes.total_size) * 100) or 0
+        if sizes.total_size == seeded_size and sizes.total_size > 0:
+            color = "green"
+        elif seeded_size:
+            color = "yellow"
+            if percent == 0:
+                percent = 1
+            if percent == 100:
+                percent = 99
+        else:
+            color = "red"
 
-            stats["count"] += 1
-            stats["total_size"] += map_result.total_size
-            stats["total_seed_size"] += seeded_size
+        stats["count"] += 1
+        stats["total_size"] += sizes.total_size
+        stats["total_seed_size"] += seeded_size
 
-            click.echo(
-                f"[{click.style((str(percent) + '%').rjust(4), fg=color)}] {os.fsencode(path).decode(errors='replace')}"
-            )
+        click.echo(
+            f"[{click.style((str(percent) + '%').rjust(4), fg=color)}] {os.fsencode(path).decode(errors='replace')}"
+        )
 
-    def dive_paths(paths, depth):
-        if depth <= 0:
-            scan_paths(paths)
-        else:
-            file_paths = []
-            dir_paths = []
-            for path in paths:
-                if path.is_dir():
+    def scan_paths(paths):
+        paths = list(paths)
+        map_results = map_paths_to_clients([Path(os.path.abspath(p)) for p in paths])
+        for path, map_result in zip(paths, map_results):
+            echo_path(path, map_result)
+
+    def list_path_from_index(path):
+        file_names, directory_names = matcher.list_path_from_index(
+            Path(os.path.abspath(path))
+        )
+        return (
+            [path / name for name in file_names],
+            [path / name for name in directory_names],
+        )
+
+    def split_paths(paths):
+        file_paths = []
+        dir_paths = []
+        for path in paths:
+            if from_index:
+                p = Path(os.path.abspath(path))
+                file_names, directory_names = matcher.list_path_from_index(p.parent)
+                if p == p.parent or p.name in directory_names:
                     dir_paths.append(path)
-                elif path.is_file():
+                elif p.name in file_names:
                     file_paths.append(path)
-
-            scan_paths(file_paths)
+            elif path.is_dir():
+                dir_paths.append(path)
+            elif path.is_file():
+                file_paths.append(path)
+        return file_paths, dir_paths
+
+    def dive_tree(path, tree, depth):
+        """List the paths below path from the tree of path, depth is at least one."""
+        if depth <= 1:
+            for child_path in path.iterdir():
+                echo_path(child_path, tree.get([child_path.name]))
+            return
+
+        file_paths, dir_paths = split_paths(path.iterdir())
+        for file_path in file_paths:
+            echo_path(file_path, tree.get([file_path.name]))
+        for dir_path in dir_paths:
+            dive_tree(dir_path, tree.get([dir_path.name]), depth - 1)
+
+    def dive_paths(file_paths, dir_paths, depth):
+        scan_paths(file_paths)
+        if from_index:  # directory sizes are looked up per path
             for path in dir_paths:
-                dive_paths(path.iterdir(), depth - 1)
-
-    dive_paths(paths, depth)
+                child_file_paths, child_dir_paths = list_path_from_index(path)
+                if depth <= 1:
+                    scan_paths(child_file_paths + child_dir_paths)
+                else:
+                    dive_paths(child_file_paths, child_dir_paths, depth - 1)
+            return
+        abs_paths = [Path(os.path.abspath(p)) for p in dir_paths]
+        map_results = map_paths_to_clients(abs_paths)
+        for path, p, map_result in zip(dir_paths, abs_paths, map_results):
+            tree = matcher.build_map_tree(p, map_result, include_indirect_seeded)
+            dive_tree(path, tree, depth)
+
+    if depth <= 0:
+        scan_paths(paths)
+    else:
+        dive_paths(*split_paths(paths), depth)
 
     if summary:
         click.echo(f"Number of paths: {stats['count']}")
@@ -301,9 +460,15 @@ def ls(ctx, summary, depth, include_indirect_seeded, path):
     flag_value=True,
     default=False,
 )
-@click.argument("path", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--from-index",
+    help="Use the scanned files and client files instead of looking at the files, paths must be scanned.",
+    flag_value=True,
+    default=False,
+)
+@click.argument("path", nargs=-1, type=click.Path())
 @click.pass_context
-def find_unseeded(ctx, escape_paths, include_indirect_seeded, path):
+def find_unseeded(ctx, escape_paths, include_indirect_seeded, from_index, path):
     if include_indirect_seeded and not ctx.obj["scan_hardlinks"]:
         raise click.BadOptionUsage(
             option_name="include_indirect_seeded",
@@ -311,40 +476,22 @@ def find_unseeded(ctx, escape_paths, include_indirect_seeded, path):
             ctx=ctx,
         )
 
-    if path:
-        paths = [Path(p) for p in path]
-    else:
-        paths = Path(".").iterdir()
+    paths = get_command_paths(ctx, path, from_index)
 
     matcher = ctx.obj["matcher"]
-
-    for path in paths:
-        p = Path(os.path.abspath(path))
-        map_result = matcher.map_path_to_clients(p)
-        path_seeds = {}
-        for f, mapped_file in map_result.files.items():
-            if f.is_symlink():
-                continue
-            ff = f
-            is_seeded = len(mapped_file.clients) > 0 or (
-                include_indirect_seeded and len(mapped_file.indirect_clients) > 0
-            )
-            while p in ff.parents or p == ff:
-                if not is_seeded and ff in path_seeds:
-                    break
-                if path_seeds.get(ff):
-                    break
-                path_seeds[ff] = is_seeded
-                ff = ff.parent
-        only_unseeded_paths = set(
-            [f for (f, is_seeded) in path_seeds.items() if not is_seeded]
+    map_paths_to_clients = get_path_mapper(ctx, from_index)
+
+    abs_paths = [Path(os.path.abspath(path)) for path in paths]
+    for p, map_result in zip(abs_paths, map_paths_to_clients(abs_paths)):
+        map_result = map_result._replace(
+            files={
+                f: mapped_file
+                for (f, mapped_file) in map_result.files.items()
+                if is_relative_to(f, p) and (from_index or not f.is_symlink())
+            }
         )
-        base_unseeded_paths = []
-        for f in only_unseeded_paths:
-            if f.parent in only_unseeded_paths:
-                continue
-            base_unseeded_paths.append(f)
-        for unseeded_path in base_unseeded_paths:
+        tree = matcher.build_map_tree(p, map_result, include_indirect_seeded)
+        for unseeded_path in tree.iter_unseeded(p):
             unseeded_path = os.path.abspath(unseeded_path)
             if escape_paths:
                 unseeded_path = shlex.quote(unseeded_path)
@@ -376,10 +523,23 @@ def find_unseeded(ctx, escape_paths, include_indirect_seeded, path):
 )
 @click.option("-l", "--client", help="Check a specific client", type=str)
 @click.option("-q", "--query", help="SQL query to match against torrents", type=str)
-@click.argument("path", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--from-index",
+    help="Use the scanned files and client files instead of looking at the files, paths must be scanned.",
+    flag_value=True,
+    default=False,
+)
+@click.argument("path", nargs=-1, type=click.Path())
 @click.pass_context
 def find_unmoved(
-    ctx, summary, include_indirect_seeded, remove_from_client, client, query, path
+    ctx,
+    summary,
+    include_indirect_seeded,
+    remove_from_client,
+    client,
+    query,
+    from_index,
+    path,
 ):
     if include_indirect_seeded and not ctx.obj["scan_hardlinks"]:
         raise click.BadOptionUsage(
@@ -389,7 +549,6 @@ def find_unmoved(
         )
 
     db = ctx.obj["db"]
-    matcher = ctx.obj["matcher"]
     clients = ctx.obj["clients"]
     clients = {
         name: c["client"]
@@ -401,15 +560,12 @@ def find_unmoved(
         click.echo("No clients found")
         quit(1)
 
-    if path:
-        paths = [Path(p) for p in path]
-    else:
-        paths = Path(".").iterdir()
+    paths = get_command_paths(ctx, path, from_index)
 
+    map_paths_to_clients = get_path_mapper(ctx, from_index)
     found_infohashes = {client_name: set() for client_name in clients.keys()}
-    for path in paths:
-        p = Path(os.path.abspath(path))
-        map_result = matcher.map_path_to_clients(p)
+    abs_paths = [Path(os.path.abspath(path)) for path in paths]
+    for map_result in map_paths_to_clients(abs_paths):
         for f, mapped_file in map_result.files.items():
             file_clients = mapped_file.clients
             if include_indirect_seeded:
@@ -489,10 +645,15 @@ def check_config(ctx):
 )
 @click.option("-l", "--client", help="Remove from a specific client", type=str)
 @click.option("-q", "--query", help="SQL query to match against torrents", type=str)
-@click.argument("path", nargs=-1, type=click.Path(exists=True), required=True)
+@click.option(
+    "--from-index",
+    help="Use the scanned files and client files instead of looking at the files, paths must be scanned.",
+    flag_value=True,
+    default=False,
+)
+@click.argument("path", nargs=-1, type=click.Path(), required=True)
 @click.pass_context
-def rm(ctx, client, query, path):
-    matcher = ctx.obj["matcher"]
+def rm(ctx, client, query, from_index, path):
     clients = ctx.obj["clients"]
     clients = {
         name: c["client"]
@@ -504,10 +665,12 @@ def rm(ctx, client, query, path):
         click.echo("No clients found")
         quit(1)
 
+    map_paths_to_clients = get_path_mapper(ctx, from_index)
     infohashes_to_remove = {}
-    for orig_p in path:
-        p = Path(os.path.abspath(orig_p))
-        map_result = matcher.map_path_to_clients(p)
+    abs_paths = [
+        Path(os.path.abspath(p)) for p in get_command_paths(ctx, path, from_index)
+    ]
+    for map_result in map_paths_to_clients(abs_paths):
         for mapped_file in map_result.files.values():
             for client_name, infohash in mapped_file.clients:
                 if client_name not in clients:
@@ -602,6 +765,12 @@ def validate_store_path_variable(ctx, param, value):
     callback=validate_store_path_variable,
     multiple=True,
 )
+@click.option(
+    "--refresh",
+    help="Evaluate torrent files again even if they are unchanged since the last run.",
+    flag_value=True,
+    default=False,
+)
 @click.argument("torrent", nargs=-1, type=click.Path(exists=True, dir_okay=False))
 @click.pass_context  # TODO: allow feedback while running
 def add(
@@ -618,11 +787,14 @@ def add(
     stopped,
     store_path_template,
     store_path_variable,
+    refresh,
 ):
+    use_idle_io_priority(ctx)
     torrent_paths = torrent
     client_name = client
     db = ctx.obj["db"]
     matcher = ctx.obj["matcher"]
+    rewriter = ctx.obj["rewriter"]
     rw_cache = ctx.obj["rw_cache"]
 
     clients = ctx.obj["clients"]
@@ -649,18 +821,120 @@ def add(
         )
         quit(1)
 
+    match_options = json.dumps(
+        {
+            "exact": exact,
+            "hash_probe": hash_probe,
+            "hash_size": hash_size,
+            "add_limit_size": ctx.obj["add_limit_size"],
+            "add_limit_percent": ctx.obj["add_limit_percent"],
+            "always_verify_hash": ctx.obj["always_verify_hash"],
+        },
+        sort_keys=True,
+    )
+    match_cache_options = None
+    if ctx.obj["cache_matches"]:
+        match_cache_options = match_options
+    files_generation = db.get_files_generation()
+
+    def missing_percentage_info(missing_size, torrent_size):
+        percent = torrent_size and int((1 - (missing_size / torrent_size)) * 100) or 0
+        if missing_size < torrent_size:
+            color = "yellow"
+            if percent == 0:
+                percent = 1
+            if percent == 100:
+                percent = 99
+        else:
+            color = "red"
+        return f"with {click.style((str(percent) + '%').rjust(3), fg=color)} found"
+
     stats = {"seeded": 0, "added": 0, "exists": 0, "failed": 0, "missing_files": 0}
+    io_budget = ctx.obj["io_budget"]
+    io_bytes_read, io_throttled_time = io_budget.bytes_read, io_budget.throttled_time
+    probe_policy = matcher.probe_policy
+    probe_cost = (
+        probe_policy.probed_pieces,
+        probe_policy.cached_pieces,
+        probe_policy.bytes_read,
+    )
     for torrent_path in torrent_paths:
         torrent_store_path_variables = dict(store_path_variables)
         torrent_path = Path(torrent_path)
+        catalog_path = os.path.abspath(torrent_path)
+        torrent_stat = torrent_path.stat()
+
+        def update_catalog(outcome, infohash=None, filelist=None, missing_size=None):
+            if dry_run:
+                return
+            db.insert_torrent_catalog_entry(
+                client_name,
+                catalog_path,
+                torrent_stat.st_size,
+                torrent_stat.st_mtime_ns,
+                infohash,
+                filelist,
+                outcome,
+                missing_size,
+                files_generation,
+                match_options,
+            )
+
+        catalog_entry = None
+        if not refresh:
+            catalog_entry = db.get_torrent_catalog_entry(client_name, catalog_path)
+        if catalog_entry and (catalog_entry.size, catalog_entry.mtime) == (
+            torrent_stat.st_size,
+            torrent_stat.st_mtime_ns,
+        ):
+            if catalog_entry.outcome == "failed":
+                add_status_formatter(
+                    "failed", torrent_path, "failed to parse torrent file"
+                )
+                stats["failed"] += 1
+                continue
+
+            if catalog_entry.infohash in existing_torrents:
+                add_status_formatter("seeded", torrent_path, "is already seeded")
+                stats["seeded"] += 1
+                if not dry_run:
+                    db.remove_unmatched_torrent(client_name, catalog_path)
+                if catalog_entry.outcome != "seeded":
+                    update_catalog(
+                        "seeded", catalog_entry.infohash, catalog_entry.filelist
+                    )
+                continue
+
+            if (
+                catalog_entry.outcome == "missing_files"
+                and catalog_entry.files_generation == files_generation
+                and catalog_entry.options == match_options
+            ):
+                percentage_info = None
+                if catalog_entry.missing_size is not None:
+                    percentage_info = missing_percentage_info(
+                        catalog_entry.missing_size,
+                        sum(size for (_, size) in catalog_entry.filelist),
+                    )
+                add_status_formatter(
+                    "missing_files",
+                    torrent_path,
+                    f"is missing data{percentage_info and ' ' + percentage_info or ''}"
+                    + " and no files are scanned since last time",
+                )
+                stats["missing_files"] += 1
+                continue
+
         try:
-            torrent_data = bdecode(torrent_path.read_bytes())
+            torrent_data, torrent_info = bdecode_torrent(torrent_path.read_bytes())
             torrent = parse_torrent(torrent_data, utf8_compat_mode=db.utf8_compat_mode)
         except (BTFailure, FailedToParseTorrentException):
             logger.exception("Failed to parse torrent file")
             add_status_formatter("failed", torrent_path, "failed to parse torrent file")
             stats["failed"] += 1
+            update_catalog("failed")
             continue
+        torrent_filelist = [[list(tf.path.parts), tf.size] for tf in torrent.filelist]
         if torrent.trackers:
             torrent_store_path_variables["tracker_domain"] = re.sub(
                 r"[\\/]", "_", get_tracker_domain(torrent.trackers[0])
@@ -677,22 +951,85 @@ def add(
             )
             stats["failed"] += 1
             continue
-        infohash = hashlib.sha1(bencode(torrent_data[b"info"])).hexdigest()
+        infohash = hashlib.sha1(torrent_info).hexdigest()
         if infohash in existing_torrents:
             add_status_formatter("seeded", torrent_path, "is already seeded")
             stats["seeded"] += 1
+            if not dry_run:
+                db.remove_unmatched_torrent(client_name, catalog_path)
+            update_catalog("seeded", infohash, torrent_filelist)
             continue
 
         found_bad_hash = False
+        have_pieces = None
         missing_size = None
+        needed_sizes = None
         torrent_root_path = None
+        fingerprint, cached_match = None, None
+        if match_cache_options is not None:
+            fingerprint = torrent.filelist_fingerprint(
+                include_piece_hashes=ctx.obj["cache_matches_piece_hashes"]
+            )
+            cached_match = matcher.get_cached_match(
+                torrent, fingerprint, match_cache_options
+            )
+            if cached_match:
+                logger.info(f"Using cached match for {torrent_path}")
+
+        def verify_hash(file_mapping):
+            if cached_match and cached_match.hash_verify_result is not None:
+                return (
+                    cached_match.hash_verify_result,
+                    cached_match.hash_touch_result,
+                    {},
+                )
+            read_file_mapping = {
+                torrent_path: actual_path and rewriter.read_path(actual_path)
+                for (torrent_path, actual_path) in file_mapping.items()
+            }
+            pieces_to_verify, piece_segments = torrent.plan_verify_hash(
+                ctx.obj["always_verify_hash"], read_file_mapping
+            )
+            piece_results = hash_pieces(
+                piece_segments,
+                torrent.pieces,
+                io_budget=ctx.obj["io_budget"],
+                piece_cache=ctx.obj["piece_cache"],
+            )
+            hash_verify_result, hash_touch_result = torrent.verify_hash_results(
+                ctx.obj["always_verify_hash"],
+                read_file_mapping,
+                pieces_to_verify,
+                piece_results,
+            )
+            # pieces that could not be planned are unreadable too
+            piece_results = {p: piece_results.get(p) for p in pieces_to_verify}
+            return hash_verify_result, hash_touch_result, piece_results
+
+        def cache_match(file_mapping, hash_verify_result, hash_touch_result, **kwargs):
+            if fingerprint is None or cached_match:
+                return
+            if not ctx.obj["cache_matches_piece_hashes"]:
+                hash_verify_result, hash_touch_result = None, None
+            matcher.cache_match(
+                fingerprint,
+                match_cache_options,
+                file_mapping,
+                hash_verify_result=hash_verify_result,
+                hash_touch_result=hash_touch_result,
+                **kwargs,
+            )
+
         if exact:
-            torrent_root_path = matcher.match_files_exact(torrent_data)
+            if cached_match:
+                torrent_root_path = cached_match.root_path
+            else:
+                torrent_root_path = matcher.match_files_exact(torrent)
             if torrent_root_path:
-                hash_verify_result, hash_touch_result = torrent.verify_hash(
-                    ctx.obj["always_verify_hash"],
-                    {tf.path: torrent_root_path / tf.path for tf in torrent.filelist},
-                )
+                file_mapping = {
+                    tf.path: torrent_root_path / tf.path for tf in torrent.filelist
+                }
+                hash_verify_result, hash_touch_result, _ = verify_hash(file_mapping)
                 if any(
                     tf
                     for (tf, tf_result) in hash_verify_result.items()
@@ -700,18 +1037,33 @@ def add(
                 ):
                     torrent_root_path = None
                     found_bad_hash = True
+                else:
+                    cache_match(
+                        file_mapping,
+                        hash_verify_result,
+                        hash_touch_result,
+                        root_path=torrent_root_path,
+                    )
         else:
-            match_result = matcher.match_files_dynamic(
-                torrent_data,  # TODO: double parsed here
-                match_hash_size=hash_size,
-                add_limit_size=ctx.obj["add_limit_size"],
-                add_limit_percent=ctx.obj["add_limit_percent"],
-                hash_probe=hash_probe,
-            )
+            if cached_match:
+                match_result = DynamicMatchResult(
+                    True,
+                    cached_match.missing_size,
+                    cached_match.matched_files,
+                    cached_match.touched_files,
+                )
+            else:
+                match_result = matcher.match_files_dynamic(
+                    torrent,
+                    match_hash_size=hash_size,
+                    add_limit_size=ctx.obj["add_limit_size"],
+                    add_limit_percent=ctx.obj["add_limit_percent"],
+                    hash_probe=hash_probe,
+                )
             missing_size = match_result.missing_size
             if match_result.success:
-                hash_verify_result, hash_touch_result = torrent.verify_hash(
-                    ctx.obj["always_verify_hash"], match_result.matched_files
+                hash_verify_result, hash_touch_result, piece_results = verify_hash(
+                    match_result.matched_files
                 )
                 failed_torrent_files = {
                     tf.path: tf
@@ -719,11 +1071,24 @@ def add(
                     if tf_result == "hash-failed"
                 }
                 missing_size += sum(tf.size for tf in failed_torrent_files.values())
+                needed_sizes = [
+                    tf.size
+                    for tf in torrent.filelist
+                    if not match_result.matched_files[tf.path]
+                    or tf.path in failed_torrent_files
+                ]
                 max_missing_size = min(
                     ctx.obj["add_limit_size"],
                     (ctx.obj["add_limit_percent"] * torrent.size) // 100,
                 )
                 if max_missing_size > missing_size:
+                    cache_match(
+                        match_result.matched_files,
+                        hash_verify_result,
+                        hash_touch_result,
+                        missing_size=match_result.missing_size,
+                        touched_files=match_result.touched_files,
+                    )
                     if ctx.obj.get("cache_touched_files"):
                         touched_torrent_paths = set(match_result.touched_files) | {
                             tf.path
@@ -765,11 +1130,22 @@ def add(
                             chown_str=chown,
                             dry_run=dry_run,
                             skip_store_metadata=skip_store_metadata,
+                            rewriter=rewriter,
                         )  # TODO: feedback that things take time when caching
                         if dry_run:
                             torrent_root_path = "/tmp/autotorrent_dry_run"
                         else:
                             torrent_root_path = create_link_result.data_path
+                        have_pieces = torrent.have_pieces(
+                            match_result.matched_files,
+                            set(failed_torrent_files)
+                            | {
+                                tf.path
+                                for (tf, tf_result) in hash_touch_result.items()
+                                if tf_result == "touch-failed"
+                            },
+                            piece_results=piece_results,
+                        )
                     except FailedToCreateLinkException as e:
                         logger.debug(f"Failed to create path: {e}")
                         stats["exists"] += 1
@@ -805,11 +1181,24 @@ def add(
                 add_status_formatter("added", torrent_path, "added")
                 stats["added"] += 1
             else:
+                torrent_data[b"info"][b"pieces"] = bytes(
+                    torrent_data[b"info"][b"pieces"]
+                )
+                fast_resume = ctx.obj["fast_resume"]
+                if fast_resume and have_pieces and not all(have_pieces):
+                    logger.info(
+                        f"Data has {sum(have_pieces)} of {len(have_pieces)} pieces"
+                    )
+                    if client.identifier == "rtorrent":
+                        add_libtorrent_resume(
+                            torrent_data, torrent, torrent_root_path, have_pieces
+                        )
+                    fast_resume = False
                 try:
                     client.add(
                         torrent_data,
                         torrent_root_path,
-                        fast_resume=ctx.obj["fast_resume"],
+                        fast_resume=fast_resume,
                         stopped=stopped,
                     )
                 except FailedToExecuteException as e:
@@ -821,6 +1210,8 @@ def add(
                 else:
                     add_status_formatter("added", torrent_path, "added")
                     stats["added"] += 1
+                    db.remove_unmatched_torrent(client_name, catalog_path)
+                    update_catalog("added", infohash, torrent_filelist)
                     if move_torrent_on_add:
                         move_torrent_on_add = Path(move_torrent_on_add)
                         move_torrent_on_add.mkdir(exist_ok=True, parents=True)
@@ -829,20 +1220,7 @@ def add(
         else:
             percentage_info = None
             if missing_size is not None:
-                percent = (
-                    torrent.size and int((1 - (missing_size / torrent.size)) * 100) or 0
-                )
-                if missing_size < torrent.size:
-                    color = "yellow"
-                    if percent == 0:
-                        percent = 1
-                    if percent == 100:
-                        percent = 99
-                else:
-                    color = "red"
-                percentage_info = (
-                    f"with {click.style((str(percent) + '%').rjust(3), fg=color)} found"
-                )
+                percentage_info = missing_percentage_info(missing_size, torrent.size)
             add_status_formatter(
                 "missing_files",
                 torrent_path,
@@ -850,8 +1228,31 @@ def add(
                 + (found_bad_hash and " due to bad file hashes" or ""),
             )
             stats["missing_files"] += 1
+            if not dry_run:
+                db.insert_unmatched_torrent(
+                    client_name,
+                    catalog_path,
+                    infohash,
+                    missing_size,
+                    needed_sizes or [tf.size for tf in torrent.filelist],
+                )
+            update_catalog("missing_files", infohash, torrent_filelist, missing_size)
             continue
 
+    io_bytes_read = io_budget.bytes_read - io_bytes_read
+    io_throttled_time = io_budget.throttled_time - io_throttled_time
+    logger.info(
+        f"Read {io_bytes_read} bytes while hashing and copying, throttled for {io_throttled_time:.2f} seconds"
+    )
+    probed_pieces, cached_pieces, probe_bytes_read = (
+        probe_policy.probed_pieces - probe_cost[0],
+        probe_policy.cached_pieces - probe_cost[1],
+        probe_policy.bytes_read - probe_cost[2],
+    )
+    logger.info(
+        f"Hash probes read {probed_pieces} pieces ({probe_bytes_read} bytes) and used {cached_pieces} cached pieces"
+    )
+
     if print_summary:
         click.echo("")
         click.echo("Summary:")
@@ -861,6 +1262,309 @@ def add(
         click.echo(f" Folder exists:  {stats['exists']}")
         click.echo(f" Already seeded: {stats['seeded']}")
         click.echo(f" Total:          {sum(stats.values())}")
+        click.echo(f" Data read:      {humanize_bytes(io_bytes_read)}")
+        click.echo(f" Throttled:      {io_throttled_time:.1f}s")
+        click.echo(
+            f" Probed pieces:  {probed_pieces} ({humanize_bytes(probe_bytes_read)}), {cached_pieces} cached"
+        )
+
+
+@cli.command(
+    help="Add torrents from the unmatched backlog that might match after new files are scanned."
+)
+@click.argument("client", type=str)
+@click.option(
+    "-e",
+    "--exact",
+    help='Exact matching mode. Can also be considered a "reseed" mode. Disables all other modes.',
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "-s",
+    "--hash-probe",
+    help="Probe matched files for full pieces to ensure the data matches.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "-a",
+    "--hash-size",
+    help="Hash size matching mode, checks for files with same size but different filenames.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "--all",
+    "all_torrents",
+    help="Re-evaluate the whole backlog, not only the torrents where new data is found.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "--print-summary",
+    help="Print a summary of all actions when done.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "--stopped",
+    help="Add the torrent in stopped state.",
+    flag_value=True,
+    default=False,
+)
+@click.pass_context
+def add_unmatched(
+    ctx, client, exact, hash_probe, hash_size, all_torrents, print_summary, stopped
+):
+    db = ctx.obj["db"]
+    torrent_paths = []
+    for torrent_path in db.get_unmatched_torrents(
+        client, pending_only=not all_torrents
+    ):
+        if not torrent_path.is_file():
+            logger.debug(f"Torrent {torrent_path} no longer exist, removing from backlog")
+            db.remove_unmatched_torrent(client, torrent_path)
+            continue
+        torrent_paths.append(str(torrent_path))
+
+    if not torrent_paths:
+        click.echo("No unmatched torrents to re-evaluate")
+        return
+
+    ctx.invoke(
+        add,
+        client=client,
+        exact=exact,
+        hash_probe=hash_probe,
+        hash_size=hash_size,
+        torrent=torrent_paths,
+        print_summary=print_summary,
+        stopped=stopped,
+        refresh=all_torrents,
+    )
+
+
+@cli.command(help="Verify all pieces of torrents against their data.")
+@click.option(
+    "-p",
+    "--path",
+    help="Path the torrent data is in, e.g. the data folder of a store path. Matched with the scanned files if not set.",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "-e",
+    "--exact",
+    help="Match the data with exact matching mode instead of dynamic matching.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "--restart",
+    help="Start over instead of resuming an interrupted verification.",
+    flag_value=True,
+    default=False,
+)
+@click.option(
+    "--json",
+    "output_json",
+    help="Print the result of every file and piece as JSON.",
+    flag_value=True,
+    default=False,
+)
+@click.argument("torrent", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def verify(ctx, path, exact, restart, output_json, torrent):
+    use_idle_io_priority(ctx)
+    db = ctx.obj["db"]
+    matcher = ctx.obj["matcher"]
+    rewriter = ctx.obj["rewriter"]
+    io_budget = ctx.obj["io_budget"]
+
+    def print_progress(progress):
+        rate = progress.elapsed and progress.bytes_hashed / progress.elapsed or 0
+        eta = rate and humanize_duration(progress.bytes_left / rate) or "unknown"
+        click.echo(
+            f" Verified {progress.verified_pieces}/{progress.total_pieces} pieces, {humanize_bytes(rate)}/s, ETA {eta}",
+            err=True,
+        )
+
+    results = []
+    has_failed = False
+    for torrent_path in torrent:
+        torrent_path = Path(torrent_path)
+        try:
+            torrent_data, torrent_info = bdecode_torrent(torrent_path.read_bytes())
+            parsed_torrent = parse_torrent(
+                torrent_data, utf8_compat_mode=db.utf8_compat_mode
+            )
+        except (BTFailure, FailedToParseTorrentException):
+            logger.exception("Failed to parse torrent file")
+            add_status_formatter("failed", torrent_path, "failed to parse torrent file")
+            has_failed = True
+            continue
+        infohash = hashlib.sha1(torrent_info).hexdigest()
+
+        file_mapping = None
+        if path:
+            file_mapping = {}
+            for tf in parsed_torrent.filelist:
+                full_path = Path(path) / tf.path
+                file_mapping[tf.path] = full_path.is_file() and full_path or None
+        elif exact:
+            torrent_root_path = matcher.match_files_exact(parsed_torrent)
+            if torrent_root_path:
+                file_mapping = {
+                    tf.path: torrent_root_path / tf.path
+                    for tf in parsed_torrent.filelist
+                }
+        else:
+            match_result = matcher.match_files_dynamic(
+                parsed_torrent,
+                add_limit_size=parsed_torrent.size,
+                add_limit_percent=100,
+            )
+            if match_result.success:
+                file_mapping = match_result.matched_files
+
+        if file_mapping and not path:
+            file_mapping = {
+                torrent_path: actual_path and rewriter.read_path(actual_path)
+                for (torrent_path, actual_path) in file_mapping.items()
+            }
+
+        if not file_mapping or not any(file_mapping.values()):
+            add_status_formatter("missing_files", torrent_path, "no data found")
+            has_failed = True
+            continue
+
+        verify_result = verify_torrent(
+            parsed_torrent,
+            infohash,
+            file_mapping,
+            db,
+            io_budget=io_budget,
+            restart=restart,
+            progress=not output_json and print_progress or None,
+        )
+        ok_pieces = verify_result.pieces.count("1")
+        failed_pieces = verify_result.pieces.count("0")
+        missing_pieces = verify_result.pieces.count("-")
+        if failed_pieces:
+            status = "failed"
+        elif missing_pieces:
+            status = "missing_files"
+        else:
+            status = "verified"
+        has_failed = has_failed or status != "verified"
+
+        if output_json:
+            results.append(
+                {
+                    "torrent": str(torrent_path),
+                    "infohash": infohash,
+                    "pieces": verify_result.pieces,
+                    "files": [
+                        {
+                            "path": str(tf.path),
+                            "full_path": file_mapping[tf.path]
+                            and str(file_mapping[tf.path])
+                            or None,
+                            **file_result._asdict(),
+                        }
+                        for (tf, file_result) in verify_result.files.items()
+                    ],
+                }
+            )
+            continue
+
+        add_status_formatter(
+            status,
+            torrent_path,
+            f"{ok_pieces}/{len(verify_result.pieces)} pieces ok, {failed_pieces} failed, {missing_pieces} not readable",
+        )
+        for tf, file_result in verify_result.files.items():
+            if file_result.status == "hash-success":
+                continue
+            click.echo(
+                f"   {file_result.status:12s} {str(tf.path)!r} {file_result.failed_pieces} failed, {file_result.missing_pieces} not readable"
+            )
+
+    if output_json:
+        click.echo(json.dumps(results, indent=2))
+
+    if has_failed:
+        quit(1)
+
+
+@cli.command(help="Verify a slice of the seeded store paths, the whole library is verified over scrub_days runs.")
+@click.argument(
+    "path", nargs=-1, type=click.Path(exists=True, file_okay=False, dir_okay=True)
+)
+@click.pass_context
+def scrub(ctx, path):
+    use_idle_io_priority(ctx)
+    db = ctx.obj["db"]
+    clients = ctx.obj["clients"]
+
+    if not path:
+        store_path = ctx.obj.get("store_path")
+        if not store_path:
+            click.echo("No path given and no store path configured")
+            quit(1)
+        path = [Path(os.path.dirname(store_path.split("{")[0]))]
+
+    seeded_infohashes = set()
+    for client in clients.values():
+        seeded_infohashes |= {t.infohash for t in client["client"].list()}
+
+    store_torrents = []
+    for p in path:
+        for store_path in find_store_paths(Path(p)):
+            store_torrent = load_store_torrent(
+                store_path, utf8_compat_mode=db.utf8_compat_mode
+            )
+            if store_torrent and store_torrent.infohash in seeded_infohashes:
+                store_torrents.append(store_torrent)
+
+    library_size = sum(st.torrent.size for st in store_torrents)
+    budget_size = -(-library_size // max(ctx.obj["scrub_days"], 1))
+    click.echo(
+        f"Scrubbing {humanize_bytes(budget_size)} of {len(store_torrents)} seeded torrent{len(store_torrents) != 1 and 's' or ''} ({humanize_bytes(library_size)})"
+    )
+
+    io_budget = ctx.obj["io_budget"]
+    if ctx.obj["scrub_max_read_rate"]:
+        io_budget = IOBudget(
+            max_read_rate=ctx.obj["scrub_max_read_rate"] * 1_000_000,
+            max_concurrent_reads=ctx.obj["io_max_concurrent_reads"],
+        )
+
+    start_time = time.monotonic()
+    results = scrub_torrents(store_torrents, db, budget_size, io_budget=io_budget)
+    elapsed = time.monotonic() - start_time
+
+    for result in results:
+        if result.failed_pieces or result.missing_pieces:
+            add_status_formatter(
+                "failed",
+                result.store_torrent.store_path,
+                f"has {result.failed_pieces} bad and {result.missing_pieces} unreadable pieces",
+            )
+        if result.completed:
+            click.echo(
+                f" {str(result.store_torrent.store_path)!r} is scrubbed, {result.pass_failed_pieces} bad and {result.pass_missing_pieces} unreadable pieces"
+            )
+
+    verified_pieces = sum(r.verified_pieces for r in results)
+    bytes_read = sum(r.bytes_read for r in results)
+    rate = elapsed and bytes_read / elapsed or 0
+    click.echo(
+        f"Verified {verified_pieces} pieces in {len(results)} torrent{len(results) != 1 and 's' or ''}, read {humanize_bytes(bytes_read)} at {humanize_bytes(rate)}/s"
+    )
+
+    if any(r.failed_pieces or r.missing_pieces for r in results):
+        quit(1)
 
 
 @cli.command(help="Cleanup RW cache for expired items.")
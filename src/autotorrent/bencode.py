@@ -0,0 +1,94 @@
+"""
+Bencode decoder for torrent files.
+
+It decodes like the libtc decoder but keeps track of where the info dict is
+in the raw data, so the infohash can be calculated from the original bytes
+without encoding the info dict again. The pieces are kept as a memoryview
+of the raw data instead of being copied.
+"""
+
+from libtc import BTFailure
+
+ZERO_COPY_KEYS = {b"pieces"}
+
+
+def _decode_int(data, view, f):
+    f += 1
+    end = data.index(b"e", f)
+    n = int(data[f:end])
+    if data[f] == 45:
+        if data[f + 1] == 48:
+            raise ValueError
+    elif data[f] == 48 and end != f + 1:
+        raise ValueError
+    return n, end + 1
+
+
+def _decode_string(data, view, f, zero_copy=False):
+    colon = data.index(b":", f)
+    n = int(data[f:colon])
+    if data[f] == 48 and colon != f + 1:
+        raise ValueError
+    colon += 1
+    end = colon + n
+    if n < 0 or end > len(data):
+        raise ValueError
+    if zero_copy:
+        return view[colon:end], end
+    return data[colon:end], end
+
+
+def _decode_list(data, view, f):
+    r, f = [], f + 1
+    while data[f] != 101:
+        v, f = _DECODE_FUNC[data[f]](data, view, f)
+        r.append(v)
+    return r, f + 1
+
+
+def _decode_dict(data, view, f):
+    r, f = {}, f + 1
+    while data[f] != 101:
+        k, f = _decode_string(data, view, f)
+        if k in ZERO_COPY_KEYS and 48 <= data[f] <= 57:
+            r[k], f = _decode_string(data, view, f, zero_copy=True)
+        else:
+            r[k], f = _DECODE_FUNC[data[f]](data, view, f)
+    return r, f + 1
+
+
+_DECODE_FUNC = {
+    100: _decode_dict,
+    105: _decode_int,
+    108: _decode_list,
+}
+for i in range(48, 58):
+    _DECODE_FUNC[i] = _decode_string
+
+
+def bdecode_torrent(data):
+    """
+    Decode a torrent file.
+
+    Returns the decoded torrent and a memoryview of the raw info dict,
+    the info dict is None if the torrent does not have one.
+    """
+    data = bytes(data)
+    view = memoryview(data)
+    torrent, info = {}, None
+    try:
+        if data[0] != 100:
+            raise ValueError
+        f = 1
+        while data[f] != 101:
+            k, f = _decode_string(data, view, f)
+            info_start = f
+            torrent[k], f = _DECODE_FUNC[data[f]](data, view, f)
+            if k == b"info":
+                info = view[info_start:f]
+        f += 1
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string")
+    if f != len(data):
+        raise BTFailure("invalid bencoded value (data after valid prefix)")
+    return torrent, info
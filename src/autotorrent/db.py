@@ -1,7 +1,9 @@
+import json
 import logging
 import os
 import sqlite3
 from collections import namedtuple
+from datetime import datetime
 from pathlib import Path
 
 from .utils import decode_str, normalize_filename
@@ -18,9 +20,40 @@ InsertTorrentFile = namedtuple(
 )
 
 
+TorrentCatalogEntry = namedtuple(
+    "TorrentCatalogEntry",
+    [
+        "size",
+        "mtime",
+        "infohash",
+        "filelist",
+        "outcome",
+        "missing_size",
+        "files_generation",
+        "options",
+    ],
+)
+
+ScrubProgress = namedtuple(
+    "ScrubProgress", ["next_piece", "failed_pieces", "missing_pieces", "scrubbed"]
+)
+
+
 class SearchedFile(
     namedtuple(
-        "SearchedFile", ["name", "path", "size", "normalized_name", "unsplitable_root"]
+        "SearchedFile",
+        [
+            "name",
+            "path",
+            "size",
+            "normalized_name",
+            "unsplitable_root",
+            "mtime",
+            "inode",
+            "fingerprint",
+            "hole_size",
+        ],
+        defaults=(None, None, None, None),
     )
 ):
     def to_full_path(self):
@@ -33,6 +66,7 @@ class Database:
     def __init__(self, path, utf8_compat_mode=False):
         self.db = sqlite3.connect(path)
         self.utf8_compat_mode = utf8_compat_mode
+        self._seeded_inodes = None
         self.create_tables()
 
     def create_tables(self):
@@ -51,6 +85,19 @@ class Database:
             """CREATE INDEX IF NOT EXISTS idx_normalized_name ON files(normalized_name)"""
         )
         c.execute("""CREATE INDEX IF NOT EXISTS idx_size ON files(size)""")
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_path ON files(path)""")
+        for column in [
+            "mtime INTEGER",
+            "inode INTEGER",
+            "fingerprint varchar",
+            "hole_size INTEGER",
+            "files_generation INTEGER",
+            "dev INTEGER",
+        ]:
+            try:
+                c.execute(f"""ALTER TABLE files ADD COLUMN {column}""")
+            except sqlite3.OperationalError:
+                pass
         c.execute(
             """CREATE TABLE IF NOT EXISTS client_torrents (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,25 +116,149 @@ class Database:
             UNIQUE(path, torrent_id)
         )"""
         )
-        try:
-            c.execute("""ALTER TABLE client_torrentfiles ADD COLUMN inode INTEGER""")
-        except sqlite3.OperationalError:
-            pass
+        for column in ["inode INTEGER", "dev INTEGER"]:
+            try:
+                c.execute(f"""ALTER TABLE client_torrentfiles ADD COLUMN {column}""")
+            except sqlite3.OperationalError:
+                pass
         c.execute(
             """CREATE INDEX IF NOT EXISTS client_torrentfiles_inode ON client_torrentfiles (inode)"""
         )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS meta (
+            key varchar NOT NULL,
+            value varchar NOT NULL,
+            UNIQUE(key)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS torrent_catalog (
+            client varchar NOT NULL,
+            torrent_path varchar NOT NULL,
+            size integer NOT NULL,
+            mtime integer NOT NULL,
+            infohash varchar,
+            filelist varchar,
+            outcome varchar NOT NULL,
+            missing_size integer,
+            files_generation integer NOT NULL,
+            options varchar NOT NULL,
+            UNIQUE(client, torrent_path)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS unmatched_torrents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client varchar NOT NULL,
+            torrent_path varchar NOT NULL,
+            infohash varchar NOT NULL,
+            missing_size integer,
+            files_generation integer NOT NULL,
+            pending bool NOT NULL DEFAULT 0,
+            UNIQUE(client, torrent_path)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS unmatched_torrent_sizes (
+            torrent_id integer NOT NULL,
+            size integer NOT NULL,
+            UNIQUE(torrent_id, size)
+        )"""
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS unmatched_torrent_sizes_size ON unmatched_torrent_sizes (size)"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS match_cache (
+            fingerprint varchar NOT NULL,
+            options varchar NOT NULL,
+            result varchar NOT NULL,
+            UNIQUE(fingerprint, options)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS piece_hash_cache (
+            name varchar NOT NULL,
+            path varchar NOT NULL,
+            size integer NOT NULL,
+            mtime integer NOT NULL,
+            offset integer NOT NULL,
+            length integer NOT NULL,
+            digest blob NOT NULL,
+            UNIQUE(name, path, offset, length)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS first_piece_hashes (
+            name varchar NOT NULL,
+            path varchar NOT NULL,
+            size integer NOT NULL,
+            mtime integer NOT NULL,
+            piece_length integer NOT NULL,
+            digest blob NOT NULL,
+            UNIQUE(name, path, piece_length)
+        )"""
+        )
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS first_piece_hashes_digest ON first_piece_hashes (digest)"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS scrub_progress (
+            infohash varchar NOT NULL,
+            next_piece integer NOT NULL,
+            failed_pieces integer NOT NULL,
+            missing_pieces integer NOT NULL,
+            scrubbed datetime,
+            UNIQUE(infohash)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS verify_progress (
+            infohash varchar NOT NULL,
+            mapping varchar NOT NULL,
+            pieces varchar NOT NULL,
+            updated datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(infohash)
+        )"""
+        )
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS directory_sizes (
+            path varchar NOT NULL,
+            total_size integer NOT NULL,
+            seeded_size integer NOT NULL,
+            indirect_seeded_size integer NOT NULL,
+            UNIQUE(path)
+        )"""
+        )
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_inode ON files(inode)""")
+        c.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS changed_client_files (
+            path varchar NOT NULL,
+            dev integer,
+            inode integer
+        )"""
+        )
+        c.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS seeded_path_lookup (
+            id integer NOT NULL,
+            path varchar,
+            inode integer,
+            dev integer
+        )"""
+        )
         self.db.commit()
 
     def commit(self):
         self.db.commit()
 
-    def insert_file_paths(self, iterable):
+    def insert_file_paths(self, iterable, files_generation=None):
         """Take an interable that generates a tuple with the three
-        fields defined in `create_insert` and normalize them for
-        insertion into the DB"""
+        fields defined in `create_insert`, optionally followed by mtime, inode, hole size and dev,
+        and normalize them for insertion into the DB. New files are marked with files_generation."""
 
         def create_insert(args):
-            path, size, unsplitable_root = args
+            path, size, unsplitable_root, *file_stat = args
+            mtime, inode, hole_size, dev = (file_stat + [None, None, None, None])[:4]
             unsplitable_root = str(unsplitable_root)
             decoded_path = decode_str(os.fsencode(path), try_fix=self.utf8_compat_mode)
             if decoded_path is None:
@@ -97,17 +268,88 @@ class Database:
             logger.debug(
                 f"Inserting name: {name!r} name_path: {name_path!r} size: {size} normalized_name: {normalized_name!r}  unsplitable_root {unsplitable_root!r}"
             )
-            return (name, name_path, size, normalized_name, unsplitable_root)
+            return (
+                name,
+                name_path,
+                size,
+                normalized_name,
+                unsplitable_root,
+                mtime,
+                inode,
+                hole_size,
+                files_generation,
+                dev,
+            )
 
         c = self.db.cursor()
         try:
             c.executemany(
-                "INSERT OR IGNORE INTO files (name, path, size, normalized_name, unsplitable_root) VALUES (?, ?, ?, ?, ?)",
+                "INSERT OR IGNORE INTO files (name, path, size, normalized_name, unsplitable_root, mtime, inode, hole_size, files_generation, dev) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 [row for row in map(create_insert, iterable) if row is not None],
             )
         finally:
             c.close()
 
+    def save_indexed_files(self):
+        """Keep the fingerprints and generations of the indexed files around while the files are truncated."""
+        c = self.db.cursor()
+        c.execute("DROP TABLE IF EXISTS temp.saved_files")
+        c.execute(
+            """CREATE TEMP TABLE saved_files AS
+                SELECT name, path, size, mtime, inode, fingerprint, files_generation FROM files"""
+        )
+
+    def restore_indexed_files(self):
+        """Restore saved fingerprints and generations of files that are unchanged."""
+        c = self.db.cursor()
+        c.execute(
+            """CREATE INDEX IF NOT EXISTS temp.saved_files_name_path
+                ON saved_files (name, path)"""
+        )
+        c.execute(
+            """UPDATE files SET (fingerprint, files_generation) = (
+                SELECT COALESCE(files.fingerprint, saved_files.fingerprint), saved_files.files_generation
+                    FROM saved_files
+                    WHERE saved_files.name = files.name
+                        AND saved_files.path = files.path
+                        AND saved_files.size = files.size
+                        AND saved_files.mtime = files.mtime
+                        AND saved_files.inode = files.inode
+            ) WHERE EXISTS (
+                SELECT 1 FROM saved_files
+                    WHERE saved_files.name = files.name
+                        AND saved_files.path = files.path
+                        AND saved_files.size = files.size
+                        AND saved_files.mtime = files.mtime
+                        AND saved_files.inode = files.inode
+            )"""
+        )
+        c.execute("DROP TABLE temp.saved_files")
+        self.commit()
+
+    def get_files_without_fingerprint(self, min_size):
+        c = self.db.cursor()
+        return [
+            (Path(path) / name, size, mtime)
+            for (name, path, size, mtime) in c.execute(
+                """SELECT name, path, size, mtime FROM files
+                    WHERE fingerprint IS NULL AND mtime IS NOT NULL AND size >= ?""",
+                (min_size,),
+            )
+        ]
+
+    def set_file_fingerprints(self, fingerprints):
+        """Set fingerprints from an iterable of (path, fingerprint)."""
+        c = self.db.cursor()
+        c.executemany(
+            "UPDATE files SET fingerprint = ? WHERE name = ? AND path = ?",
+            [
+                (fingerprint, path.name, str(path.parent))
+                for (path, fingerprint) in fingerprints
+            ],
+        )
+        self.commit()
+
     def truncate_files(self):
         c = self.db.cursor()
         try:
@@ -169,15 +411,13 @@ class Database:
             args.append(str(unsplitable_root))
 
         query = (
-            "SELECT name, path, size, normalized_name, unsplitable_root FROM files WHERE "
+            "SELECT name, path, size, normalized_name, unsplitable_root, mtime, inode, fingerprint, hole_size FROM files WHERE "
             + " AND ".join(query)
         )
         logger.debug(f"Doing query: {query!r} with args: {args!r}")
         return [
-            SearchedFile(name, Path(path), size, normalized_name, unsplitable_root)
-            for (name, path, size, normalized_name, unsplitable_root) in c.execute(
-                query, args
-            ).fetchall()
+            SearchedFile(name, Path(path), size, *rest)
+            for (name, path, size, *rest) in c.execute(query, args).fetchall()
         ]
 
     def get_torrent_file_info(self, client, infohash):
@@ -225,33 +465,48 @@ class Database:
 
         for itf in insert_torrent_files:
             insert_args = []
-            for path, size, inode in itf.paths:
+            for path, size, inode, dev in itf.paths:
                 path = decode_str(path, try_fix=self.utf8_compat_mode)
                 if path is None:
                     continue
 
                 insert_args.append(
-                    (infohash_id_mapping[itf.infohash], path, size, inode)
+                    (infohash_id_mapping[itf.infohash], path, size, inode, dev)
                 )
 
             c.executemany(
-                "INSERT OR IGNORE INTO client_torrentfiles (torrent_id, path, size, inode) VALUES (?, ?, ?, ?)",
+                "INSERT OR IGNORE INTO client_torrentfiles (torrent_id, path, size, inode, dev) VALUES (?, ?, ?, ?, ?)",
                 insert_args,
             )
+            c.executemany(
+                "INSERT INTO temp.changed_client_files (path, inode, dev) VALUES (?, ?, ?)",
+                [(path, inode, dev) for (_, path, _, inode, dev) in insert_args],
+            )
         self.commit()
+        self._seeded_inodes = None
 
     def truncate_torrent_files(self, client=None):
         c = self.db.cursor()
         if client:
+            c.execute(
+                """INSERT INTO temp.changed_client_files (path, dev, inode)
+                    SELECT path, dev, inode FROM client_torrentfiles WHERE torrent_id IN (SELECT id FROM client_torrents WHERE client = ?)""",
+                (client,),
+            )
             c.execute(
                 "DELETE FROM client_torrentfiles WHERE torrent_id IN (SELECT id FROM client_torrents WHERE client = ?)",
                 (client,),
             )
             c.execute("DELETE FROM client_torrents WHERE client = ?", (client,))
         else:
+            c.execute(
+                """INSERT INTO temp.changed_client_files (path, dev, inode)
+                    SELECT path, dev, inode FROM client_torrentfiles"""
+            )
             c.execute("DELETE FROM client_torrentfiles")
             c.execute("DELETE FROM client_torrents")
         self.db.commit()
+        self._seeded_inodes = None
 
     def remove_torrent_files(self, client, infohashes):
         c = self.db.cursor()
@@ -260,8 +515,14 @@ class Database:
             (client, *infohashes),
         ):
             c.execute("DELETE FROM client_torrents WHERE id = ?", (id_,))
+            c.execute(
+                """INSERT INTO temp.changed_client_files (path, dev, inode)
+                    SELECT path, dev, inode FROM client_torrentfiles WHERE torrent_id = ?""",
+                (id_,),
+            )
             c.execute("DELETE FROM client_torrentfiles WHERE torrent_id = ?", (id_,))
         self.db.commit()
+        self._seeded_inodes = None
 
     def remove_non_existing_infohashes(self, client, infohashes):
         c = self.db.cursor()
@@ -276,21 +537,60 @@ class Database:
             ],
         )
 
+    def _decode_path(self, path):
+        """Decode path like decode_str, without guessing when it is valid utf-8."""
+        decoded_path = str(path)
+        try:
+            decoded_path.encode()
+        except UnicodeEncodeError:
+            return decode_str(path, try_fix=self.utf8_compat_mode)
+        return decoded_path
+
     def get_seeded_paths(self, paths, inodes):
+        """
+        Find the client files seeded from paths and, for the paths in inodes, the
+        client files seeded from other paths of the same file.
+
+        The paths are looked up in a temporary table joined against the client
+        files so the statements are the same for every batch.
+        """
+        path_inodes = {}
+        for inode, inode_paths in inodes.items():
+            for p, dev in inode_paths:
+                path_inodes[p] = (inode, dev)
+
         c = self.db.cursor()
+        c.execute("DELETE FROM temp.seeded_path_lookup")
+        # inserted in path order so the index of the client files is walked in order
+        c.executemany(
+            "INSERT INTO temp.seeded_path_lookup (id, path, inode, dev) VALUES (?, ?, ?, ?)",
+            sorted(
+                (
+                    (i, self._decode_path(p), *path_inodes.get(p, (None, None)))
+                    for (i, p) in enumerate(paths)
+                ),
+                key=lambda row: row[1] or "",
+            ),
+        )
         c.execute(
-            f"""SELECT client_torrentfiles.torrent_id, name, download_path, infohash, client, path, size FROM client_torrentfiles
-                      LEFT JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id
-                      WHERE path IN ({','.join(['?'] * len(paths))})""",
-            [decode_str(p, try_fix=self.utf8_compat_mode) for p in paths],
+            """SELECT 0, seeded_path_lookup.id, NULL, name, download_path, infohash, client, client_torrentfiles.path, client_torrentfiles.size FROM temp.seeded_path_lookup
+                    JOIN client_torrentfiles ON client_torrentfiles.path = seeded_path_lookup.path
+                    LEFT JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id
+                UNION ALL
+                SELECT 1, seeded_path_lookup.id, client_torrentfiles.dev IS NULL, name, download_path, infohash, client, client_torrentfiles.path, client_torrentfiles.size FROM temp.seeded_path_lookup
+                    JOIN client_torrentfiles ON client_torrentfiles.inode = seeded_path_lookup.inode
+                        AND (client_torrentfiles.dev = seeded_path_lookup.dev OR client_torrentfiles.dev IS NULL)
+                        AND client_torrentfiles.path IS NOT seeded_path_lookup.path
+                    LEFT JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id"""
         )
 
         seeded_files = []
         indirect_seeded_files = []
-        seen_files = set()
-
+        seeded_devs = {}
         for (
-            torrent_id,
+            indirect,
+            i,
+            unknown_dev,
             name,
             download_path,
             infohash,
@@ -298,43 +598,210 @@ class Database:
             path,
             size,
         ) in c.fetchall():
-            seeded_files.append(
-                SeededFile(name, Path(path), download_path, infohash, client, size)
+            p = paths[i]
+            seeded_file = SeededFile(name, p, download_path, infohash, client, size)
+            if not indirect:
+                seeded_files.append(seeded_file)
+                continue
+
+            if unknown_dev:  # scanned before the device was stored
+                if path not in seeded_devs:
+                    full_path = Path(path)
+                    seeded_devs[path] = (
+                        full_path.stat().st_dev if full_path.is_file() else None
+                    )
+                if seeded_devs[path] != path_inodes[p][1]:
+                    continue
+            indirect_seeded_files.append(seeded_file)
+
+        c.execute("DELETE FROM temp.seeded_path_lookup")
+        self.commit()
+        return seeded_files, indirect_seeded_files
+
+    def _path_range(self, path):
+        """Path and the range of the paths below it as arguments for a query."""
+        path = str(path)
+        prefix = os.path.join(path, "")
+        return [path, prefix, prefix[:-1] + chr(ord(os.sep) + 1)]
+
+    def _indexed_path_query(self, path):
+        """Where clause and arguments for the indexed files at or below path."""
+        return (
+            """(files.path = ? OR (files.path >= ? AND files.path < ?)
+                OR (files.path = ? AND files.name = ?))""",
+            self._path_range(path) + list(os.path.split(str(path))),
+        )
+
+    def get_indexed_files(self, path):
+        """Indexed files at or below path as (path, size, dev, inode)."""
+        c = self.db.cursor()
+        where, args = self._indexed_path_query(path)
+        return [
+            (Path(file_path) / name, size, dev, inode)
+            for (name, file_path, size, dev, inode) in c.execute(
+                f"SELECT name, path, size, dev, inode FROM files WHERE {where}", args
             )
-            seen_files.add((torrent_id, client, path))
+        ]
 
-        if inodes:
-            c.execute(
-                f"""SELECT client_torrentfiles.torrent_id, inode, name, download_path, infohash, client, path, size FROM client_torrentfiles
-                        LEFT JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id
-                        WHERE inode IN ({','.join(['?'] * len(inodes))})""",
-                list(inodes.keys()),
+    def get_indexed_children(self, path):
+        """Names of the indexed files and directories directly in path as two sets."""
+        c = self.db.cursor()
+        path, prefix, prefix_end = self._path_range(path)
+        file_names = {
+            name
+            for (name,) in c.execute("SELECT name FROM files WHERE path = ?", (path,))
+        }
+        directory_names = {
+            file_path[len(prefix) :].split(os.sep, 1)[0]
+            for (file_path,) in c.execute(
+                "SELECT DISTINCT path FROM files WHERE path >= ? AND path < ?",
+                (prefix, prefix_end),
             )
-            for (
-                torrent_id,
-                inode,
-                name,
-                download_path,
-                infohash,
-                client,
-                path,
-                size,
-            ) in c.fetchall():
-                if (torrent_id, client, path) in seen_files:
-                    continue
-                seen_files.add((torrent_id, client, path))
-                full_path = Path(path)
-                if not full_path.is_file():
-                    continue
-                stat = full_path.stat()
-                for p, dev in inodes[inode]:
-                    if dev == stat.st_dev:
-                        indirect_seeded_files.append(
-                            SeededFile(name, p, download_path, infohash, client, size)
-                        )
-                        break
+        }
+        return file_names, directory_names
+
+    def get_indexed_seeded_paths(self, path, include_inodes=False):
+        """
+        Seeded and indirectly seeded files of the indexed files at or below path,
+        the same as get_seeded_paths without looking at the files. Indirectly
+        seeded files are only found for clients scanned with the device stored.
+        """
+        c = self.db.cursor()
+        where, args = self._indexed_path_query(path)
+        seeded_files = [
+            SeededFile(name, Path(path), download_path, infohash, client, size)
+            for (name, path, download_path, infohash, client, size) in c.execute(
+                f"""SELECT client_torrents.name, client_torrentfiles.path, download_path, infohash, client, client_torrentfiles.size FROM files
+                        JOIN client_torrentfiles ON client_torrentfiles.path = rtrim(files.path, '/') || '/' || files.name
+                        JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id
+                        WHERE {where}""",
+                args,
+            )
+        ]
+
+        indirect_seeded_files = []
+        if include_inodes:
+            indirect_seeded_files = [
+                SeededFile(
+                    name,
+                    Path(file_path) / file_name,
+                    download_path,
+                    infohash,
+                    client,
+                    size,
+                )
+                for (
+                    name,
+                    file_path,
+                    file_name,
+                    download_path,
+                    infohash,
+                    client,
+                    size,
+                ) in c.execute(
+                    f"""SELECT client_torrents.name, files.path, files.name, download_path, infohash, client, client_torrentfiles.size FROM files
+                        JOIN client_torrentfiles ON client_torrentfiles.inode = files.inode
+                            AND client_torrentfiles.dev = files.dev
+                            AND client_torrentfiles.path != rtrim(files.path, '/') || '/' || files.name
+                        JOIN client_torrents ON client_torrents.id = client_torrentfiles.torrent_id
+                        WHERE {where}""",
+                    args,
+                )
+            ]
         return seeded_files, indirect_seeded_files
 
+    def _update_directory_sizes(self, changed_only):
+        """Sum up the file sizes of the changed directories, or of all directories."""
+        c = self.db.cursor()
+        if changed_only:
+            c.execute(
+                """DELETE FROM directory_sizes WHERE path IN (SELECT path FROM temp.changed_directories)"""
+            )
+            where = "files.path IN (SELECT path FROM temp.changed_directories)"
+        else:
+            c.execute("DELETE FROM directory_sizes")
+            where = "1"
+        c.execute(
+            f"""INSERT INTO directory_sizes (path, total_size, seeded_size, indirect_seeded_size)
+                SELECT path, SUM(size), SUM(seeded * size), SUM((NOT seeded AND indirect_seeded) * size) FROM (
+                    SELECT files.path, files.size,
+                        EXISTS (SELECT 1 FROM client_torrentfiles WHERE client_torrentfiles.path = rtrim(files.path, '/') || '/' || files.name) AS seeded,
+                        EXISTS (SELECT 1 FROM client_torrentfiles WHERE client_torrentfiles.inode = files.inode AND client_torrentfiles.dev = files.dev) AS indirect_seeded
+                    FROM files WHERE {where}
+                ) GROUP BY path"""
+        )
+        c.execute("DROP TABLE IF EXISTS temp.changed_directories")
+        self.commit()
+
+    def update_directory_sizes(self, paths=None):
+        """Update the sizes of the directories at or below paths, all if paths is None."""
+        if paths is None:
+            self._update_directory_sizes(False)
+            return
+
+        c = self.db.cursor()
+        c.execute("DROP TABLE IF EXISTS temp.changed_directories")
+        c.execute("CREATE TEMP TABLE changed_directories (path varchar NOT NULL)")
+        for path in paths:
+            where, args = self._indexed_path_query(path)
+            c.execute(
+                f"""INSERT INTO temp.changed_directories (path)
+                    SELECT DISTINCT path FROM files WHERE {where}""",
+                args,
+            )
+        self._update_directory_sizes(True)
+
+    def update_client_files_directory_sizes(self):
+        """Update the sizes of the directories with client files changed since the last update."""
+        c = self.db.cursor()
+        changed_directories = {
+            os.path.dirname(path)
+            for (path,) in c.execute("SELECT path FROM temp.changed_client_files")
+        }
+        c.execute("DROP TABLE IF EXISTS temp.changed_directories")
+        c.execute("CREATE TEMP TABLE changed_directories (path varchar NOT NULL)")
+        c.executemany(
+            "INSERT INTO temp.changed_directories (path) VALUES (?)",
+            [(path,) for path in changed_directories],
+        )
+        c.execute(
+            """INSERT INTO temp.changed_directories (path)
+                SELECT DISTINCT files.path FROM temp.changed_client_files
+                    JOIN files ON files.inode = changed_client_files.inode AND files.dev = changed_client_files.dev
+                    WHERE changed_client_files.inode >= 0"""
+        )
+        c.execute("DELETE FROM temp.changed_client_files")
+        self._update_directory_sizes(True)
+
+    def get_directory_sizes(self, path):
+        """
+        Total, seeded and only indirectly seeded size of the files at or below the
+        directory path, None if there are no scanned files there.
+        """
+        c = self.db.cursor()
+        count, *sizes = c.execute(
+            """SELECT COUNT(*), SUM(total_size), SUM(seeded_size), SUM(indirect_seeded_size) FROM directory_sizes
+                WHERE path = ? OR (path >= ? AND path < ?)""",
+            self._path_range(path),
+        ).fetchone()
+        if not count:
+            return None
+        return sizes
+
+    def get_seeded_inodes(self):
+        """
+        Set of (dev, inode) of the seeded files, kept until the client files change.
+        The dev is None for files scanned before the device was stored.
+        """
+        if self._seeded_inodes is None:
+            c = self.db.cursor()
+            self._seeded_inodes = set(
+                c.execute(
+                    "SELECT DISTINCT dev, inode FROM client_torrentfiles WHERE inode >= 0"
+                )
+            )
+        return self._seeded_inodes
+
     def get_seeded_infohashes(self, client):
         c = self.db.cursor()
         c.execute(
@@ -350,3 +817,320 @@ class Database:
         return [
             (infohash, name, size, count) for (infohash, size, count) in c.fetchall()
         ]
+
+    def get_match_cache(self, fingerprint, options):
+        c = self.db.cursor()
+        row = c.execute(
+            "SELECT result FROM match_cache WHERE fingerprint = ? AND options = ?",
+            (fingerprint, options),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def insert_match_cache(self, fingerprint, options, result):
+        c = self.db.cursor()
+        c.execute(
+            "INSERT OR REPLACE INTO match_cache (fingerprint, options, result) VALUES (?, ?, ?)",
+            (fingerprint, options, json.dumps(result)),
+        )
+        self.commit()
+
+    def get_piece_hashes(self, path, size, mtime):
+        """Cached piece digests of a file as a mapping of (offset, length) to digest."""
+        c = self.db.cursor()
+        return {
+            (offset, length): digest
+            for (offset, length, digest) in c.execute(
+                """SELECT offset, length, digest FROM piece_hash_cache
+                    WHERE name = ? AND path = ? AND size = ? AND mtime = ?""",
+                (path.name, str(path.parent), size, mtime),
+            )
+        }
+
+    def insert_piece_hashes(self, path, size, mtime, digests):
+        c = self.db.cursor()
+        c.executemany(
+            """INSERT OR REPLACE INTO piece_hash_cache (name, path, size, mtime, offset, length, digest)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (path.name, str(path.parent), size, mtime, offset, length, digest)
+                for ((offset, length), digest) in digests.items()
+            ],
+        )
+        self.commit()
+
+    def prune_piece_hashes(self):
+        """Remove cached piece digests of files no longer indexed with the same size."""
+        c = self.db.cursor()
+        c.execute(
+            """DELETE FROM piece_hash_cache WHERE NOT EXISTS (
+                SELECT 1 FROM files WHERE files.name = piece_hash_cache.name
+                    AND files.path = piece_hash_cache.path
+                    AND files.size = piece_hash_cache.size
+            )"""
+        )
+        self.commit()
+        return c.rowcount
+
+    def get_first_piece_hash_files(self, min_size):
+        """Indexed files of at least min_size with the mtime their first piece hashes are from, if any."""
+        c = self.db.cursor()
+        return [
+            (Path(path) / name, size, mtime)
+            for (name, path, size, mtime) in c.execute(
+                """SELECT files.name, files.path, files.size, MIN(first_piece_hashes.mtime) FROM files
+                    LEFT JOIN first_piece_hashes ON files.name = first_piece_hashes.name
+                        AND files.path = first_piece_hashes.path
+                        AND files.size = first_piece_hashes.size
+                    WHERE files.size >= ?
+                    GROUP BY files.name, files.path""",
+                (min_size,),
+            )
+        ]
+
+    def insert_first_piece_hashes(self, path, size, mtime, digests):
+        c = self.db.cursor()
+        c.execute(
+            "DELETE FROM first_piece_hashes WHERE name = ? AND path = ?",
+            (path.name, str(path.parent)),
+        )
+        c.executemany(
+            """INSERT INTO first_piece_hashes (name, path, size, mtime, piece_length, digest)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (path.name, str(path.parent), size, mtime, piece_length, digest)
+                for (piece_length, digest) in digests.items()
+            ],
+        )
+
+    def find_first_piece_hash_files(self, piece_length, digest, size):
+        """Indexed files of size with a first piece digest, as (path, mtime) tuples."""
+        c = self.db.cursor()
+        return [
+            (Path(path) / name, mtime)
+            for (name, path, mtime) in c.execute(
+                """SELECT name, path, mtime FROM first_piece_hashes
+                    WHERE digest = ? AND piece_length = ? AND size = ?""",
+                (digest, piece_length, size),
+            )
+        ]
+
+    def get_first_piece_hashes(self, searched_files, piece_length):
+        """First piece hashes of searched files as a mapping of path to (mtime, digest)."""
+        c = self.db.cursor()
+        first_piece_hashes = {}
+        for searched_file in searched_files:
+            row = c.execute(
+                """SELECT mtime, digest FROM first_piece_hashes
+                    WHERE name = ? AND path = ? AND size = ? AND piece_length = ?""",
+                (
+                    searched_file.name,
+                    str(searched_file.path),
+                    searched_file.size,
+                    piece_length,
+                ),
+            ).fetchone()
+            if row is not None:
+                first_piece_hashes[searched_file.path / searched_file.name] = row
+        return first_piece_hashes
+
+    def prune_first_piece_hashes(self):
+        """Remove first piece hashes of files no longer indexed with the same size."""
+        c = self.db.cursor()
+        c.execute(
+            """DELETE FROM first_piece_hashes WHERE NOT EXISTS (
+                SELECT 1 FROM files WHERE files.name = first_piece_hashes.name
+                    AND files.path = first_piece_hashes.path
+                    AND files.size = first_piece_hashes.size
+            )"""
+        )
+        self.commit()
+        return c.rowcount
+
+    def get_verify_progress(self, infohash, mapping):
+        """Saved piece states of an interrupted verification of the same file mapping, if any."""
+        c = self.db.cursor()
+        row = c.execute(
+            "SELECT pieces FROM verify_progress WHERE infohash = ? AND mapping = ?",
+            (infohash, mapping),
+        ).fetchone()
+        return row and row[0] or None
+
+    def save_verify_progress(self, infohash, mapping, pieces):
+        c = self.db.cursor()
+        c.execute(
+            """INSERT OR REPLACE INTO verify_progress (infohash, mapping, pieces, updated)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+            (infohash, mapping, pieces),
+        )
+        self.commit()
+
+    def remove_verify_progress(self, infohash):
+        c = self.db.cursor()
+        c.execute("DELETE FROM verify_progress WHERE infohash = ?", (infohash,))
+        self.commit()
+
+    def get_scrub_progress(self):
+        c = self.db.cursor()
+        return {
+            infohash: ScrubProgress(*row)
+            for (infohash, *row) in c.execute(
+                "SELECT infohash, next_piece, failed_pieces, missing_pieces, scrubbed FROM scrub_progress"
+            )
+        }
+
+    def save_scrub_progress(
+        self, infohash, next_piece, failed_pieces, missing_pieces, scrubbed
+    ):
+        c = self.db.cursor()
+        c.execute(
+            """INSERT OR REPLACE INTO scrub_progress (infohash, next_piece, failed_pieces, missing_pieces, scrubbed)
+                VALUES (?, ?, ?, ?, ?)""",
+            (infohash, next_piece, failed_pieces, missing_pieces, scrubbed),
+        )
+        self.commit()
+
+    def insert_unmatched_torrent(
+        self, client, torrent_path, infohash, missing_size, sizes
+    ):
+        """
+        Add a torrent to the unmatched backlog together with the file sizes
+        it needs and the current files generation.
+        """
+        self.remove_unmatched_torrent(client, torrent_path)
+        c = self.db.cursor()
+        c.execute(
+            "INSERT INTO unmatched_torrents (client, torrent_path, infohash, missing_size, files_generation) VALUES (?, ?, ?, ?, ?)",
+            (
+                client,
+                str(torrent_path),
+                infohash,
+                missing_size,
+                self.get_files_generation(),
+            ),
+        )
+        torrent_id = c.lastrowid
+        c.executemany(
+            "INSERT OR IGNORE INTO unmatched_torrent_sizes (torrent_id, size) VALUES (?, ?)",
+            [(torrent_id, size) for size in set(sizes)],
+        )
+        self.commit()
+
+    def remove_unmatched_torrent(self, client, torrent_path):
+        c = self.db.cursor()
+        c.execute(
+            "DELETE FROM unmatched_torrent_sizes WHERE torrent_id IN (SELECT id FROM unmatched_torrents WHERE client = ? AND torrent_path = ?)",
+            (client, str(torrent_path)),
+        )
+        c.execute(
+            "DELETE FROM unmatched_torrents WHERE client = ? AND torrent_path = ?",
+            (client, str(torrent_path)),
+        )
+        self.commit()
+
+    def mark_unmatched_torrents_pending(self):
+        """
+        Mark unmatched torrents where a file with a size they need was indexed
+        after they were added to the backlog.
+        """
+        c = self.db.cursor()
+        c.execute(
+            """UPDATE unmatched_torrents SET pending = 1 WHERE pending = 0 AND EXISTS (
+                    SELECT 1 FROM unmatched_torrent_sizes
+                    JOIN files ON files.size = unmatched_torrent_sizes.size
+                    WHERE unmatched_torrent_sizes.torrent_id = unmatched_torrents.id
+                        AND files.files_generation > unmatched_torrents.files_generation
+                )"""
+        )
+        self.commit()
+        return c.rowcount
+
+    def get_unmatched_torrents(self, client, pending_only=True):
+        c = self.db.cursor()
+        query = "SELECT torrent_path FROM unmatched_torrents WHERE client = ?"
+        if pending_only:
+            query += " AND pending = 1"
+        return [Path(torrent_path) for (torrent_path,) in c.execute(query, (client,))]
+
+    def get_files_generation(self):
+        """The files generation is bumped every time the files are scanned."""
+        c = self.db.cursor()
+        row = c.execute(
+            "SELECT value FROM meta WHERE key = 'files_generation'"
+        ).fetchone()
+        if row is None:
+            return 0
+        return int(row[0])
+
+    def bump_files_generation(self):
+        c = self.db.cursor()
+        c.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('files_generation', ?)",
+            (str(self.get_files_generation() + 1),),
+        )
+        self.commit()
+
+    def set_scanned(self, key):
+        """Remember when the files or client files were last scanned."""
+        c = self.db.cursor()
+        c.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (f"{key}_scanned", datetime.now().isoformat(sep=" ", timespec="seconds")),
+        )
+        self.commit()
+
+    def get_scanned(self, key):
+        """When the files or client files were last scanned, None if never."""
+        c = self.db.cursor()
+        row = c.execute(
+            "SELECT value FROM meta WHERE key = ?", (f"{key}_scanned",)
+        ).fetchone()
+        return row and datetime.fromisoformat(row[0]) or None
+
+    def get_torrent_catalog_entry(self, client, torrent_path):
+        c = self.db.cursor()
+        row = c.execute(
+            """SELECT size, mtime, infohash, filelist, outcome, missing_size, files_generation, options
+                FROM torrent_catalog WHERE client = ? AND torrent_path = ?""",
+            (client, str(torrent_path)),
+        ).fetchone()
+        if row is None:
+            return None
+        size, mtime, infohash, filelist, *rest = row
+        return TorrentCatalogEntry(
+            size, mtime, infohash, filelist and json.loads(filelist), *rest
+        )
+
+    def insert_torrent_catalog_entry(
+        self,
+        client,
+        torrent_path,
+        size,
+        mtime,
+        infohash,
+        filelist,
+        outcome,
+        missing_size,
+        files_generation,
+        options,
+    ):
+        c = self.db.cursor()
+        c.execute(
+            """INSERT OR REPLACE INTO torrent_catalog
+                (client, torrent_path, size, mtime, infohash, filelist, outcome, missing_size, files_generation, options)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                client,
+                str(torrent_path),
+                size,
+                mtime,
+                infohash,
+                filelist is not None and json.dumps(filelist) or None,
+                outcome,
+                missing_size,
+                files_generation,
+                options,
+            ),
+        )
+        self.commit()
@@ -0,0 +1,458 @@
+"""
+Piece verification engine.
+
+Pieces are described as a list of (path, offset, length) segments so pieces
+spanning file boundaries are hashed like any other piece. Independent pieces
+are hashed in batches by a pool of threads, both file reads and hashlib
+release the GIL so this scales with cores and disks.
+
+Batches are scheduled per device, every device is read in parallel with a
+bounded number of batches in flight and reads are ordered by file and offset
+so each disk sees reads that are as sequential as possible.
+"""
+
+import hashlib
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+HASHER_READ_BLOCK_SIZE = 2**18
+FIRST_PIECE_LENGTHS = [2**i for i in range(18, 25)]
+FINGERPRINT_BLOCK_SIZE = 2**12
+FINGERPRINT_BLOCK_COUNT = 5
+HASHER_BATCH_SIZE = 2**26
+DEFAULT_HASH_WORKERS = min(8, max(2, os.cpu_count() or 1))
+DEFAULT_DEVICE_WORKERS = 2
+
+
+def advise_sequential(fp):
+    """Hint the kernel that a file is read sequentially"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+
+def advise_willneed(fp, offset, length):
+    """Hint the kernel that a range of a file will be read soon"""
+    if not hasattr(os, "posix_fadvise") or length <= 0:
+        return
+    try:
+        os.posix_fadvise(fp.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def find_holes(path, size):
+    """
+    Find the holes in a file with SEEK_HOLE and SEEK_DATA as a list of (start, end).
+    Preallocated but unwritten ranges are holes on most filesystems too.
+    Returns an empty list if the file or the filesystem does not support it.
+    """
+    if not hasattr(os, "SEEK_HOLE"):
+        return []
+    holes = []
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return []
+    try:
+        offset = 0
+        while offset < size:
+            hole = os.lseek(fd, offset, os.SEEK_HOLE)
+            if hole >= size:
+                break
+            try:
+                offset = min(os.lseek(fd, hole, os.SEEK_DATA), size)
+            except OSError:  # no data after the hole
+                offset = size
+            holes.append((hole, offset))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+    return holes
+
+
+@lru_cache(maxsize=None)
+def zero_piece_digest(piece_length):
+    """Digest of a piece of only zeros, which is what a hole reads as"""
+    return hashlib.sha1(bytes(piece_length)).digest()
+
+
+class PieceHasher:
+    """Hashes pieces from files with a single reusable read buffer."""
+
+    def __init__(self, read_ranges=None, io_budget=None):
+        self.buffer = memoryview(bytearray(HASHER_READ_BLOCK_SIZE))
+        self.read_ranges = read_ranges or {}
+        self.io_budget = io_budget
+        self.path = None
+        self.fp = None
+
+    def open(self, path):
+        if self.path != path:
+            self.close()
+            self.fp = path.open("rb", buffering=0)
+            self.path = path
+            advise_sequential(self.fp)
+            if path in self.read_ranges:
+                start, end = self.read_ranges[path]
+                advise_willneed(self.fp, start, end - start)
+        return self.fp
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+        self.path, self.fp = None, None
+
+    def hash_piece(self, segments):
+        """Returns the digest of the segments, None if they could not be read completely"""
+        hasher = hashlib.new("sha1", usedforsecurity=False)
+        for path, offset, length in segments:
+            fp = self.open(path)
+            fp.seek(offset)
+            while length > 0:
+                read = fp.readinto(self.buffer[: min(HASHER_READ_BLOCK_SIZE, length)])
+                if not read:
+                    logger.warning(
+                        f"We expected to be able to read more data from {path} with missing size {length}"
+                    )
+                    return None
+                if self.io_budget:
+                    self.io_budget.consume(read)
+                hasher.update(self.buffer[:read])
+                length -= read
+        return hasher.digest()
+
+
+def hash_first_pieces(path, size, io_budget=None):
+    """
+    Hash the first piece of a file at every piece length in FIRST_PIECE_LENGTHS
+    that fits in the file, the file is read once.
+
+    Returns a mapping of piece length to digest.
+    """
+    hasher = hashlib.new("sha1", usedforsecurity=False)
+    buffer = memoryview(bytearray(HASHER_READ_BLOCK_SIZE))
+    digests = {}
+    read_size = 0
+    with path.open("rb", buffering=0) as fp:
+        advise_sequential(fp)
+        for piece_length in FIRST_PIECE_LENGTHS:
+            if piece_length > size:
+                break
+            while read_size < piece_length:
+                read = fp.readinto(
+                    buffer[: min(HASHER_READ_BLOCK_SIZE, piece_length - read_size)]
+                )
+                if not read:
+                    return digests
+                if io_budget:
+                    io_budget.consume(read)
+                hasher.update(buffer[:read])
+                read_size += read
+            digests[piece_length] = hasher.copy().digest()
+    return digests
+
+
+def fingerprint_file(path, size, io_budget=None):
+    """
+    Hash a few small blocks spread evenly through a file.
+
+    Files of the same size with the same fingerprint most likely have the same content.
+    """
+    hasher = hashlib.new("sha1", usedforsecurity=False)
+    block_size = min(FINGERPRINT_BLOCK_SIZE, size)
+    offsets = sorted(
+        {
+            (size - block_size) * i // (FINGERPRINT_BLOCK_COUNT - 1)
+            for i in range(FINGERPRINT_BLOCK_COUNT)
+        }
+    )
+    with path.open("rb", buffering=0) as fp:
+        for offset in offsets:
+            fp.seek(offset)
+            data = fp.read(block_size)
+            if io_budget:
+                io_budget.consume(len(data))
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class PieceHashCache:
+    """
+    Digests of pieces that are within a single file, stored in the database.
+
+    A cached digest is only used while the size and mtime of the file are unchanged.
+    Must only be used from the thread that owns the database.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def file_digests(self, path):
+        """
+        All cached digests of a file as a mapping of (offset, length) to digest.
+
+        Returns the digests and the file identity to store new digests with,
+        the identity is None if the file cannot be found.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {}, None
+        identity = (stat.st_size, stat.st_mtime_ns)
+        return self.db.get_piece_hashes(path, *identity), identity
+
+    def store_file_digests(self, path, identity, digests):
+        if identity is not None and digests:
+            self.db.insert_piece_hashes(path, *identity, digests)
+
+    def lookup(self, piece_segments):
+        """
+        Find cached digests for the single file pieces in piece_segments.
+
+        Returns the cached digests mapped by piece key and the file identities
+        to store newly calculated digests with.
+        """
+        file_pieces = {}
+        for key, segments in piece_segments.items():
+            if len(segments) == 1:
+                path, offset, length = segments[0]
+                file_pieces.setdefault(path, []).append((key, offset, length))
+
+        cached_digests, identities = {}, {}
+        for path, pieces in file_pieces.items():
+            file_digests, identity = self.file_digests(path)
+            if identity is None:
+                continue
+            identities[path] = identity
+            for key, offset, length in pieces:
+                if (offset, length) in file_digests:
+                    cached_digests[key] = file_digests[(offset, length)]
+
+        logger.debug(
+            f"Found {len(cached_digests)} of {len(piece_segments)} piece hashes in cache"
+        )
+        return cached_digests, identities
+
+    def store(self, piece_segments, digests, identities):
+        file_digests = {}
+        for key, digest in digests.items():
+            segments = piece_segments[key]
+            if digest is None or len(segments) != 1:
+                continue
+            path, offset, length = segments[0]
+            if path in identities:
+                file_digests.setdefault(path, {})[(offset, length)] = digest
+
+        for path, path_digests in file_digests.items():
+            self.store_file_digests(path, identities[path], path_digests)
+
+
+PROBE_CONFIDENCE_PIECES = {"low": 1, "normal": 2, "high": 4}
+
+
+class ProbePolicy:
+    """
+    Picks the pieces of a file to hash probe and keeps count of what probing costs.
+
+    Cached pieces are free and used first, the rest are spread out through the file
+    starting with the first and last piece. The number of pieces is doubled when
+    the candidates are ambiguous.
+    """
+
+    def __init__(self, confidence="normal"):
+        if confidence not in PROBE_CONFIDENCE_PIECES:
+            raise ValueError(
+                f"Unknown hash probe confidence {confidence!r}, must be one of {', '.join(PROBE_CONFIDENCE_PIECES)}"
+            )
+        self.confidence = confidence
+        self.piece_count = PROBE_CONFIDENCE_PIECES[confidence]
+        self.probed_pieces = 0
+        self.cached_pieces = 0
+        self.bytes_read = 0
+
+    def select_pieces(self, piece_count, cached_pieces=(), ambiguous=False):
+        """Select which of piece_count complete pieces to probe."""
+        wanted = min(piece_count, self.piece_count * (2 if ambiguous else 1))
+        selected = sorted(cached_pieces)[:wanted]
+        for piece in _spread_pieces(piece_count):
+            if len(selected) >= wanted:
+                break
+            if piece not in selected:
+                selected.append(piece)
+        return selected
+
+    def record(self, piece_length, cached):
+        if cached:
+            self.cached_pieces += 1
+        else:
+            self.probed_pieces += 1
+            self.bytes_read += piece_length
+
+
+def _spread_pieces(piece_count):
+    """Yields piece indexes starting with the first and last, then halving the gaps in between."""
+    if not piece_count:
+        return
+    yield 0
+    if piece_count == 1:
+        return
+    yield piece_count - 1
+    intervals = deque([(0, piece_count - 1)])
+    while intervals:
+        low, high = intervals.popleft()
+        if high - low < 2:
+            continue
+        middle = (low + high) // 2
+        yield middle
+        intervals.append((low, middle))
+        intervals.append((middle, high))
+
+
+def _read_ranges(segments):
+    read_ranges = {}
+    for path, offset, length in segments:
+        if path in read_ranges:
+            start, end = read_ranges[path]
+            read_ranges[path] = (min(start, offset), max(end, offset + length))
+        else:
+            read_ranges[path] = (offset, offset + length)
+    return read_ranges
+
+
+def _split_batches(keys, piece_segments):
+    batches, batch, batch_size = [], [], 0
+    for key in keys:
+        batch.append(key)
+        batch_size += sum(length for (_, _, length) in piece_segments[key])
+        if batch_size >= HASHER_BATCH_SIZE:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def schedule_batches(piece_segments):
+    """
+    Group pieces into batches per device.
+
+    The pieces are ordered by the file and offset they start at.
+    Returns a mapping of device to a list of batches of piece keys.
+    """
+    devices = {}
+    path_devices = {}
+    keys = sorted(
+        piece_segments,
+        key=lambda key: (str(piece_segments[key][0][0]), piece_segments[key][0][1]),
+    )
+    for key in keys:
+        path = piece_segments[key][0][0]
+        if path not in path_devices:
+            path_devices[path] = os.stat(path).st_dev
+        devices.setdefault(path_devices[path], []).append(key)
+
+    return {
+        device: _split_batches(device_keys, piece_segments)
+        for device, device_keys in devices.items()
+    }
+
+
+def hash_pieces(
+    piece_segments,
+    piece_hashes,
+    workers=None,
+    device_workers=None,
+    io_budget=None,
+    piece_cache=None,
+):
+    """
+    Verify pieces against the expected piece hashes.
+
+    piece_segments maps a piece key to a list of (path, offset, length) and
+    piece_hashes maps the same key to the expected hash, the keys can be
+    piece indexes or e.g. (torrent, piece index) to verify several torrents together.
+    Returns a mapping of piece key to True if the piece matches, False if not
+    and None if the piece could not be read completely.
+
+    With a piece_cache, cached digests are used instead of reading the pieces
+    and the calculated digests are stored.
+    """
+    if workers is None:
+        workers = DEFAULT_HASH_WORKERS
+    if io_budget:
+        workers = io_budget.limit_workers(workers)
+    if device_workers is None:
+        device_workers = DEFAULT_DEVICE_WORKERS
+
+    def hash_batch(batch):
+        hasher = PieceHasher(
+            _read_ranges(
+                segment for key in batch for segment in piece_segments[key]
+            ),
+            io_budget=io_budget,
+        )
+        try:
+            return {key: hasher.hash_piece(piece_segments[key]) for key in batch}
+        finally:
+            hasher.close()
+
+    def drain(queue):
+        result = {}
+        while True:
+            try:
+                batch = queue.popleft()
+            except IndexError:
+                return result
+            result.update(hash_batch(batch))
+
+    cached_digests, identities = {}, {}
+    if piece_cache:
+        cached_digests, identities = piece_cache.lookup(piece_segments)
+
+    device_batches = schedule_batches(
+        {
+            key: segments
+            for (key, segments) in piece_segments.items()
+            if key not in cached_digests
+        }
+    )
+    batch_count = sum(len(batches) for batches in device_batches.values())
+    logger.debug(
+        f"Hashing {len(piece_segments) - len(cached_digests)} pieces in {batch_count} batches on {len(device_batches)} devices with {workers} workers"
+    )
+
+    digests = {}
+    if workers <= 1 or batch_count <= 1:
+        for batches in device_batches.values():
+            digests.update(drain(deque(batches)))
+    else:
+        queues = [deque(batches) for batches in device_batches.values()]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # round-robin over devices so every device gets a worker before any gets two
+            futures = [
+                executor.submit(drain, queue)
+                for i in range(device_workers)
+                for queue in queues
+                if len(queue) > i
+            ]
+            for future in futures:
+                digests.update(future.result())
+
+    if piece_cache:
+        piece_cache.store(piece_segments, digests, identities)
+    digests.update(cached_digests)
+
+    return {
+        key: digest if digest is None else digest == piece_hashes[key]
+        for (key, digest) in digests.items()
+    }
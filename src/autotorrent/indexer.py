@@ -7,6 +7,13 @@ from pathlib import Path
 from queue import Empty, SimpleQueue
 
 from .db import InsertTorrentFile
+from .hashing import (
+    DEFAULT_HASH_WORKERS,
+    FIRST_PIECE_LENGTHS,
+    find_holes,
+    fingerprint_file,
+    hash_first_pieces,
+)
 from .utils import get_root_of_unsplitable, is_unsplitable
 
 logger = logging.getLogger(__name__)
@@ -17,20 +24,35 @@ SCAN_PATH_QUEUE_TIMEOUT_SECONDS = 10
 
 
 class PathTrieNode:
-    __slots__ = ("children", "is_file", "is_unsplitable", "size")
+    __slots__ = (
+        "children",
+        "is_file",
+        "is_unsplitable",
+        "size",
+        "mtime",
+        "inode",
+        "hole_size",
+        "dev",
+    )
 
     def __init__(self):
         self.children = {}
         self.is_file = False  # In a typical string-based trie, this would mark the end of the string
         self.is_unsplitable = False
         self.size = None
+        self.mtime = None
+        self.inode = None
+        self.hole_size = None
+        self.dev = None
 
 
 class PathTrie:
     def __init__(self):
         self.root = PathTrieNode()
 
-    def insert_path(self, path, size):
+    def insert_path(
+        self, path, size, mtime=None, inode=None, hole_size=None, dev=None
+    ):
         current = self.root
         for segment in path.parts:
             ch = segment
@@ -41,6 +63,10 @@ class PathTrie:
             current = node
         current.is_file = True
         current.size = size
+        current.mtime = mtime
+        current.inode = inode
+        current.hole_size = hole_size
+        current.dev = dev
 
     def mark_unsplitable(self, path):
         current = self.root
@@ -88,11 +114,17 @@ class Indexer:
         ignore_file_patterns=None,
         ignore_directory_patterns=None,
         include_inodes=False,
+        first_piece_hash_min_size=0,
+        fingerprint_min_size=0,
+        io_budget=None,
     ):
         self.db = db
         self.ignore_file_patterns = ignore_file_patterns or []
         self.ignore_directory_patterns = ignore_directory_patterns or []
         self.include_inodes = include_inodes
+        self.first_piece_hash_min_size = first_piece_hash_min_size
+        self.fingerprint_min_size = fingerprint_min_size
+        self.io_budget = io_budget
 
     def scan_paths(self, paths, full_scan=True):
         paths = [Path(p) for p in paths]
@@ -133,13 +165,101 @@ class Indexer:
 
         # Helper function to modify walk results for DB usage
         def db_insert(child, full_path, unsplitable_root):
-            return (str(full_path), child.size, str(unsplitable_root))
+            return (
+                str(full_path),
+                child.size,
+                str(unsplitable_root),
+                child.mtime,
+                child.inode,
+                child.hole_size,
+                child.dev,
+            )
 
         self.db.commit()
         if full_scan:
+            self.db.save_indexed_files()
             self.db.truncate_files()
-        self.db.insert_file_paths(path_tree.walk(db_insert))
+        self.db.insert_file_paths(
+            path_tree.walk(db_insert),
+            files_generation=self.db.get_files_generation() + 1,
+        )
+        self.db.commit()
+        if full_scan:
+            self.db.restore_indexed_files()
+        self.db.bump_files_generation()
+        self.db.update_directory_sizes(not full_scan and paths or None)
+        self.db.set_scanned("files")
+
+        pruned_count = self.db.prune_piece_hashes()
+        if pruned_count:
+            logger.debug(f"Removed {pruned_count} cached piece hashes of changed files")
+
+        self.db.prune_first_piece_hashes()
+        if self.first_piece_hash_min_size:
+            self.index_first_piece_hashes()
+        if self.fingerprint_min_size:
+            self.index_fingerprints()
+
+        pending_count = self.db.mark_unmatched_torrents_pending()
+        if pending_count:
+            logger.info(f"{pending_count} unmatched torrents can now be re-evaluated")
+
+    def index_first_piece_hashes(self):
+        """Hash the first piece of new and changed files of at least first_piece_hash_min_size"""
+        min_size = max(self.first_piece_hash_min_size, FIRST_PIECE_LENGTHS[0])
+
+        def hash_file(args):
+            path, size, mtime = args
+            try:
+                stat = path.stat()
+                if stat.st_size != size or stat.st_mtime_ns == mtime:
+                    return None
+                return (
+                    path,
+                    size,
+                    stat.st_mtime_ns,
+                    hash_first_pieces(path, size, io_budget=self.io_budget),
+                )
+            except OSError as e:
+                logger.warning(f"Failed to hash first piece of {path}: {e}")
+                return None
+
+        hashed_count = 0
+        with ThreadPoolExecutor(max_workers=DEFAULT_HASH_WORKERS) as executor:
+            for result in executor.map(
+                hash_file, self.db.get_first_piece_hash_files(min_size)
+            ):
+                if result is not None:
+                    self.db.insert_first_piece_hashes(*result)
+                    hashed_count += 1
         self.db.commit()
+        logger.info(f"Indexed first piece hashes of {hashed_count} files")
+
+    def index_fingerprints(self):
+        """Fingerprint files of at least fingerprint_min_size that do not have a fingerprint"""
+
+        def fingerprint(args):
+            path, size, mtime = args
+            try:
+                stat = path.stat()
+                if stat.st_size != size or stat.st_mtime_ns != mtime:
+                    return None
+                return path, fingerprint_file(path, size, io_budget=self.io_budget)
+            except OSError as e:
+                logger.warning(f"Failed to fingerprint {path}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=DEFAULT_HASH_WORKERS) as executor:
+            fingerprints = [
+                result
+                for result in executor.map(
+                    fingerprint,
+                    self.db.get_files_without_fingerprint(self.fingerprint_min_size),
+                )
+                if result is not None
+            ]
+        self.db.set_file_fingerprints(fingerprints)
+        logger.info(f"Fingerprinted {len(fingerprints)} files")
 
     def _match_ignore_pattern(self, ignore_patterns, p, ignore_case=False):
         name = p.name
@@ -169,8 +289,20 @@ class Indexer:
                 ):
                     return
                 files.append(Path(p))
-                size = p.stat().st_size
-                queue.put((IndexAction.ADD, (Path(p), size)))
+                stat = p.stat()
+                queue.put(
+                    (
+                        IndexAction.ADD,
+                        (
+                            Path(p),
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                            stat.st_ino,
+                            self._get_hole_size(p, stat),
+                            stat.st_dev,
+                        ),
+                    )
+                )
 
         try:
             if path.is_file():
@@ -189,12 +321,24 @@ class Indexer:
         if root_thread:
             queue.put((IndexAction.FINISHED, (str(path))))
 
+    def _get_hole_size(self, path, stat):
+        """
+        Size of the holes in a file, only files with fewer blocks allocated than their size
+        are checked for holes. Preallocated files are found when matching.
+        """
+        st_blocks = getattr(stat, "st_blocks", None)
+        if st_blocks is None or st_blocks * 512 >= stat.st_size:
+            return 0
+        return sum(end - start for (start, end) in find_holes(path, stat.st_size))
+
     def scan_clients(self, clients, full_scan=False, fast_scan=False):
         for name, client in clients.items():
             if full_scan:
                 self.db.truncate_torrent_files(name)
             self._scan_client(name, client, not full_scan and fast_scan)
         self.db.commit()
+        self.db.update_client_files_directory_sizes()
+        self.db.set_scanned("client_files")
 
     def _scan_client(self, client_name, client, fast_scan):
         torrents = client.list()
@@ -202,9 +346,10 @@ class Indexer:
 
         def get_file_inode(path):
             if self.include_inodes:
-                return path.stat().st_ino
+                stat = path.stat()
+                return stat.st_dev, stat.st_ino
             else:
-                return -1
+                return None, -1
 
         for torrent in torrents:
             _, current_download_path = self.db.get_torrent_file_info(
@@ -229,11 +374,11 @@ class Indexer:
             paths = []
             for f in files:
                 f_path = download_path / f.path
-                inode = get_file_inode(f_path)
-                paths.append((str(f_path), f.size, inode))
+                dev, inode = get_file_inode(f_path)
+                paths.append((str(f_path), f.size, inode, dev))
                 f_path_resolved = f_path.resolve()
                 if f_path_resolved != f_path:
-                    paths.append((str(f_path_resolved), f.size, inode))
+                    paths.append((str(f_path_resolved), f.size, inode, dev))
             insert_queue.append(
                 InsertTorrentFile(torrent.infohash, torrent.name, download_path, paths)
             )
@@ -0,0 +1,102 @@
+import ctypes
+import logging
+import platform
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+IO_BURST_SECONDS = 1.0
+COPY_BLOCK_SIZE = 2**20
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+}
+
+
+def set_idle_io_priority():
+    """Put the process in the idle I/O scheduling class, returns True if it worked"""
+    syscall_number = SYS_IOPRIO_SET.get(platform.machine())
+    if platform.system() != "Linux" or syscall_number is None:
+        logger.warning(
+            f"Idle I/O priority is not supported on {platform.system()} {platform.machine()}"
+        )
+        return False
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if (
+        libc.syscall(
+            syscall_number,
+            IOPRIO_WHO_PROCESS,
+            0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT,
+        )
+        != 0
+    ):
+        logger.warning(
+            f"Failed to set idle I/O priority, errno {ctypes.get_errno()}"
+        )
+        return False
+    return True
+
+
+class IOBudget:
+    """
+    Limits reads done while hashing and copying so seeding is not starved.
+
+    The read rate is paced with up to IO_BURST_SECONDS of unused budget saved up,
+    bytes read and time spent throttled are counted for reporting.
+    """
+
+    def __init__(self, max_read_rate=0, max_concurrent_reads=0):
+        self.max_read_rate = max_read_rate
+        self.max_concurrent_reads = max_concurrent_reads
+        self.bytes_read = 0
+        self.throttled_time = 0.0
+        self._next_read_at = 0.0
+        self._lock = threading.Lock()
+
+    def limit_workers(self, workers):
+        if self.max_concurrent_reads:
+            return min(workers, self.max_concurrent_reads)
+        return workers
+
+    def consume(self, size):
+        """Account for size bytes read, sleeps if the read rate is exceeded"""
+        with self._lock:
+            self.bytes_read += size
+            if not self.max_read_rate:
+                return
+            now = time.monotonic()
+            self._next_read_at = (
+                max(self._next_read_at, now - IO_BURST_SECONDS)
+                + size / self.max_read_rate
+            )
+            delay = self._next_read_at - now
+            if delay <= 0:
+                return
+            self.throttled_time += delay
+        time.sleep(delay)
+
+    def copyfile(self, src, dst):
+        """Copy a file while keeping within the budget"""
+        if not self.max_read_rate:
+            shutil.copyfile(src, dst)
+            self.consume(dst.stat().st_size)
+            return
+
+        with src.open("rb") as src_fp, dst.open("wb") as dst_fp:
+            while True:
+                data = src_fp.read(COPY_BLOCK_SIZE)
+                if not data:
+                    break
+                self.consume(len(data))
+                dst_fp.write(data)
@@ -1,30 +1,41 @@
 import errno
 import logging
 import os
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from math import ceil
-from pathlib import Path
+from pathlib import Path, PurePath
 
-from .utils import (
-    can_potentially_miss_in_unsplitable,
-    get_root_of_unsplitable,
-    is_unsplitable,
-    parse_torrent,
-)
+from .hashing import FIRST_PIECE_LENGTHS, ProbePolicy, find_holes
+from .utils import Torrent, can_potentially_miss_in_unsplitable, parse_torrent
 
 MatchedFile = namedtuple("MatchedFile", ["torrent_file", "searched_files"])
 MatchResult = namedtuple("MatchResult", ["root_path", "matched_files", "size"])
-MappedFile = namedtuple("MappedFile", ["size", "clients", "indirect_clients"])
+MappedFile = namedtuple(
+    "MappedFile", ["size", "clients", "indirect_clients", "real_path"]
+)
 MapResult = namedtuple(
     "MapResult", ["total_size", "seeded_size", "indirect_seeded_size", "files"]
 )
 DynamicMatchResult = namedtuple(
     "DynamicMatchResult", ["success", "missing_size", "matched_files", "touched_files"]
 )
+CachedMatch = namedtuple(
+    "CachedMatch",
+    [
+        "root_path",
+        "missing_size",
+        "matched_files",
+        "touched_files",
+        "hash_verify_result",
+        "hash_touch_result",
+    ],
+)
 
 logger = logging.getLogger(__name__)
 
 EXACT_MATCH_FACTOR = 0.05
+DEFAULT_MAP_WORKERS = 8
 
 
 def is_relative_to(path, *other):
@@ -36,11 +47,90 @@ def is_relative_to(path, *other):
         return False
 
 
+class MapTreeNode:
+    """
+    Sizes and seeding of the files at or below a path of a map result, children are
+    keyed by name. A node is seeded if any file below it is seeded.
+    """
+
+    __slots__ = (
+        "children",
+        "file_count",
+        "total_size",
+        "seeded_size",
+        "indirect_seeded_size",
+        "is_seeded",
+    )
+
+    def __init__(self):
+        self.children = {}
+        self.file_count = 0
+        self.total_size = 0
+        self.seeded_size = 0
+        self.indirect_seeded_size = 0
+        self.is_seeded = False
+
+    def add_sizes(self, total_size, seeded_size, indirect_seeded_size):
+        self.total_size += total_size
+        self.seeded_size += seeded_size
+        self.indirect_seeded_size += indirect_seeded_size
+
+    def sum_up(self):
+        """Add up the children bottom-up."""
+        stack = [(self, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.values())
+                continue
+            for child in node.children.values():
+                node.file_count += child.file_count
+                node.total_size += child.total_size
+                node.seeded_size += child.seeded_size
+                node.indirect_seeded_size += child.indirect_seeded_size
+                node.is_seeded = node.is_seeded or child.is_seeded
+
+    def get(self, parts):
+        """The node at the relative path parts, an empty node if there are no files."""
+        node = self
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return MapTreeNode()
+        return node
+
+    def iter_unseeded(self, path):
+        """The paths of the topmost nodes where no file below is seeded."""
+        stack = [((), self)]
+        while stack:
+            parts, node = stack.pop()
+            if not node.file_count:
+                continue
+            if not node.is_seeded:
+                yield path.joinpath(*parts)
+                continue
+            stack.extend(
+                ((*parts, name), child) for (name, child) in node.children.items()
+            )
+
+
 class Matcher:
-    def __init__(self, rewriter, db, include_inodes=False):
+    def __init__(
+        self,
+        rewriter,
+        db,
+        include_inodes=False,
+        io_budget=None,
+        piece_cache=None,
+        probe_policy=None,
+    ):
         self.rewriter = rewriter
         self.db = db
         self.include_inodes = include_inodes
+        self.io_budget = io_budget
+        self.piece_cache = piece_cache
+        self.probe_policy = probe_policy or ProbePolicy()
 
     def _match_filelist_exact(
         self,
@@ -213,6 +303,63 @@ class Matcher:
 
         return match_results
 
+    def _get_first_piece_matches(self, torrent, torrent_file, searched_files):
+        """
+        Compare the first piece of a piece aligned torrent file with the indexed first piece hashes.
+
+        Returns a mapping of path to True if the first piece matches and False if not,
+        files without an up to date first piece hash are left out.
+        Matching files are found with the digest index, only when there are none
+        the first piece hashes of the searched files are looked up to skip them.
+        """
+        piece_calculation = torrent.piece_calculations[torrent_file.path]
+        if (
+            torrent.piece_length not in FIRST_PIECE_LENGTHS
+            or piece_calculation.start_offset
+            or torrent_file.size < torrent.piece_length
+        ):
+            return {}
+
+        def is_unchanged(path, mtime):
+            try:
+                return path.stat().st_mtime_ns == mtime
+            except OSError:
+                return False
+
+        expected_digest = piece_calculation.complete_pieces[0]
+        searched_paths = {x.path / x.name for x in searched_files}
+        first_piece_matches = {
+            path: True
+            for (path, mtime) in self.db.find_first_piece_hash_files(
+                torrent.piece_length, expected_digest, torrent_file.size
+            )
+            if path in searched_paths and is_unchanged(path, mtime)
+        }
+        if first_piece_matches:
+            return first_piece_matches
+
+        for path, (mtime, digest) in self.db.get_first_piece_hashes(
+            searched_files, torrent.piece_length
+        ).items():
+            if is_unchanged(path, mtime):
+                first_piece_matches[path] = digest == expected_digest
+        return first_piece_matches
+
+    def _get_fingerprints(self, searched_files):
+        """Fingerprints of searched files that are unchanged since they were fingerprinted"""
+        fingerprints = {}
+        for searched_file in searched_files:
+            if searched_file.fingerprint is None:
+                continue
+            path = searched_file.to_full_path()
+            try:
+                if path.stat().st_mtime_ns != searched_file.mtime:
+                    continue
+            except OSError:
+                continue
+            fingerprints[path] = (searched_file.size, searched_file.fingerprint)
+        return fingerprints
+
     def _match_best_file(
         self,
         torrent,
@@ -221,15 +368,72 @@ class Matcher:
         hash_probe=False,
         match_hash_size=False,
     ):
+        first_piece_matches, fingerprints = {}, {}
+        if hash_probe:
+            first_piece_matches = self._get_first_piece_matches(
+                torrent, torrent_file, searched_files
+            )
+            fingerprints = self._get_fingerprints(searched_files)
         searched_files = sorted(
-            searched_files, key=lambda x: x.name == torrent_file.path.name, reverse=True
+            searched_files,
+            key=lambda x: (
+                first_piece_matches.get(x.path / x.name) is True,
+                not x.hole_size,
+                x.name == torrent_file.path.name,
+            ),
+            reverse=True,
         )
+        # candidates are ambiguous if more than one distinct file can be probed
+        ambiguous = (
+            len(
+                {
+                    fingerprints.get(x.path / x.name, x.path / x.name)
+                    for x in searched_files
+                    if (x.path / x.name) not in first_piece_matches
+                }
+            )
+            > 1
+        )
+        failed_fingerprints = set()
         for searched_file in searched_files:
             if hash_probe:
                 searched_file_path = searched_file.path / searched_file.name
-                with searched_file_path.open("rb") as fp:
+                first_piece_match = first_piece_matches.get(searched_file_path)
+                fingerprint = fingerprints.get(searched_file_path)
+                if first_piece_match is False:
+                    logger.debug(
+                        f"File {searched_file_path} matched against {torrent_file.path} has a different first piece, skipping"
+                    )
+                    continue
+                elif first_piece_match:
+                    return searched_file
+                if fingerprint in failed_fingerprints:
+                    logger.debug(
+                        f"File {searched_file_path} matched against {torrent_file.path} has the fingerprint of a file that failed hash probe, skipping"
+                    )
+                    continue
+                read_path = self.rewriter.read_path(searched_file_path)
+                holes = find_holes(read_path, searched_file.size)
+                if (
+                    holes
+                    and torrent_file.pieces.verify_holes(searched_file.size, holes)
+                    is False
+                ):
+                    logger.debug(
+                        f"File {searched_file_path} matched against {torrent_file.path} has holes where the torrent has data, skipping"
+                    )
+                    if fingerprint is not None:
+                        failed_fingerprints.add(fingerprint)
+                    continue
+                with read_path.open("rb") as fp:
                     matched_hash_probe = torrent_file.pieces.probe_hash(
-                        searched_file.size, fp
+                        searched_file.size,
+                        fp,
+                        io_budget=self.io_budget,
+                        piece_cache=self.piece_cache,
+                        probe_policy=self.probe_policy,
+                        ambiguous=ambiguous,
+                        path=searched_file_path,
                     )
                     if (
                         matched_hash_probe is False
@@ -239,6 +443,8 @@ class Matcher:
                         logger.debug(
                             f"File {searched_file_path} matched against {torrent_file.path} failed hash probe, skipping"
                         )
+                        if fingerprint is not None:
+                            failed_fingerprints.add(fingerprint)
                         continue
             return searched_file
         return None
@@ -246,28 +452,50 @@ class Matcher:
     def _select_best_candidate(
         self, torrent, candidates, hash_probe=False, match_hash_size=False
     ):
-        evaluated_candidates = []
-        for match_result in candidates:
+        """
+        Evaluate candidates from the largest matched size and down.
+
+        The matched size of a candidate is the most it can end up with after
+        evaluation, so we stop when no remaining candidate can beat the best one.
+        """
+        best_result, best_size = None, -1
+        for match_result in sorted(candidates, key=lambda x: -x.size):
+            if match_result.size <= best_size:
+                logger.debug(
+                    f"Candidate {match_result.root_path} can not beat best size {best_size}, stopping"
+                )
+                break
+
             candidate_result = {}
+            possible_size = match_result.size
             for matched_file in match_result.matched_files:
-                candidate_result[matched_file.torrent_file.path] = (
-                    self._match_best_file(
-                        torrent,
-                        matched_file.torrent_file,
-                        matched_file.searched_files,
-                        hash_probe=hash_probe,
-                        match_hash_size=match_hash_size,
-                    )
+                searched_file = self._match_best_file(
+                    torrent,
+                    matched_file.torrent_file,
+                    matched_file.searched_files,
+                    hash_probe=hash_probe,
+                    match_hash_size=match_hash_size,
                 )
-            evaluated_candidates.append(candidate_result)
-        return sorted(
-            evaluated_candidates,
-            key=lambda x: sum(y.size for y in x.values() if y is not None),
-            reverse=True,
-        )[0]
+                candidate_result[matched_file.torrent_file.path] = searched_file
+                if searched_file is None and matched_file.searched_files:
+                    possible_size -= matched_file.torrent_file.size
+                    if possible_size <= best_size:
+                        logger.debug(
+                            f"Candidate {match_result.root_path} can no longer beat best size {best_size}, skipping"
+                        )
+                        break
+            else:
+                best_result, best_size = candidate_result, possible_size
+        return best_result
+
+    def _parse_torrent(self, torrent):
+        """Parse a torrent dict unless it is an already parsed torrent."""
+        if isinstance(torrent, Torrent):
+            return torrent
+        return parse_torrent(torrent, utf8_compat_mode=self.db.utf8_compat_mode)
 
     def match_files_exact(self, torrent):
-        torrent = parse_torrent(torrent, utf8_compat_mode=self.db.utf8_compat_mode)
+        torrent = self._parse_torrent(torrent)
         logger.info(f"Doing exact lookup for {torrent}")
         match_results = self._match_filelist_exact(torrent.filelist)
         usable_match_results = []
@@ -295,23 +523,9 @@ class Matcher:
     ):
         if match_hash_size:
             hash_probe = True
-        torrent = parse_torrent(torrent, utf8_compat_mode=self.db.utf8_compat_mode)
-
-        path_files = {}
-        for f in torrent.filelist:
-            path_files.setdefault(f.path.parent, []).append(f)
-
-        unsplitable_roots = set()
-        for path, files in path_files.items():
-            parts = path.parts
-            while parts:
-                if parts in unsplitable_roots:
-                    break
-                parts = parts[:-1]
-            else:
-                if is_unsplitable([f.path for f in files]):
-                    unsplitable_root = get_root_of_unsplitable(Path(path))
-                    unsplitable_roots.add(unsplitable_root.parts)
+        torrent = self._parse_torrent(torrent)
+        path_files = torrent.path_files
+        unsplitable_roots = torrent.unsplitable_roots
 
         best_possible_size = 0
         candidate_paths = {}
@@ -390,7 +604,7 @@ class Matcher:
         found_file_piece_mapping = {}
         current_missing_size = 0
         for torrent_file in torrent.filelist:
-            piece_calculation = torrent_file.pieces.calculate_offsets(torrent_file.size)
+            piece_calculation = torrent.piece_calculations[torrent_file.path]
             if result_mapping[torrent_file.path]:
                 found_pieces.add(piece_calculation.start_piece)
                 found_pieces.add(piece_calculation.end_piece)
@@ -425,106 +639,409 @@ class Matcher:
             list(touched_files),
         )
 
+    def get_cached_match(self, torrent, fingerprint, options):
+        """
+        Find a cached match for a torrent with the same filelist fingerprint.
+
+        Returns None if nothing is cached or any of the matched files changed.
+        """
+        result = self.db.get_match_cache(fingerprint, options)
+        if result is None:
+            return None
+
+        matched_files = {}
+        for torrent_path, actual_path, size, mtime in result["files"]:
+            torrent_path = PurePath(*torrent_path)
+            if torrent_path not in torrent.filelist_mapped:
+                logger.debug(f"Cached path {torrent_path} not found in torrent")
+                return None
+
+            if actual_path is not None:
+                actual_path = Path(actual_path)
+                try:
+                    stat = actual_path.stat()
+                except OSError:
+                    logger.debug(f"Cached path {actual_path} no longer exist")
+                    return None
+                if stat.st_size != size or stat.st_mtime_ns != mtime:
+                    logger.debug(f"Cached path {actual_path} has been modified")
+                    return None
+            matched_files[torrent_path] = actual_path
+
+        def load_file_status(file_status):
+            if file_status is None:
+                return None
+            return {
+                torrent.filelist_mapped[PurePath(*torrent_path)]: status
+                for (torrent_path, status) in file_status
+            }
+
+        return CachedMatch(
+            result["root_path"] and Path(result["root_path"]),
+            result["missing_size"],
+            matched_files,
+            [PurePath(*torrent_path) for torrent_path in result["touched_files"]],
+            load_file_status(result["hash_verify_result"]),
+            load_file_status(result["hash_touch_result"]),
+        )
+
+    def cache_match(
+        self,
+        fingerprint,
+        options,
+        matched_files,
+        missing_size=0,
+        touched_files=None,
+        hash_verify_result=None,
+        hash_touch_result=None,
+        root_path=None,
+    ):
+        """
+        Cache a match for a filelist fingerprint, the modification time and size
+        of the matched files are stored to make sure they are unchanged when reused.
+        """
+        files = []
+        for torrent_path, actual_path in matched_files.items():
+            if actual_path is None:
+                files.append([list(torrent_path.parts), None, None, None])
+                continue
+            stat = actual_path.stat()
+            files.append(
+                [
+                    list(torrent_path.parts),
+                    str(actual_path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ]
+            )
+
+        def dump_file_status(file_status):
+            if file_status is None:
+                return None
+            return [
+                [list(torrent_file.path.parts), status]
+                for (torrent_file, status) in file_status.items()
+            ]
+
+        self.db.insert_match_cache(
+            fingerprint,
+            options,
+            {
+                "root_path": root_path and str(root_path),
+                "missing_size": missing_size,
+                "files": files,
+                "touched_files": [
+                    list(torrent_path.parts) for torrent_path in (touched_files or [])
+                ],
+                "hash_verify_result": dump_file_status(hash_verify_result),
+                "hash_touch_result": dump_file_status(hash_touch_result),
+            },
+        )
+
     def map_path_to_clients(self, path):
         """
         Map a path and all its files to clients.
         """
-        scanned_folders = set()
-        total = {"size": 0}
-        real_files_seen = set()
-        real_files_mapping = {}
-        path_seeded = {}
-        path_check_queue = []
-
-        def flush_check_queue():
-            logger.debug("Flushing queue")
-            path_inodes = {}
-            for p in path_check_queue:
-                resolved_p = p.resolve()
-                stat = p.stat()
-                size = stat.st_size
-                if self.include_inodes:
-                    if stat.st_ino not in path_inodes:
-                        path_inodes[stat.st_ino] = []
-                    path_inodes[stat.st_ino].append((p, stat.st_dev))
-                if resolved_p not in real_files_seen:
-                    total["size"] += size
-                    real_files_seen.add(resolved_p)
-
-                real_files_mapping[p] = resolved_p
-                path_seeded[p] = MappedFile(size=size, clients=[], indirect_clients=[])
-
-            seeded_files, indirect_seeded_files = self.db.get_seeded_paths(
-                path_check_queue, path_inodes
-            )
+        return next(self.map_paths_to_clients([path]))
 
-            for seeded_file in seeded_files:
-                path_seeded[seeded_file.path].clients.append(
-                    (seeded_file.client, seeded_file.infohash)
-                )
+    def map_paths_to_clients(self, paths, workers=DEFAULT_MAP_WORKERS):
+        """
+        Map paths and all their files to clients, yields a MapResult for every path
+        in the order of paths. Directories of all the paths are listed by a pool of
+        workers while the files already found are looked up in batches.
+        """
+        states = [
+            {
+                "scanned_folders": set(),
+                "path_seeded": {},
+                "check_queue": [],
+                "pending": 0,
+            }
+            for _ in paths
+        ]
+        map_results = {}
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
 
-            for indirect_seeded_file in indirect_seeded_files:
-                path_seeded[indirect_seeded_file.path].indirect_clients.append(
-                    (indirect_seeded_file.client, indirect_seeded_file.infohash)
-                )
+            def submit(index, path, resolved_path):
+                state = states[index]
+                if path in state["scanned_folders"]:
+                    return
+                logger.debug(f"Scanning path {path!s}")
+                state["scanned_folders"].add(path)
+                state["pending"] += 1
+                future = executor.submit(self._list_map_path, path, resolved_path)
+                futures[future] = index
 
-            path_check_queue.clear()
+            for index, path in enumerate(paths):
+                submit(index, path, None)
 
-        def looper(path, initial_path=False):
-            if path in scanned_folders:
-                return
-            logger.debug(f"Scanning path {path!s}")
-            scanned_folders.add(path)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    state = states[index]
+                    state["pending"] -= 1
+                    files, directories = future.result()
+                    state["check_queue"] += files
+                    for directory, resolved_directory in directories:
+                        submit(index, directory, resolved_directory)
 
-            for rewritten_path in self.rewriter.rewrite_path(
-                path, prefix_match=initial_path
-            ):
+                    if state["pending"] and len(state["check_queue"]) <= 1000:
+                        continue
+                    self._flush_map_queue(state["path_seeded"], state["check_queue"])
+                    if not state["pending"]:
+                        map_results[index] = self._create_map_result(
+                            state["path_seeded"]
+                        )
+                        states[index] = None
+
+                while next_index in map_results:
+                    yield map_results.pop(next_index)
+                    next_index += 1
+
+    def _list_map_path(self, path, resolved_path):
+        """
+        List the files and directories in path as (path, resolved path, stat) and
+        (path, resolved path). Paths are resolved from the resolved path of their
+        directory, only symlinks are resolved on their own.
+        """
+        files, directories = [], []
+        for rewritten_path in self.rewriter.rewrite_path(path):
+            if resolved_path is None or rewritten_path != path:
                 if rewritten_path.is_file():
-                    path_check_queue.append(rewritten_path)
+                    files.append(
+                        (
+                            rewritten_path,
+                            rewritten_path.resolve(),
+                            rewritten_path.stat(),
+                        )
+                    )
                     continue
-                try:
-                    for p in rewritten_path.iterdir():
-                        if p.is_dir():
-                            looper(p)
-                        elif p.is_file():
-                            path_check_queue.append(p)
-                except OSError as e:
-                    if e.errno != errno.ELOOP:
-                        raise e
-
-            if len(path_check_queue) > 1000:
-                flush_check_queue()
-
-        looper(path)
-        flush_check_queue()
+                resolved_directory = None
+            else:
+                resolved_directory = resolved_path
+
+            try:
+                with os.scandir(rewritten_path) as it:
+                    for entry in it:
+                        p = rewritten_path / entry.name
+                        if entry.is_symlink():
+                            if p.is_dir():
+                                directories.append((p, None))
+                            elif p.is_file():
+                                files.append((p, p.resolve(), p.stat()))
+                            continue
+
+                        if resolved_directory is None:
+                            resolved_directory = rewritten_path.resolve()
+                        if entry.is_dir():
+                            directories.append((p, resolved_directory / entry.name))
+                        elif entry.is_file():
+                            files.append(
+                                (p, resolved_directory / entry.name, entry.stat())
+                            )
+            except OSError as e:
+                if e.errno != errno.ELOOP:
+                    raise e
+        return files, directories
+
+    def _flush_map_queue(self, path_seeded, check_queue):
+        """Look up the seeding of the files in the check queue."""
+        logger.debug("Flushing queue")
+        path_inodes = {}
+        if self.include_inodes:
+            seeded_inodes = self.db.get_seeded_inodes()
+        for p, resolved_p, stat in check_queue:
+            if self.include_inodes and (
+                (stat.st_dev, stat.st_ino) in seeded_inodes
+                or (None, stat.st_ino) in seeded_inodes
+            ):
+                if stat.st_ino not in path_inodes:
+                    path_inodes[stat.st_ino] = []
+                path_inodes[stat.st_ino].append((p, stat.st_dev))
+
+            path_seeded[p] = MappedFile(
+                size=stat.st_size, clients=[], indirect_clients=[], real_path=resolved_p
+            )
+
+        seeded_files, indirect_seeded_files = self.db.get_seeded_paths(
+            [p for (p, _, _) in check_queue], path_inodes
+        )
+
+        for seeded_file in seeded_files:
+            path_seeded[seeded_file.path].clients.append(
+                (seeded_file.client, seeded_file.infohash)
+            )
+
+        for indirect_seeded_file in indirect_seeded_files:
+            path_seeded[indirect_seeded_file.path].indirect_clients.append(
+                (indirect_seeded_file.client, indirect_seeded_file.infohash)
+            )
+
+        check_queue.clear()
+
+    def map_path_to_clients_from_index(self, path):
+        """
+        Map a path and all its files to clients with only the scanned files and client
+        files, the files themselves are not looked at. Files are only found if path is
+        scanned. Symlinks cannot be told apart from their targets and count as files.
+        """
+        path_seeded = {}
+        seeded_files, indirect_seeded_files = [], []
+        for rewritten_path in self.rewriter.rewrite_path(path):
+            for p, size, dev, inode in self.db.get_indexed_files(rewritten_path):
+                path_seeded[p] = MappedFile(
+                    size=size, clients=[], indirect_clients=[], real_path=p
+                )
+            path_seeded_files = self.db.get_indexed_seeded_paths(
+                rewritten_path, include_inodes=self.include_inodes
+            )
+            seeded_files += path_seeded_files[0]
+            indirect_seeded_files += path_seeded_files[1]
+
+        for seeded_file in seeded_files:
+            path_seeded[seeded_file.path].clients.append(
+                (seeded_file.client, seeded_file.infohash)
+            )
+
+        for indirect_seeded_file in indirect_seeded_files:
+            path_seeded[indirect_seeded_file.path].indirect_clients.append(
+                (indirect_seeded_file.client, indirect_seeded_file.infohash)
+            )
+
+        return self._create_map_result(path_seeded)
+
+    def list_path_from_index(self, path):
+        """
+        Names of the files and directories directly in path as two sorted lists with
+        only the scanned files, the files themselves are not looked at.
+        """
+        file_names, directory_names = set(), set()
+        for rewritten_path in self.rewriter.rewrite_path(path):
+            rewritten_file_names, rewritten_directory_names = (
+                self.db.get_indexed_children(rewritten_path)
+            )
+            file_names |= rewritten_file_names
+            directory_names |= rewritten_directory_names
+        return sorted(file_names), sorted(directory_names - file_names)
+
+    def map_directory_to_clients_from_index(self, path):
+        """
+        Seeded sizes of a directory from the directory sizes kept up to date by the
+        scans. Returns None if there are no scanned files in the directory.
+        """
+        found_sizes = [
+            directory_sizes
+            for directory_sizes in map(
+                self.db.get_directory_sizes, self.rewriter.rewrite_path(path)
+            )
+            if directory_sizes is not None
+        ]
+        if not found_sizes:
+            return None
+        return MapResult(*[sum(sizes) for sizes in zip(*found_sizes)], files={})
+
+    def _create_map_result(self, path_seeded):
+        """Sum up the sizes of mapped files, counting every real file once."""
+        total_size = 0
         seeded_size = 0
         indirect_seeded_size = 0
+        counted_paths = set()
         already_counted_paths = set()
-        for p, mapped_file in path_seeded.items():
+        for mapped_file in path_seeded.values():
+            if mapped_file.real_path in counted_paths:
+                continue
+
+            counted_paths.add(mapped_file.real_path)
+            total_size += mapped_file.size
+
+        for mapped_file in path_seeded.values():
             if not mapped_file.clients:
                 continue
 
-            resolved_p = real_files_mapping[p]
-            if resolved_p in already_counted_paths:
+            if mapped_file.real_path in already_counted_paths:
                 continue
 
-            already_counted_paths.add(resolved_p)
+            already_counted_paths.add(mapped_file.real_path)
             seeded_size += mapped_file.size
 
-        for p, mapped_file in path_seeded.items():
+        for mapped_file in path_seeded.values():
             if not mapped_file.indirect_clients:
                 continue
 
-            resolved_p = real_files_mapping[p]
-            if resolved_p in already_counted_paths:
+            if mapped_file.real_path in already_counted_paths:
                 continue
 
-            already_counted_paths.add(resolved_p)
+            already_counted_paths.add(mapped_file.real_path)
             indirect_seeded_size += mapped_file.size
 
         return MapResult(
-            total_size=total["size"],
+            total_size=total_size,
             seeded_size=seeded_size,
             indirect_seeded_size=indirect_seeded_size,
             files=path_seeded,
         )
+
+    def build_map_tree(self, path, map_result, include_indirect_seeded=False):
+        """
+        Build a MapTreeNode tree of the files of a map result of path in one pass,
+        the sizes and seeding of every directory are summed up from the files below it.
+        Files in paths path is rewritten to are put where they would be in path.
+        A real file with more than one path is counted once in every directory it is in.
+        """
+        root_parts = [root_path.parts for root_path in self.rewriter.rewrite_path(path)]
+        real_path_count = Counter(
+            mapped_file.real_path for mapped_file in map_result.files.values()
+        )
+        tree = MapTreeNode()
+        shared_real_paths = {}
+        for p, mapped_file in map_result.files.items():
+            node = tree
+            nodes = [node]
+            for parts in root_parts:
+                if p.parts[: len(parts)] == parts:
+                    for part in p.parts[len(parts) :]:
+                        child = node.children.get(part)
+                        if child is None:
+                            child = node.children[part] = MapTreeNode()
+                        node = child
+                        nodes.append(node)
+                    break
+
+            node.file_count += 1
+            node.is_seeded = node.is_seeded or bool(
+                mapped_file.clients
+                or (include_indirect_seeded and mapped_file.indirect_clients)
+            )
+            if real_path_count[mapped_file.real_path] > 1:
+                shared_real_paths.setdefault(mapped_file.real_path, []).append(
+                    (mapped_file, nodes)
+                )
+            elif mapped_file.clients:
+                node.add_sizes(mapped_file.size, mapped_file.size, 0)
+            elif mapped_file.indirect_clients:
+                node.add_sizes(mapped_file.size, 0, mapped_file.size)
+            else:
+                node.add_sizes(mapped_file.size, 0, 0)
+        tree.sum_up()
+
+        for mapped_files in shared_real_paths.values():
+            node_seeding = {}
+            for mapped_file, nodes in mapped_files:
+                for node in nodes:
+                    clients, indirect_clients = node_seeding.get(node, (False, False))
+                    node_seeding[node] = (
+                        clients or bool(mapped_file.clients),
+                        indirect_clients or bool(mapped_file.indirect_clients),
+                    )
+            size = mapped_files[0][0].size
+            for node, (clients, indirect_clients) in node_seeding.items():
+                if clients:
+                    node.add_sizes(size, size, 0)
+                elif indirect_clients:
+                    node.add_sizes(size, 0, size)
+                else:
+                    node.add_sizes(size, 0, 0)
+        return tree
@@ -14,10 +14,11 @@ CW_CACHE_CONF_NAME = "autotorrent.json"
 
 
 class ReadWriteFileCache:
-    def __init__(self, path, ttl, chown_str=None):
+    def __init__(self, path, ttl, chown_str=None, io_budget=None):
         self.path = Path(path)
         self.ttl = ttl
         self.chown_str = chown_str
+        self.io_budget = io_budget
 
     def cleanup_cache(self):
         removed_paths = []
@@ -40,7 +41,11 @@ class ReadWriteFileCache:
                 shutil.rmtree(path)
         return removed_paths
 
-    def cache_file(self, path, target_path, link_type):
+    def cache_file(self, path, target_path, link_type, rewriter=None):
+        """
+        Link target_path to a cached copy of path, the copy is read from the read path
+        of the rewriter if set.
+        """
         full_folder_name = "__".join(path.parts[1:])
         folder_name = f"{full_folder_name[:25]}__{full_folder_name[-50:]}__{hashlib.sha1(str(path).encode()).hexdigest()}"
         folder_path = self.path / folder_name
@@ -53,7 +58,11 @@ class ReadWriteFileCache:
             )
             folder_path.mkdir()
             folder_data_path.mkdir()
-            shutil.copyfile(path, folder_data_file)
+            read_path = rewriter and rewriter.read_path(path)
+            if self.io_budget:
+                self.io_budget.copyfile(read_path or path, folder_data_file)
+            else:
+                shutil.copyfile(read_path or path, folder_data_file)
             if self.chown_str is not None:
                 chown(self.chown_str, folder_data_file)
             conf_path.write_text(
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+from libtc import BTFailure
+
+from .bencode import bdecode_torrent
+from .hashing import hash_pieces
+from .utils import (
+    AUTOTORRENT_CONF_NAME,
+    STORE_DATA_PATH,
+    FailedToParseTorrentException,
+    parse_torrent,
+)
+
+logger = logging.getLogger(__name__)
+
+StoreTorrent = namedtuple(
+    "StoreTorrent", ["infohash", "store_path", "data_path", "torrent"]
+)
+ScrubResult = namedtuple(
+    "ScrubResult",
+    [
+        "store_torrent",
+        "verified_pieces",
+        "failed_pieces",
+        "missing_pieces",
+        "bytes_read",
+        "completed",
+        "pass_failed_pieces",
+        "pass_missing_pieces",
+    ],
+)
+
+
+def find_store_paths(path):
+    """Find store paths created by add below path, i.e. folders with an autotorrent.json."""
+    for root, dirs, files in os.walk(path):
+        if AUTOTORRENT_CONF_NAME in files:
+            dirs[:] = []
+            yield Path(root)
+
+
+def load_store_torrent(store_path, utf8_compat_mode=False):
+    """Parse the torrent copy in a store path, returns None if there is none to parse."""
+    data_path = store_path / STORE_DATA_PATH
+    for torrent_path in sorted(store_path.glob("*.torrent")):
+        try:
+            torrent_data, torrent_info = bdecode_torrent(torrent_path.read_bytes())
+            torrent = parse_torrent(torrent_data, utf8_compat_mode=utf8_compat_mode)
+        except (OSError, BTFailure, FailedToParseTorrentException):
+            logger.exception(f"Failed to parse torrent file {torrent_path}")
+            continue
+        infohash = hashlib.sha1(torrent_info).hexdigest()
+        return StoreTorrent(infohash, store_path, data_path, torrent)
+    return None
+
+
+def scrub_torrents(store_torrents, db, budget_size, workers=None, io_budget=None):
+    """
+    Verify the next budget_size bytes of pieces of the store torrents.
+
+    Torrents are continued where the last run stopped, partially scrubbed torrents
+    first and then the ones that were scrubbed the longest time ago.
+    Returns a ScrubResult for every torrent pieces were verified in, with the counts
+    of the slice verified now and of the whole pass through the torrent so far.
+    """
+    scrub_progress = db.get_scrub_progress()
+
+    def scrub_order(store_torrent):
+        progress = scrub_progress.get(store_torrent.infohash)
+        if progress is None:
+            return (1, "")
+        return (progress.next_piece == 0, progress.scrubbed or "")
+
+    results = []
+    for store_torrent in sorted(store_torrents, key=scrub_order):
+        if budget_size <= 0:
+            break
+
+        torrent = store_torrent.torrent
+        progress = scrub_progress.get(store_torrent.infohash)
+        next_piece, failed_pieces, missing_pieces = 0, 0, 0
+        if progress and 0 < progress.next_piece < len(torrent.pieces):
+            next_piece, failed_pieces, missing_pieces = progress[:3]
+
+        file_mapping = {}
+        for torrent_file in torrent.filelist:
+            full_path = store_torrent.data_path / torrent_file.path
+            file_mapping[torrent_file.path] = full_path.exists() and full_path or None
+        _, piece_segments = torrent.plan_verify_hash(["*"], file_mapping)
+
+        slice_segments, slice_missing = {}, 0
+        piece_index = next_piece
+        while piece_index < len(torrent.pieces) and budget_size > 0:
+            if piece_index in piece_segments:
+                slice_segments[piece_index] = piece_segments[piece_index]
+                budget_size -= sum(
+                    length for (_, _, length) in piece_segments[piece_index]
+                )
+            else:
+                slice_missing += 1
+            piece_index += 1
+
+        piece_results = hash_pieces(
+            slice_segments, torrent.pieces, workers=workers, io_budget=io_budget
+        )
+        slice_failed = sum(1 for r in piece_results.values() if r is False)
+        slice_missing += sum(1 for r in piece_results.values() if r is None)
+        failed_pieces += slice_failed
+        missing_pieces += slice_missing
+
+        completed = piece_index >= len(torrent.pieces)
+        if completed:
+            scrubbed = datetime.now().isoformat(sep=" ", timespec="seconds")
+        else:
+            scrubbed = progress and progress.scrubbed or None
+        db.save_scrub_progress(
+            store_torrent.infohash,
+            completed and 0 or piece_index,
+            failed_pieces,
+            missing_pieces,
+            scrubbed,
+        )
+        results.append(
+            ScrubResult(
+                store_torrent,
+                piece_index - next_piece,
+                slice_failed,
+                slice_missing,
+                sum(
+                    length
+                    for segments in slice_segments.values()
+                    for (_, _, length) in segments
+                ),
+                completed,
+                failed_pieces,
+                missing_pieces,
+            )
+        )
+
+    return results
@@ -9,12 +9,14 @@ import shutil
 import sqlite3
 from collections import namedtuple
 from fnmatch import fnmatch
+from functools import cached_property
 from pathlib import Path, PurePath
 
 import chardet
 import click
 
 from .exceptions import FailedToCreateLinkException, FailedToParseTorrentException
+from .hashing import ProbePolicy, advise_willneed, hash_pieces, zero_piece_digest
 
 logger = logging.getLogger(__name__)
 
@@ -70,7 +72,6 @@ UNSPLITABLE_FILE_MISSABLE = [  # If foldername does not match, these files can b
 #     INVALID_BASE_NAMES = INVALID_BASE_NAMES_NIX
 
 PIECE_SIZE = 20
-HASHER_READ_BLOCK_SIZE = 2**18
 
 AUTOTORRENT_CONF_NAME = "autotorrent.json"
 STORE_DATA_PATH = "data"
@@ -177,10 +178,42 @@ def get_root_of_unsplitable(path):
         path = path.parent
 
 
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "9p", "afs", "ceph", "glusterfs"}
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+
+def read_mount_types(mountinfo_path=MOUNTINFO_PATH):
+    """Mount points mapped to their filesystem type, empty if they cannot be read."""
+    mount_types = {}
+    try:
+        with open(mountinfo_path) as f:
+            for line in f:
+                mount_fields, _, fs_fields = line.partition(" - ")
+                mount_point = re.sub(
+                    r"\\([0-7]{3})",
+                    lambda m: chr(int(m.group(1), 8)),
+                    mount_fields.split()[4],
+                )
+                mount_types[mount_point] = fs_fields.split()[0]
+    except (OSError, IndexError):
+        logger.debug(f"Unable to read mount types from {mountinfo_path}")
+    return mount_types
+
+
+def mount_type_rank(fs_type):
+    """Rank a filesystem type by how fast it is expected to read, lower is faster."""
+    if fs_type.startswith("fuse"):
+        return 2
+    if fs_type in NETWORK_FILESYSTEMS:
+        return 1
+    return 0
+
+
 class PathRewriter:
-    def __init__(self, path_mappings):
+    def __init__(self, path_mappings, mount_types=None):
         self.paths = {}
         self.path_groups = {}
+        self.mount_types = mount_types
         self.handle_path_mappings(path_mappings)
 
     def handle_path_mappings(self, path_mappings):
@@ -211,10 +244,51 @@ class PathRewriter:
             else:
                 postfix_path = Path(path.name) / postfix_path
 
+            if path == path.parent:  # reached the root
+                break
             path = path.parent
 
         return [orig_path]
 
+    def read_path(self, path):
+        """
+        The equivalent path a file is fastest to read from, i.e. a path on a local mount
+        is preferred over one on a network or FUSE mount when the file is found with the
+        same size there. Links should still point to the original path.
+        """
+        equivalent_paths = self.rewrite_path(path, prefix_match=True)
+        if len(equivalent_paths) <= 1:
+            return path
+
+        best_path, best_rank, size = path, self._get_mount_rank(path), None
+        for equivalent_path in equivalent_paths:
+            rank = self._get_mount_rank(equivalent_path)
+            if rank >= best_rank:
+                continue
+            try:
+                if size is None:
+                    size = path.stat().st_size
+                if equivalent_path.stat().st_size != size:
+                    continue
+            except OSError:
+                continue
+            best_path, best_rank = equivalent_path, rank
+        if best_path != path:
+            logger.debug(f"Reading {path!s} from {best_path!s}")
+        return best_path
+
+    def _get_mount_rank(self, path):
+        if self.mount_types is None:
+            self.mount_types = read_mount_types()
+        path = str(path)
+        best_mount_point, fs_type = "", ""
+        for mount_point, mount_fs_type in self.mount_types.items():
+            if len(mount_point) <= len(best_mount_point):
+                continue
+            if path == mount_point or path.startswith(mount_point.rstrip("/") + "/"):
+                best_mount_point, fs_type = mount_point, mount_fs_type
+        return mount_type_rank(fs_type)
+
     def _tuplify(self, path):
         p = []
         while path.name:
@@ -248,13 +322,101 @@ PieceCalculation = namedtuple(
 )
 
 
+class PieceHashes:
+    """
+    Piece hashes kept in a single buffer, indexed by offset.
+
+    Slicing returns a view of the same buffer, nothing is copied until a
+    single hash is fetched.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        if isinstance(data, list):
+            data = b"".join(data)
+        self.data = memoryview(data)
+
+    def __len__(self):
+        return len(self.data) // PIECE_SIZE
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise TypeError("The step must be None")
+            stop = max(start, stop)
+            return self.__class__(self.data[start * PIECE_SIZE : stop * PIECE_SIZE])
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("piece index out of range")
+        offset = key * PIECE_SIZE
+        return self.data[offset : offset + PIECE_SIZE].tobytes()
+
+    def __iter__(self):
+        data = self.data
+        for offset in range(0, len(self) * PIECE_SIZE, PIECE_SIZE):
+            yield data[offset : offset + PIECE_SIZE].tobytes()
+
+
+def _calculate_piece_calculation(piece_length, pieces, start_size, size, is_last_file):
+    start_piece, start_offset = divmod(start_size, piece_length)
+    first_complete_piece = start_piece
+    if start_offset:
+        first_complete_piece += 1
+        start_offset = piece_length - start_offset
+
+    end_piece, end_offset = divmod(start_size + size, piece_length)
+    if not end_offset and size:
+        # the file ends on a piece boundary, its data ends in the piece before
+        end_piece -= 1
+    last_complete_piece = end_piece
+    if end_offset and not is_last_file:
+        last_complete_piece -= 1
+    elif not end_offset and not size and is_last_file:
+        last_complete_piece -= 1
+
+    return PieceCalculation(
+        start_piece,
+        start_offset,
+        first_complete_piece,
+        end_piece,
+        end_offset,
+        last_complete_piece,
+        pieces[start_piece : end_piece + 1],
+        pieces[first_complete_piece : last_complete_piece + 1],
+    )
+
+
+def calculate_piece_layout(piece_length, pieces, sizes):
+    """
+    Calculate the piece layout of consecutive files in one pass.
+
+    Returns a list of PieceCalculation, one for each size.
+    The last size is treated as the last file in the torrent.
+    """
+    if not isinstance(pieces, PieceHashes):
+        pieces = PieceHashes(pieces)
+    layout = []
+    start_size = 0
+    last_i = len(sizes) - 1
+    for i, size in enumerate(sizes):
+        layout.append(
+            _calculate_piece_calculation(
+                piece_length, pieces, start_size, size, i == last_i
+            )
+        )
+        start_size += size
+    return layout
+
+
 class Pieces:
     def __init__(self, piece_length, pieces, start_size=0):
         self.piece_length = piece_length
-        if not isinstance(pieces, list):
-            pieces = [
-                pieces[i : i + PIECE_SIZE] for i in range(0, len(pieces), PIECE_SIZE)
-            ]
+        if not isinstance(pieces, PieceHashes):
+            pieces = PieceHashes(pieces)
         self.pieces = pieces
         self.start_size = start_size
 
@@ -275,7 +437,7 @@ class Pieces:
             self.piece_length, self.pieces, self.start_size + key.start
         )
 
-    def hash_piece(self, f):
+    def hash_piece(self, f, io_budget=None):
         """Hashes a full piece from a single file, returns the hash-digest"""
         missing_size = self.piece_length
         hasher = hashlib.sha1()
@@ -289,32 +451,15 @@ class Pieces:
                 )
                 return None
             missing_size -= len(d)
+            if io_budget:
+                io_budget.consume(len(d))
             hasher.update(d)
 
         return hasher.digest()
 
     def calculate_offsets(self, size, is_last_file=False):
-        start_piece, start_offset = divmod(self.start_size, self.piece_length)
-        first_complete_piece = start_piece
-        if start_offset:
-            first_complete_piece += 1
-            start_offset = self.piece_length - start_offset
-
-        end_size = self.start_size + size
-        end_piece, end_offset = divmod(end_size, self.piece_length)
-        last_complete_piece = end_piece
-        if end_offset and not is_last_file:
-            last_complete_piece -= 1
-
-        piece_calculation = PieceCalculation(
-            start_piece,
-            start_offset,
-            first_complete_piece,
-            end_piece,
-            end_offset,
-            last_complete_piece,
-            self.pieces[start_piece : end_piece + 1],
-            self.pieces[first_complete_piece : last_complete_piece + 1],
+        piece_calculation = _calculate_piece_calculation(
+            self.piece_length, self.pieces, self.start_size, size, is_last_file
         )
         logger.debug(
             f"Piece calculation start_piece: {piece_calculation.start_piece} "
@@ -326,76 +471,203 @@ class Pieces:
         )
         return piece_calculation
 
-    def probe_hash(self, size, fp):
+    def probe_hash(
+        self,
+        size,
+        fp,
+        io_budget=None,
+        piece_cache=None,
+        probe_policy=None,
+        ambiguous=False,
+        path=None,
+    ):
         """
-        Test a few pieces against the file if possible.
+        Test a few pieces against the file if possible, the probe policy decides which.
+        Cached pieces are looked up by path, which defaults to the name of fp.
 
         Returns True if passed, False if failed, None if not possible
         """
         piece_calculation = self.calculate_offsets(size)
-        if not piece_calculation.complete_pieces:
+        complete_piece_count = len(piece_calculation.complete_pieces)
+        if not complete_piece_count:
             return None
 
-        pieces_to_verify = set([0])
-        if len(piece_calculation.complete_pieces) > 1:
-            pieces_to_verify.add(len(piece_calculation.complete_pieces) - 1)
+        if probe_policy is None:
+            probe_policy = ProbePolicy()
 
+        path = Path(path or fp.name)
+        cached_digests, identity = {}, None
+        if piece_cache:
+            file_digests, identity = piece_cache.file_digests(path)
+            for (offset, length), digest in file_digests.items():
+                piece, remainder = divmod(
+                    offset - piece_calculation.start_offset, self.piece_length
+                )
+                if (
+                    length == self.piece_length
+                    and not remainder
+                    and 0 <= piece < complete_piece_count
+                ):
+                    cached_digests[piece] = digest
+
+        pieces_to_verify = probe_policy.select_pieces(
+            complete_piece_count, cached_digests, ambiguous=ambiguous
+        )
+        piece_offsets = {
+            piece: piece_calculation.start_offset + piece * self.piece_length
+            for piece in pieces_to_verify
+        }
         for piece in pieces_to_verify:
-            fp.seek(piece_calculation.start_offset + piece * self.piece_length)
-            if self.hash_piece(fp) != piece_calculation.complete_pieces[piece]:
-                return False
+            if piece not in cached_digests:
+                advise_willneed(fp, piece_offsets[piece], self.piece_length)
+
+        digests = {}
+        try:
+            for piece in sorted(pieces_to_verify):
+                digest = cached_digests.get(piece)
+                probe_policy.record(self.piece_length, cached=digest is not None)
+                if digest is None:
+                    fp.seek(piece_offsets[piece])
+                    digest = self.hash_piece(fp, io_budget=io_budget)
+                    if digest is not None:
+                        digests[(piece_offsets[piece], self.piece_length)] = digest
+                if digest != piece_calculation.complete_pieces[piece]:
+                    return False
+        finally:
+            if piece_cache:
+                piece_cache.store_file_digests(path, identity, digests)
 
         return True
 
+    def verify_holes(self, size, holes):
+        """
+        Test the complete pieces of a file that are inside holes against a piece of zeros,
+        this needs no reads.
+
+        Returns False if a piece in a hole is not zeros, True if the pieces are, None if
+        no complete piece is inside a hole
+        """
+        piece_calculation = self.calculate_offsets(size)
+        complete_pieces = piece_calculation.complete_pieces
+        zero_digest = zero_piece_digest(self.piece_length)
+        result = None
+        for start, end in holes:
+            first_piece = max(
+                -(-(start - piece_calculation.start_offset) // self.piece_length), 0
+            )
+            end_piece = min(
+                (end - piece_calculation.start_offset) // self.piece_length,
+                len(complete_pieces),
+            )
+            for piece in range(first_piece, end_piece):
+                if complete_pieces[piece] != zero_digest:
+                    return False
+                result = True
+        return result
+
 
 class Torrent(
     namedtuple(
         "Torrent",
-        ["name", "size", "piece_length", "filelist", "filelist_mapped", "trackers"],
+        [
+            "name",
+            "size",
+            "piece_length",
+            "filelist",
+            "filelist_mapped",
+            "trackers",
+            "pieces",
+        ],
     )
 ):
+    @cached_property
+    def path_files(self):
+        """Files in the torrent grouped by the folder they are in."""
+        path_files = {}
+        for f in self.filelist:
+            path_files.setdefault(f.path.parent, []).append(f)
+        return path_files
+
+    @cached_property
+    def unsplitable_roots(self):
+        """The path parts of the unsplitable roots in the torrent."""
+        unsplitable_roots = set()
+        for path, files in self.path_files.items():
+            parts = path.parts
+            while parts:
+                if parts in unsplitable_roots:
+                    break
+                parts = parts[:-1]
+            else:
+                if is_unsplitable([f.path for f in files]):
+                    unsplitable_root = get_root_of_unsplitable(Path(path))
+                    unsplitable_roots.add(unsplitable_root.parts)
+        return unsplitable_roots
+
+    @cached_property
+    def piece_calculations(self):
+        """Piece layout for every file in the torrent, mapped by torrent path."""
+        layout = calculate_piece_layout(
+            self.piece_length, self.pieces, [f.size for f in self.filelist]
+        )
+        return {
+            torrent_file.path: piece_calculation
+            for torrent_file, piece_calculation in zip(self.filelist, layout)
+        }
+
+    def file_pieces(self, torrent_file):
+        """Range of the pieces a torrent file has data in."""
+        piece_calculation = self.piece_calculations[torrent_file.path]
+        if not torrent_file.size:
+            return range(piece_calculation.start_piece, piece_calculation.start_piece)
+        return range(
+            piece_calculation.start_piece,
+            min(piece_calculation.end_piece, len(self.pieces) - 1) + 1,
+        )
+
+    def have_pieces(self, file_mapping, failed_files=(), piece_results=None):
+        """
+        Conservative bitfield of the pieces the matched data has, as a list of booleans.
+        A piece is only had if every file it touches is mapped and not in failed_files,
+        and if it is in piece_results, only if it was verified as matching.
+        """
+        bitfield = [True] * len(self.pieces)
+        for torrent_file in self.filelist:
+            if (
+                file_mapping.get(torrent_file.path)
+                and torrent_file.path not in failed_files
+            ):
+                continue
+            for piece_index in self.file_pieces(torrent_file):
+                bitfield[piece_index] = False
+        for piece_index, piece_result in (piece_results or {}).items():
+            if piece_result is not True:
+                bitfield[piece_index] = False
+        return bitfield
+
     def is_problematic(self):
         # TODO: check if the torrent can cause problems with some clients
         return False
 
-    def verify_hash(self, fnmatches, file_mapping):
-        """Returns a torrent_file mapping of failed and successful matched files"""
-        # loop files, build list of pieces to verify
-        pieces_to_verify = set()
-        missing_pieces = set()
-        for torrent_file in self.filelist:
-            piece_calculation = torrent_file.pieces.calculate_offsets(
-                torrent_file.size, is_last_file=torrent_file.is_last_file
-            )
-            torrent_file_pieces = set(
-                range(piece_calculation.start_piece, piece_calculation.end_piece + 1)
-            )
-            for pattern in fnmatches:
-                if fnmatch(torrent_file.path.name, pattern):
-                    pieces_to_verify |= torrent_file_pieces
-                    break
-            else:
-                if not file_mapping[torrent_file.path]:
-                    missing_pieces |= torrent_file_pieces
+    def _walk_piece_reads(self, file_mapping, pieces_to_verify, piece_results=None):
+        """
+        Walk through the pieces to verify file by file in the order they are read.
+
+        Without piece_results, returns the (path, offset, length) segments of every
+        piece that can be read completely. With piece_results, returns the piece status
+        where pieces in a file are skipped after the first failed piece and pieces
+        touching missing files are None.
 
+        Pieces are read as a stream over the actual file sizes, a truncated file
+        continues the piece in the next file and a piece that runs out of files
+        cannot be read completely.
+        """
         piece_status = {}
+        piece_segments = {}
         file_piece_mapping = {}
-        file_has_inner_pieces = {}
-        hasher, hasher_piece, data_left, fp, skip_to_piece = (
-            None,
-            None,
-            None,
-            None,
-            None,
-        )
+        hasher_piece, segments, data_left, skip_to_piece = None, None, None, None
         for torrent_file in self.filelist:
-            piece_calculation = torrent_file.pieces.calculate_offsets(
-                torrent_file.size, is_last_file=torrent_file.is_last_file
-            )
-            file_has_inner_pieces[torrent_file] = (
-                piece_calculation.first_complete_piece
-                <= piece_calculation.last_complete_piece
-            )
+            piece_calculation = self.piece_calculations[torrent_file.path]
             full_path = file_mapping[torrent_file.path]
             if not full_path:
                 piece_status[piece_calculation.start_piece] = None
@@ -403,8 +675,15 @@ class Torrent(
                 skip_to_piece = piece_calculation.end_piece + 1
                 continue
 
-            for piece_index, piece in enumerate(
-                piece_calculation.pieces, piece_calculation.start_piece
+            try:
+                file_size = full_path.stat().st_size
+            except OSError:
+                file_size = torrent_file.size
+
+            tell = None
+            for piece_index in range(
+                piece_calculation.start_piece,
+                piece_calculation.start_piece + len(piece_calculation.pieces),
             ):
                 file_piece_mapping.setdefault(piece_index, []).append(torrent_file)
                 if skip_to_piece is not None and skip_to_piece > piece_index:
@@ -424,43 +703,94 @@ class Torrent(
                 else:
                     expected_tell = 0
 
-                if not fp:
-                    fp = full_path.open("rb")
-                    if expected_tell:
-                        fp.seek(expected_tell)
+                if tell is None:
+                    tell = expected_tell
 
                 if hasher_piece != piece_index:
-                    hasher = hashlib.new("sha1", usedforsecurity=False)
                     hasher_piece = piece_index
+                    segments = []
                     data_left = min(
                         self.size - (piece_index * self.piece_length), self.piece_length
                     )
-                    if fp.tell() != expected_tell:
-                        fp.seek(expected_tell)
+                    tell = expected_tell
 
-                while data_left > 0:
-                    data = fp.read(min(HASHER_READ_BLOCK_SIZE, data_left))
-                    hasher.update(data)
-                    data_left -= len(data)
-                    if not data:
-                        break
+                length = min(data_left, max(file_size - tell, 0))
+                if length:
+                    segments.append((full_path, tell, length))
+                    tell += length
+                    data_left -= length
 
                 if data_left == 0:
-                    piece_status[hasher_piece] = hasher.digest() == piece
-                    if not piece_status[hasher_piece]:
-                        skip_to_piece = piece_calculation.end_piece
+                    if piece_results is None:
+                        piece_segments[piece_index] = segments
+                        piece_status[piece_index] = True
+                    elif piece_results.get(piece_index) is not None:
+                        piece_status[piece_index] = piece_results[piece_index]
+                        if not piece_status[piece_index]:
+                            skip_to_piece = piece_calculation.end_piece
 
-            if fp:
-                fp.close()
-                fp = None
+        return piece_status, piece_segments, file_piece_mapping
 
-        file_status_mapping = {}
+    def plan_verify_hash(self, fnmatches, file_mapping):
+        """
+        Returns the pieces to verify for files matching fnmatches and the
+        (path, offset, length) segments of the pieces that can be read.
+        """
+        pieces_to_verify = set()
         for torrent_file in self.filelist:
+            piece_calculation = self.piece_calculations[torrent_file.path]
             for pattern in fnmatches:
                 if fnmatch(torrent_file.path.name, pattern):
-                    piece_calculation = torrent_file.pieces.calculate_offsets(
-                        torrent_file.size, is_last_file=torrent_file.is_last_file
+                    pieces_to_verify |= set(
+                        range(
+                            piece_calculation.start_piece,
+                            piece_calculation.end_piece + 1,
+                        )
                     )
+                    break
+
+        _, piece_segments, _ = self._walk_piece_reads(file_mapping, pieces_to_verify)
+        return pieces_to_verify, piece_segments
+
+    def verify_hash(
+        self, fnmatches, file_mapping, workers=None, io_budget=None, piece_cache=None
+    ):
+        """Returns a torrent_file mapping of failed and successful matched files"""
+        pieces_to_verify, piece_segments = self.plan_verify_hash(
+            fnmatches, file_mapping
+        )
+        piece_results = hash_pieces(
+            piece_segments,
+            self.pieces,
+            workers=workers,
+            io_budget=io_budget,
+            piece_cache=piece_cache,
+        )
+        return self.verify_hash_results(
+            fnmatches, file_mapping, pieces_to_verify, piece_results
+        )
+
+    def verify_hash_results(
+        self, fnmatches, file_mapping, pieces_to_verify, piece_results
+    ):
+        """Turn hashed piece results into a torrent_file mapping of failed and successful matched files"""
+        piece_status, _, file_piece_mapping = self._walk_piece_reads(
+            file_mapping, pieces_to_verify, piece_results=piece_results
+        )
+
+        file_has_inner_pieces = {}
+        for torrent_file in self.filelist:
+            piece_calculation = self.piece_calculations[torrent_file.path]
+            file_has_inner_pieces[torrent_file] = (
+                piece_calculation.first_complete_piece
+                <= piece_calculation.last_complete_piece
+            )
+
+        file_status_mapping = {}
+        for torrent_file in self.filelist:
+            for pattern in fnmatches:
+                if fnmatch(torrent_file.path.name, pattern):
+                    piece_calculation = self.piece_calculations[torrent_file.path]
 
                     inner_piece_status = [
                         piece_status.get(p)
@@ -524,9 +854,7 @@ class Torrent(
         for torrent_file in self.filelist:
             # if hash-failed or any pieces are failed, then it is touch-failed
             # if any of the files in any of the pieces are missing, then it is touched-success
-            piece_calculation = torrent_file.pieces.calculate_offsets(
-                torrent_file.size, is_last_file=torrent_file.is_last_file
-            )
+            piece_calculation = self.piece_calculations[torrent_file.path]
             file_piece_results = {
                 piece_status[p]
                 for p in range(
@@ -544,6 +872,25 @@ class Torrent(
 
         return file_status_mapping, file_touch_status_mapping
 
+    def filelist_fingerprint(self, include_piece_hashes=True):
+        """
+        Fingerprint the filelist of the torrent. Cross-seeds of the same data
+        from different trackers share the fingerprint even though the infohash differs.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(
+            json.dumps(
+                [
+                    self.piece_length,
+                    include_piece_hashes,
+                    [[list(f.path.parts), f.size] for f in self.filelist],
+                ]
+            ).encode()
+        )
+        if include_piece_hashes:
+            hasher.update(self.pieces.data)
+        return hasher.hexdigest()
+
     def has_file_patterns(self, patterns):
         for torrent_file in self.filelist:
             for pattern in patterns:
@@ -625,7 +972,13 @@ def parse_torrent(
                 trackers.append(trackers)
     trackers = [t for t in trackers if t]
     return Torrent(
-        name, length, info[b"piece length"], filelist, filelist_mapped, trackers
+        name,
+        length,
+        info[b"piece length"],
+        filelist,
+        filelist_mapped,
+        trackers,
+        pieces.pieces,
     )
 
 
@@ -691,6 +1044,7 @@ def create_link_path(
     chown_str=None,
     dry_run=False,
     skip_store_metadata=False,
+    rewriter=None,
 ):
     kwargs = {
         "client": client_name,
@@ -729,11 +1083,14 @@ def create_link_path(
         link_path.parent.mkdir(exist_ok=True, parents=True)
         if action == "link" or action == "cache_link":
             if rw_cache and action == "cache_link":
-                actual_path = rw_cache.cache_file(actual_path, link_path, link_type)
+                actual_path = rw_cache.cache_file(
+                    actual_path, link_path, link_type, rewriter=rewriter
+                )
 
             create_link(actual_path, link_path, link_type)
         elif action == "copy":
-            shutil.copyfile(actual_path, link_path)
+            read_path = rewriter and rewriter.read_path(actual_path) or actual_path
+            shutil.copyfile(read_path, link_path)
 
     if chown_str:
         chown(chown_str, data_store_path)
@@ -867,6 +1224,55 @@ def humanize_bytes(
     return "%.*f %s" % (precision, bytes / factor, suffix)
 
 
+def humanize_duration(seconds):
+    """Return a duration as hours, minutes and seconds.
+    >>> humanize_duration(3723.4)
+    '1h02m03s'
+    >>> humanize_duration(59)
+    '59s'
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02}m{seconds:02}s"
+    if minutes:
+        return f"{minutes}m{seconds:02}s"
+    return f"{seconds}s"
+
+
+def bitfield_to_bytes(bitfield):
+    """Pack a list of booleans into bytes, the first piece is the highest bit."""
+    packed = bytearray((len(bitfield) + 7) // 8)
+    for piece_index, have in enumerate(bitfield):
+        if have:
+            packed[piece_index // 8] |= 1 << (7 - piece_index % 8)
+    return bytes(packed)
+
+
+def add_libtorrent_resume(torrent_data, torrent, data_path, have_pieces):
+    """
+    Add rtorrent resume data to torrent_data where only the pieces in have_pieces are done,
+    rtorrent then only checks and downloads the pieces that are not.
+    """
+    resume_files = []
+    for torrent_file in torrent.filelist:
+        resume_file = {
+            b"priority": 1,
+            b"completed": sum(
+                have_pieces[p] for p in torrent.file_pieces(torrent_file)
+            ),
+        }
+        full_path = data_path / torrent_file.path
+        if full_path.is_file():
+            resume_file[b"mtime"] = int(full_path.stat().st_mtime)
+        resume_files.append(resume_file)
+
+    torrent_data[b"libtorrent_resume"] = {
+        b"files": resume_files,
+        b"bitfield": bitfield_to_bytes(have_pieces),
+    }
+
+
 def add_status_formatter(status, torrent_path, message):
     status_specs = {
         "seeded": ["blue", "Seeded"],
@@ -874,6 +1280,7 @@ def add_status_formatter(status, torrent_path, message):
         "missing_files": ["red", "Missing"],
         "failed": ["magenta", "Failed"],
         "added": ["green", "Added"],
+        "verified": ["green", "Verified"],
     }
     status_spec = status_specs[status]
 
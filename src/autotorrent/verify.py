@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import time
+from collections import namedtuple
+
+from .hashing import hash_pieces
+
+logger = logging.getLogger(__name__)
+
+VERIFY_CHECKPOINT_SIZE = 2**30
+
+PIECE_UNVERIFIED = "?"
+PIECE_STATES = {True: "1", False: "0", None: "-"}
+PIECE_RESULTS = {state: result for (result, state) in PIECE_STATES.items()}
+
+VerifyProgress = namedtuple(
+    "VerifyProgress",
+    ["verified_pieces", "total_pieces", "bytes_hashed", "bytes_left", "elapsed"],
+)
+FileVerifyResult = namedtuple(
+    "FileVerifyResult", ["status", "ok_pieces", "failed_pieces", "missing_pieces"]
+)
+VerifyResult = namedtuple("VerifyResult", ["pieces", "files", "resumed_pieces"])
+
+
+def file_mapping_fingerprint(torrent, file_mapping):
+    """Fingerprint a file mapping together with size and mtime of the mapped files."""
+    mapping = []
+    for torrent_file in torrent.filelist:
+        full_path = file_mapping[torrent_file.path]
+        entry = [str(torrent_file.path), None, None, None]
+        if full_path:
+            try:
+                stat = full_path.stat()
+            except OSError:
+                pass
+            else:
+                entry[1:] = [str(full_path), stat.st_size, stat.st_mtime_ns]
+        mapping.append(entry)
+    return hashlib.sha1(json.dumps(mapping).encode()).hexdigest()
+
+
+def verify_torrent(
+    torrent,
+    infohash,
+    file_mapping,
+    db,
+    workers=None,
+    io_budget=None,
+    checkpoint_size=VERIFY_CHECKPOINT_SIZE,
+    restart=False,
+    progress=None,
+):
+    """
+    Verify every piece of a torrent against file_mapping.
+
+    The piece states are saved in the database every checkpoint_size bytes so an
+    interrupted verification of unchanged files resumes where it stopped.
+    Progress is called with a VerifyProgress after every checkpoint.
+
+    Returns a VerifyResult with the piece states as a string, 1 for a good piece,
+    0 for a bad piece and - for a piece that could not be read, and a
+    FileVerifyResult for every torrent file.
+    """
+    piece_count = len(torrent.pieces)
+    pieces_to_verify, piece_segments = torrent.plan_verify_hash(["*"], file_mapping)
+    mapping = file_mapping_fingerprint(torrent, file_mapping)
+
+    pieces = None
+    if not restart:
+        pieces = db.get_verify_progress(infohash, mapping)
+    if pieces is None or len(pieces) != piece_count:
+        pieces = PIECE_UNVERIFIED * piece_count
+    pieces = list(pieces)
+    resumed_pieces = piece_count - pieces.count(PIECE_UNVERIFIED)
+    if resumed_pieces:
+        logger.info(f"Resuming verification of {infohash} at {resumed_pieces} pieces")
+
+    for piece_index in range(piece_count):
+        if piece_index not in piece_segments:
+            pieces[piece_index] = PIECE_STATES[None]
+
+    pending_pieces = [
+        piece_index
+        for piece_index in sorted(piece_segments)
+        if pieces[piece_index] == PIECE_UNVERIFIED
+    ]
+    bytes_left = sum(
+        length
+        for piece_index in pending_pieces
+        for (_, _, length) in piece_segments[piece_index]
+    )
+    bytes_hashed = 0
+    start_time = time.monotonic()
+    chunk, chunk_size = [], 0
+    for i, piece_index in enumerate(pending_pieces):
+        chunk.append(piece_index)
+        chunk_size += sum(length for (_, _, length) in piece_segments[piece_index])
+        if chunk_size < checkpoint_size and i + 1 < len(pending_pieces):
+            continue
+
+        piece_results = hash_pieces(
+            {p: piece_segments[p] for p in chunk},
+            torrent.pieces,
+            workers=workers,
+            io_budget=io_budget,
+        )
+        for p, piece_result in piece_results.items():
+            pieces[p] = PIECE_STATES[piece_result]
+        db.save_verify_progress(infohash, mapping, "".join(pieces))
+
+        bytes_hashed += chunk_size
+        bytes_left -= chunk_size
+        chunk, chunk_size = [], 0
+        if progress:
+            progress(
+                VerifyProgress(
+                    piece_count - pieces.count(PIECE_UNVERIFIED),
+                    piece_count,
+                    bytes_hashed,
+                    bytes_left,
+                    time.monotonic() - start_time,
+                )
+            )
+
+    db.remove_verify_progress(infohash)
+
+    piece_results = {
+        piece_index: PIECE_RESULTS[state] for (piece_index, state) in enumerate(pieces)
+    }
+    file_status_mapping, _ = torrent.verify_hash_results(
+        ["*"], file_mapping, pieces_to_verify, piece_results
+    )
+
+    files = {}
+    for torrent_file in torrent.filelist:
+        file_pieces = [pieces[p] for p in torrent.file_pieces(torrent_file)]
+        if file_mapping[torrent_file.path]:
+            status = file_status_mapping[torrent_file]
+        else:
+            status = "missing"
+        files[torrent_file] = FileVerifyResult(
+            status,
+            file_pieces.count(PIECE_STATES[True]),
+            file_pieces.count(PIECE_STATES[False]),
+            file_pieces.count(PIECE_STATES[None]),
+        )
+
+    return VerifyResult("".join(pieces), files, resumed_pieces)
@@ -1,3 +1,4 @@
+import logging
 import shutil
 from pathlib import Path, PurePosixPath
 
@@ -23,6 +24,7 @@ __all__ = [
     "rewriter",
     "testfiles",
     "configfile",
+    "no_live_logging",
 ]
 
 
@@ -74,6 +76,14 @@ class ConfigFile:
         self.config_path.write_text(toml.dumps(self.config))
 
 
+@pytest.fixture
+def no_live_logging():
+    # live logging swaps stdout back while CliRunner.invoke captures the output
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
 @pytest.fixture
 def configfile(tmp_path, monkeypatch, client):
     monkeypatch.setattr(click, "get_app_dir", lambda app: str(tmp_path.resolve()))
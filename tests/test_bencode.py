@@ -0,0 +1,46 @@
+import hashlib
+
+import pytest
+from libtc import BTFailure, bdecode, bencode
+
+from autotorrent.bencode import bdecode_torrent
+from autotorrent.utils import parse_torrent
+
+from .fixtures import *
+
+
+@pytest.mark.parametrize(
+    "torrent_name",
+    ["test.torrent", "test_single.torrent", "Some-Release.torrent", "My-Bluray.torrent"],
+)
+def test_bdecode_torrent_same_as_libtc(testfiles, torrent_name):
+    data = (testfiles / torrent_name).read_bytes()
+    torrent_data, torrent_info = bdecode_torrent(data)
+    libtc_torrent_data = bdecode(data)
+
+    assert isinstance(torrent_data[b"info"][b"pieces"], memoryview)
+    torrent_data[b"info"][b"pieces"] = bytes(torrent_data[b"info"][b"pieces"])
+    assert torrent_data == libtc_torrent_data
+    assert (
+        hashlib.sha1(torrent_info).hexdigest()
+        == hashlib.sha1(bencode(libtc_torrent_data[b"info"])).hexdigest()
+    )
+
+
+def test_bdecode_torrent_non_canonical_info(testfiles):
+    info = b"d4:name4:test12:piece lengthi16384e6:pieces20:" + b"a" * 20 + b"6:lengthi10ee"
+    torrent_data, torrent_info = bdecode_torrent(b"d4:info" + info + b"e")
+    assert bytes(torrent_info) == info
+    assert hashlib.sha1(torrent_info).digest() == hashlib.sha1(info).digest()
+    assert parse_torrent(torrent_data).size == 10
+    torrent_data[b"info"][b"pieces"] = bytes(torrent_data[b"info"][b"pieces"])
+    assert hashlib.sha1(torrent_info).digest() != hashlib.sha1(bencode(torrent_data[b"info"])).digest()
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"", b"d4:info", b"d4:infoi01ee", b"d4:info5:abcde", b"de trailing", b"l4:infoe", b"d4:info99:ae"],
+)
+def test_bdecode_torrent_invalid(data):
+    with pytest.raises(BTFailure):
+        bdecode_torrent(data)
@@ -1,11 +1,19 @@
+import hashlib
+import json
+from datetime import datetime
+
+import click
 import pytest
 
 import libtc
 
 from click.testing import CliRunner
-from libtc import bdecode, bencode
+from libtc import TorrentData, TorrentState, bdecode, bencode
 from pathlib import Path
 
+import autotorrent.__main__
+import autotorrent.matcher
+from autotorrent.bencode import bdecode_torrent
 from autotorrent.__main__ import cli
 
 from .fixtures import *
@@ -246,3 +254,371 @@ def test_cli_scan_single_file(testfiles, indexer, matcher, client, configfile, t
     runner = CliRunner()
     result = runner.invoke(cli, ['scan', '-p', str(testfiles / 'file_b.txt')], catch_exceptions=False)
     assert result.exit_code == 0
+
+
+def test_cli_idle_io_priority(testfiles, indexer, matcher, client, configfile, tmp_path, monkeypatch):
+    configfile.config["autotorrent"]["io_idle_priority"] = True
+    configfile.save_config()
+    calls = []
+    monkeypatch.setattr(autotorrent.__main__, "set_idle_io_priority", lambda: calls.append(True))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['ls', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not calls
+
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert calls == [True]
+
+
+def test_cli_invalid_hash_probe_confidence(configfile):
+    configfile.config["autotorrent"]["hash_probe_confidence"] = "very high"
+    configfile.save_config()
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['ls'], catch_exceptions=False)
+    assert result.exit_code == 1
+    assert "Unknown hash probe confidence 'very high'" in result.output
+
+
+def test_cli_add_cached_match(testfiles, indexer, matcher, client, configfile, tmp_path, monkeypatch, no_live_logging):
+    configfile.config["autotorrent"]["cache_matches"] = True
+    configfile.save_config()
+
+    torrent_data = bdecode((testfiles / "test.torrent").read_bytes())
+    torrent_data[b"info"][b"source"] = b"other-tracker"
+    (testfiles / "test-other.torrent").write_bytes(bencode(torrent_data))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Added' in result.output
+
+    def match_files_dynamic(*args, **kwargs):
+        raise Exception("Matcher should not be used for cached matches")
+
+    monkeypatch.setattr(autotorrent.matcher.Matcher, "match_files_dynamic", match_files_dynamic)
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test-other.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Added' in result.output
+    action, kwargs = client._action_queue[1]
+    assert action == "add"
+    assert (kwargs["destination_path"] / "testfiles" / "file_a.txt").exists()
+
+    (testfiles / "file_a.txt").write_bytes(b"changed")
+    (testfiles / "test-other.torrent").rename(testfiles / "test-third.torrent")
+    with pytest.raises(Exception, match="Matcher should not be used"):
+        runner.invoke(cli, ['add', 'testclient', str(testfiles / "test-third.torrent")], catch_exceptions=False)
+
+
+def test_cli_add_unmatched_backlog(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    (testfiles / "file_c.txt").rename(tmp_path / "file_c.txt")
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Missing' in result.output
+    assert not client._action_queue
+
+    result = runner.invoke(cli, ['add-unmatched', 'testclient'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'No unmatched torrents' in result.output
+
+    (tmp_path / "file_c.txt").rename(testfiles / "file_c.txt")
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['add-unmatched', 'testclient'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Added' in result.output
+    action, kwargs = client._action_queue[0]
+    assert action == "add"
+
+    result = runner.invoke(cli, ['add-unmatched', 'testclient', '--all'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'No unmatched torrents' in result.output
+
+
+def test_cli_add_unmatched_backlog_replaced_file(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    configfile.config["autotorrent"]["paths"] = [str(testfiles)]
+    configfile.save_config()
+    (testfiles / "file_c.txt").rename(tmp_path / "file_c.txt")
+    (testfiles / "extra.txt").write_bytes(b"x" * 11)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan'], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Missing' in result.output
+
+    result = runner.invoke(cli, ['scan'], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add-unmatched', 'testclient'], catch_exceptions=False)
+    assert 'No unmatched torrents' in result.output
+
+    # same number of files with the needed size, but one of them is new
+    (testfiles / "extra.txt").unlink()
+    (tmp_path / "file_c.txt").rename(testfiles / "file_c.txt")
+    result = runner.invoke(cli, ['scan'], catch_exceptions=False)
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['add-unmatched', 'testclient'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Added' in result.output
+
+
+def test_cli_add_torrent_catalog(testfiles, indexer, matcher, client, configfile, tmp_path, monkeypatch, no_live_logging):
+    (testfiles / "file_c.txt").rename(tmp_path / "file_c.txt")
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Missing' in result.output
+
+    def failing_bdecode_torrent(data):
+        raise Exception("Unchanged torrents should not be decoded")
+
+    monkeypatch.setattr(autotorrent.__main__, "bdecode_torrent", failing_bdecode_torrent)
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Missing' in result.output
+    assert 'no files are scanned since last time' in result.output
+
+    with pytest.raises(Exception, match="should not be decoded"):
+        runner.invoke(cli, ['add', 'testclient', '--refresh', str(testfiles / "test.torrent")], catch_exceptions=False)
+
+    monkeypatch.setattr(autotorrent.__main__, "bdecode_torrent", bdecode_torrent)
+    (tmp_path / "file_c.txt").rename(testfiles / "file_c.txt")
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Added' in result.output
+
+
+def test_cli_verify(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['verify', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Verified' in result.output
+    assert '5/5 pieces ok' in result.output
+
+    (testfiles / 'file_c.txt').write_bytes(b'x' * 11)
+    result = runner.invoke(cli, ['verify', '--json', '-p', str(tmp_path), str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 1
+    verify_result = json.loads(result.output)
+    assert verify_result[0]['pieces'] == '11000'
+    assert [(f['path'], f['status']) for f in verify_result[0]['files']] == [
+        ('testfiles/file_a.txt', 'hash-success'),
+        ('testfiles/file_b.txt', 'hash-failed'),
+        ('testfiles/file_c.txt', 'hash-failed'),
+    ]
+
+
+@pytest.mark.parametrize("identifier", ["testclient", "rtorrent"])
+def test_cli_add_fast_resume_bitfield(testfiles, indexer, matcher, client, configfile, tmp_path, monkeypatch, identifier):
+    configfile.config["autotorrent"]["fast_resume"] = True
+    configfile.config["autotorrent"]["add_limit_percent"] = 50
+    configfile.save_config()
+    monkeypatch.setattr(client, "identifier", identifier)
+    (testfiles / "file_c.txt").unlink()
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    action, kwargs = client._action_queue[0]
+    assert action == "add"
+    assert not kwargs["fast_resume"]
+    if identifier == "rtorrent":
+        assert kwargs["torrent"][b"libtorrent_resume"][b"bitfield"] == bytes([0b11000000])
+        assert [f[b"completed"] for f in kwargs["torrent"][b"libtorrent_resume"][b"files"]] == [2, 1, 0]
+    else:
+        assert b"libtorrent_resume" not in kwargs["torrent"]
+
+
+def test_cli_add_fast_resume_complete(testfiles, indexer, matcher, client, configfile, tmp_path):
+    configfile.config["autotorrent"]["fast_resume"] = True
+    configfile.save_config()
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    action, kwargs = client._action_queue[0]
+    assert kwargs["fast_resume"]
+    assert b"libtorrent_resume" not in kwargs["torrent"]
+
+
+def test_cli_scrub(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    configfile.config["autotorrent"]["scrub_days"] = 2
+    configfile.save_config()
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['add', 'testclient', str(testfiles / "test.torrent")], catch_exceptions=False)
+    assert result.exit_code == 0
+    action, kwargs = client._action_queue[0]
+
+    result = runner.invoke(cli, ['scrub'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'of 0 seeded torrents' in result.output
+
+    torrent_data, torrent_info = bdecode_torrent((testfiles / "test.torrent").read_bytes())
+    client._inject_torrent(
+        TorrentData(hashlib.sha1(torrent_info).hexdigest(), "test", 33, TorrentState.ACTIVE, 100, 1000, datetime(2020, 1, 1, 1, 1), "example.com", 0, 0, None),
+        [],
+        kwargs["destination_path"],
+    )
+
+    result = runner.invoke(cli, ['scrub'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Verified 3 pieces in 1 torrent,' in result.output
+    assert 'is scrubbed' not in result.output
+
+    result = runner.invoke(cli, ['scrub'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Verified 2 pieces in 1 torrent,' in result.output
+    assert 'is scrubbed, 0 bad and 0 unreadable pieces' in result.output
+
+    (testfiles / 'file_a.txt').write_bytes(b'x' * 11)
+    result = runner.invoke(cli, ['scrub'], catch_exceptions=False)
+    assert result.exit_code == 1
+    assert 'has 2 bad and 0 unreadable pieces' in result.output
+
+
+def test_cli_ls_from_index(testfiles, indexer, matcher, client, configfile, tmp_path):
+    runner = CliRunner()
+    result = runner.invoke(cli, ['ls', '--from-index', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'files last scanned: never, clients last scanned: never' in result.output
+    assert 'No files in the index' in result.output
+
+    result = runner.invoke(cli, ['scan', '-p', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['ls', '--from-index', '--summary', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'clients last scanned: never' in result.output
+    assert 'files last scanned: never' not in result.output
+    assert 'No files in the index' not in result.output
+    assert f'[  0%] {testfiles}' in result.output
+
+    result = runner.invoke(cli, ['find-unseeded', '--from-index', str(testfiles)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert f'{testfiles}\n' in result.output
+
+
+def test_cli_ls_from_index_depth(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    data_path = tmp_path / 'data'
+    for fn in ['a/x/f1', 'a/x/f2', 'b/f3', 'b/y/f4', 'c/z/f5', 'f6']:
+        (data_path / fn).parent.mkdir(parents=True, exist_ok=True)
+        (data_path / fn).write_bytes(b'a' * 100)
+    client._inject_torrent(
+        TorrentData(
+            'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+            'data',
+            300,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            'example.com',
+            0,
+            0,
+            None,
+        ),
+        [libtc.TorrentFile(fn, 100, 100) for fn in ['a/x/f1', 'a/x/f2', 'b/f3']],
+        data_path,
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan', '-p', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ['scan-clients'], catch_exceptions=False)
+    assert result.exit_code == 0
+
+    # the files are not looked at, not even to list the directories
+    data_path.rename(tmp_path / 'moved')
+    result = runner.invoke(cli, ['ls', '-d', '2', '--from-index', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert sorted(l for l in click.unstyle(result.output).splitlines() if l.startswith('[')) == [
+        f'[  0%] {data_path / "b" / "y"}',
+        f'[  0%] {data_path / "c" / "z"}',
+        f'[  0%] {data_path / "f6"}',
+        f'[100%] {data_path / "a" / "x"}',
+        f'[100%] {data_path / "b" / "f3"}',
+    ]
+
+    result = runner.invoke(cli, ['ls', '-d', '2', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 2
+    assert 'does not exist' in result.output
+
+
+def test_cli_ls_depth_find_unseeded(testfiles, indexer, matcher, client, configfile, tmp_path, no_live_logging):
+    data_path = tmp_path / 'data'
+    for fn in ['a/x/f1', 'a/x/f2', 'b/f3', 'b/y/f4', 'c/z/f5', 'f6']:
+        (data_path / fn).parent.mkdir(parents=True, exist_ok=True)
+        (data_path / fn).write_bytes(b'a' * 100)
+    client._inject_torrent(
+        TorrentData(
+            'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+            'data',
+            300,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            'example.com',
+            0,
+            0,
+            None,
+        ),
+        [libtc.TorrentFile(fn, 100, 100) for fn in ['a/x/f1', 'a/x/f2', 'b/f3']],
+        data_path,
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scan-clients'], catch_exceptions=False)
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['ls', '-d', '1', '--summary', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert sorted(click.unstyle(result.output).splitlines()[:4]) == [
+        f'[  0%] {data_path / "c"}',
+        f'[  0%] {data_path / "f6"}',
+        f'[ 50%] {data_path / "b"}',
+        f'[100%] {data_path / "a"}',
+    ]
+    assert 'Number of paths: 4' in result.output
+    assert 'Total size 600.0 bytes' in result.output
+
+    result = runner.invoke(cli, ['ls', '-d', '2', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert sorted(click.unstyle(result.output).splitlines()) == [
+        f'[  0%] {data_path / "b" / "y"}',
+        f'[  0%] {data_path / "c" / "z"}',
+        f'[  0%] {data_path / "f6"}',
+        f'[100%] {data_path / "a" / "x"}',
+        f'[100%] {data_path / "b" / "f3"}',
+    ]
+
+    result = runner.invoke(cli, ['find-unseeded', str(data_path)], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert sorted(result.output.splitlines()) == [
+        str(data_path / 'b' / 'y'),
+        str(data_path / 'c'),
+        str(data_path / 'f6'),
+    ]
@@ -0,0 +1,58 @@
+from pathlib import PurePosixPath
+
+from libtc import bdecode
+
+import autotorrent.iobudget
+from autotorrent.iobudget import IOBudget
+from autotorrent.utils import parse_torrent
+
+from .fixtures import *
+
+
+def test_io_budget_throttles_read_rate(monkeypatch):
+    now = [100.0]
+    sleeps = []
+    monkeypatch.setattr(autotorrent.iobudget.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(autotorrent.iobudget.time, "sleep", sleeps.append)
+
+    io_budget = IOBudget(max_read_rate=1000)
+    io_budget.consume(1000)
+    assert sleeps == []
+
+    io_budget.consume(500)
+    assert sleeps == [0.5]
+
+    now[0] += 10
+    io_budget.consume(1000)
+    assert sleeps == [0.5]
+    assert io_budget.bytes_read == 2500
+    assert io_budget.throttled_time == 0.5
+
+
+def test_io_budget_limits_workers():
+    assert IOBudget().limit_workers(4) == 4
+    assert IOBudget(max_concurrent_reads=2).limit_workers(4) == 2
+
+
+def test_io_budget_counts_hash_verification(testfiles):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    io_budget = IOBudget()
+    hash_result, _ = torrent.verify_hash(['*'], {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): testfiles / 'file_b.txt',
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }, io_budget=io_budget)
+    assert set(hash_result.values()) == {'hash-success'}
+    assert io_budget.bytes_read == torrent.size
+
+
+def test_io_budget_copyfile(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotorrent.iobudget.time, "sleep", lambda delay: None)
+    src = tmp_path / "src"
+    src.write_bytes(b"x" * 3000)
+    for max_read_rate in (0, 1000):
+        io_budget = IOBudget(max_read_rate=max_read_rate)
+        dst = tmp_path / f"dst_{max_read_rate}"
+        io_budget.copyfile(src, dst)
+        assert dst.read_bytes() == src.read_bytes()
+        assert io_budget.bytes_read == 3000
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import shutil
 from datetime import datetime
 from pathlib import Path, PurePosixPath
@@ -6,6 +8,9 @@ import pytest
 from libtc import TorrentData, TorrentFile, TorrentState, bdecode
 
 from .fixtures import *
+from autotorrent.hashing import find_holes
+from autotorrent.indexer import Indexer
+from autotorrent.utils import PathRewriter, Pieces, create_link_path, parse_torrent
 
 
 def test_scan_match_exact_client(testfiles, indexer, matcher, client):
@@ -631,3 +636,247 @@ def test_scan_ignore_patterns(testfiles, indexer, matcher, client):
         matcher.match_files_exact(bdecode((testfiles / "test.torrent").read_bytes()))
         is None
     )
+
+
+def test_scan_match_dynamic_unsplitable_stops_on_perfect_match(
+    testfiles, indexer, matcher, client, monkeypatch
+):
+    shutil.copytree(testfiles / "Some-Release", testfiles / "copy" / "Some-Release")
+    indexer.scan_paths([testfiles])
+
+    evaluated_files = []
+    match_best_file = matcher._match_best_file
+
+    def counting_match_best_file(torrent, torrent_file, searched_files, **kwargs):
+        evaluated_files.append(torrent_file.path)
+        return match_best_file(torrent, torrent_file, searched_files, **kwargs)
+
+    monkeypatch.setattr(matcher, "_match_best_file", counting_match_best_file)
+
+    result = matcher.match_files_dynamic(
+        bdecode((testfiles / "Some-Release.torrent").read_bytes()), hash_probe=True
+    )
+    assert result.success
+    assert len(result.matched_files) == 13
+    assert all(result.matched_files.values())
+    assert len(evaluated_files) == 13
+
+
+def test_scan_match_parsed_torrent(testfiles, indexer, matcher, client):
+    indexer.scan_paths([testfiles])
+
+    torrent_data = bdecode((testfiles / "Some-Release.torrent").read_bytes())
+    torrent = parse_torrent(torrent_data)
+    assert matcher.match_files_exact(torrent) == testfiles
+    assert matcher.match_files_dynamic(torrent) == matcher.match_files_dynamic(
+        torrent_data
+    )
+    assert torrent.unsplitable_roots == {("Some-Release",)}
+    assert torrent.unsplitable_roots is torrent.unsplitable_roots
+
+
+def test_scan_match_first_piece_hash_index(tmp_path, db, matcher, monkeypatch):
+    piece_length = 2**18
+    data = bytes(range(256)) * 1200
+    data_path = tmp_path / "data"
+    (data_path / "a").mkdir(parents=True)
+    (data_path / "b").mkdir()
+    (data_path / "a" / "other.bin").write_bytes(data[::-1])
+    (data_path / "b" / "other.bin").write_bytes(data)
+    torrent = {
+        b"info": {
+            b"name": b"movie.bin",
+            b"piece length": piece_length,
+            b"length": len(data),
+            b"pieces": b"".join(
+                hashlib.sha1(data[i : i + piece_length]).digest()
+                for i in range(0, len(data), piece_length)
+            ),
+        }
+    }
+
+    indexer = Indexer(db, first_piece_hash_min_size=1)
+    indexer.scan_paths([data_path])
+    assert db.db.execute("SELECT COUNT(*) FROM first_piece_hashes").fetchone()[0] == 2
+
+    def failing_probe_hash(*args, **kwargs):
+        raise Exception("Files with a first piece hash should not be probed")
+
+    def failing_get_first_piece_hashes(*args, **kwargs):
+        raise Exception("Digest index should have found the match")
+
+    monkeypatch.setattr(Pieces, "probe_hash", failing_probe_hash)
+    monkeypatch.setattr(db, "get_first_piece_hashes", failing_get_first_piece_hashes)
+    result = matcher.match_files_dynamic(torrent, match_hash_size=True)
+    assert result.matched_files == {
+        PurePosixPath("movie.bin"): data_path / "b" / "other.bin",
+    }
+
+    monkeypatch.undo()
+    (data_path / "b" / "other.bin").unlink()
+    indexer.scan_paths([data_path])
+    monkeypatch.setattr(Pieces, "probe_hash", failing_probe_hash)
+    result = matcher.match_files_dynamic(torrent, match_hash_size=True)
+    assert not result.success
+
+
+def test_scan_match_fingerprint_clusters(tmp_path, db, matcher, monkeypatch):
+    piece_length = 2**14
+    data = bytes(range(256)) * 160
+    data_path = tmp_path / "data"
+    for name in ["a", "b", "c"]:
+        (data_path / name).mkdir(parents=True)
+    (data_path / "a" / "other.bin").write_bytes(b"\x00" * len(data))
+    (data_path / "b" / "other.bin").write_bytes(b"\x00" * len(data))
+    (data_path / "c" / "other.bin").write_bytes(data)
+    torrent = {
+        b"info": {
+            b"name": b"movie.bin",
+            b"piece length": piece_length,
+            b"length": len(data),
+            b"pieces": b"".join(
+                hashlib.sha1(data[i : i + piece_length]).digest()
+                for i in range(0, len(data), piece_length)
+            ),
+        }
+    }
+
+    indexer = Indexer(db, fingerprint_min_size=1)
+    indexer.scan_paths([data_path])
+    fingerprints = {
+        f.path.name: f.fingerprint for f in db.search_file(size=len(data))
+    }
+    assert fingerprints["a"] == fingerprints["b"] != fingerprints["c"]
+
+    probed_paths = []
+    original_probe_hash = Pieces.probe_hash
+
+    def probe_hash(self, size, fp, **kwargs):
+        probed_paths.append(fp.name)
+        return original_probe_hash(self, size, fp, **kwargs)
+
+    monkeypatch.setattr(Pieces, "probe_hash", probe_hash)
+    result = matcher.match_files_dynamic(torrent, match_hash_size=True)
+    assert result.matched_files == {
+        PurePosixPath("movie.bin"): data_path / "c" / "other.bin",
+    }
+    assert len(probed_paths) == 2
+
+    # fingerprints are kept when unchanged files are scanned again
+    db.db.execute("UPDATE files SET fingerprint = 'kept' WHERE path LIKE '%a'")
+    (data_path / "b" / "other.bin").write_bytes(data)
+    indexer.scan_paths([data_path])
+    fingerprints = {
+        f.path.name: f.fingerprint for f in db.search_file(size=len(data))
+    }
+    assert fingerprints["a"] == "kept"
+    assert fingerprints["b"] == fingerprints["c"]
+
+
+def test_scan_match_sparse_files(tmp_path, db, matcher, monkeypatch):
+    piece_length = 2**16
+    data = hashlib.sha1(b"sparse").digest() * (2**18 // 20) + b"end"
+    data_path = tmp_path / "data"
+    for name in ["a", "b", "c"]:
+        (data_path / name).mkdir(parents=True)
+    with (data_path / "a" / "movie.bin").open("wb") as f:
+        f.write(data[:4096])
+        f.truncate(len(data))
+    if not find_holes(data_path / "a" / "movie.bin", len(data)):
+        pytest.skip("Filesystem does not report holes")
+    fd = os.open(data_path / "b" / "movie.bin", os.O_RDWR | os.O_CREAT)
+    try:
+        os.posix_fallocate(fd, 0, len(data))
+    finally:
+        os.close(fd)
+    (data_path / "c" / "movie.bin").write_bytes(data)
+    torrent = {
+        b"info": {
+            b"name": b"movie.bin",
+            b"piece length": piece_length,
+            b"length": len(data),
+            b"pieces": b"".join(
+                hashlib.sha1(data[i : i + piece_length]).digest()
+                for i in range(0, len(data), piece_length)
+            ),
+        }
+    }
+
+    indexer = Indexer(db)
+    indexer.scan_paths([data_path])
+    hole_sizes = {f.path.name: f.hole_size for f in db.search_file(size=len(data))}
+    assert hole_sizes["a"] > 0
+    assert hole_sizes["c"] == 0
+
+    probed_paths = []
+    original_probe_hash = Pieces.probe_hash
+
+    def probe_hash(self, size, fp, **kwargs):
+        probed_paths.append(Path(fp.name).parent.name)
+        return original_probe_hash(self, size, fp, **kwargs)
+
+    monkeypatch.setattr(Pieces, "probe_hash", probe_hash)
+    result = matcher.match_files_dynamic(torrent, hash_probe=True)
+    assert result.matched_files == {
+        PurePosixPath("movie.bin"): data_path / "c" / "movie.bin",
+    }
+    assert probed_paths == ["c"]
+
+    (data_path / "c" / "movie.bin").unlink()
+    indexer.scan_paths([data_path])
+    result = matcher.match_files_dynamic(torrent, hash_probe=True)
+    assert not result.success
+    assert probed_paths == ["c"]
+
+
+def test_path_rewriter_read_path(tmp_path):
+    local_path, fuse_path = tmp_path / 'local', tmp_path / 'fuse'
+    for path in [local_path, fuse_path]:
+        (path / 'release').mkdir(parents=True)
+        (path / 'release' / 'file.mkv').write_bytes(b'data')
+    (fuse_path / 'release' / 'other.mkv').write_bytes(b'data')
+    (fuse_path / 'release' / 'changed.mkv').write_bytes(b'data')
+    (local_path / 'release' / 'changed.mkv').write_bytes(b'more data')
+    rewriter = PathRewriter([[str(fuse_path), str(local_path)]], mount_types={
+        '/': 'ext4',
+        str(fuse_path): 'fuse.rar2fs',
+    })
+
+    assert rewriter.read_path(fuse_path / 'release' / 'file.mkv') == local_path / 'release' / 'file.mkv'
+    assert rewriter.read_path(local_path / 'release' / 'file.mkv') == local_path / 'release' / 'file.mkv'
+    assert rewriter.read_path(fuse_path / 'release' / 'other.mkv') == fuse_path / 'release' / 'other.mkv'
+    assert rewriter.read_path(fuse_path / 'release' / 'changed.mkv') == fuse_path / 'release' / 'changed.mkv'
+    assert rewriter.read_path(tmp_path / 'elsewhere' / 'file.mkv') == tmp_path / 'elsewhere' / 'file.mkv'
+    assert rewriter.rewrite_path(Path('/'), prefix_match=True) == [Path('/')]
+
+
+def test_create_link_path_read_path(tmp_path):
+    local_path, fuse_path = tmp_path / 'local', tmp_path / 'fuse'
+    for path in [local_path, fuse_path]:
+        (path / 'release').mkdir(parents=True)
+        (path / 'release' / 'file.mkv').write_bytes(b'data')
+        (path / 'release' / 'file.nfo').write_bytes(b'info')
+    rewriter = PathRewriter([[str(fuse_path), str(local_path)]], mount_types={
+        '/': 'ext4',
+        str(fuse_path): 'fuse.rar2fs',
+    })
+    read_paths = []
+    read_path = rewriter.read_path
+    rewriter.read_path = lambda path: read_paths.append(path) or read_path(path)
+
+    result = create_link_path(
+        str(tmp_path / 'store' / '{torrent_name}'),
+        {
+            PurePosixPath('release/file.mkv'): ('link', fuse_path / 'release' / 'file.mkv'),
+            PurePosixPath('release/file.nfo'): ('copy', fuse_path / 'release' / 'file.nfo'),
+        },
+        'testclient',
+        Path('release.torrent'),
+        {},
+        'soft',
+        skip_store_metadata=True,
+        rewriter=rewriter,
+    )
+    assert read_paths == [fuse_path / 'release' / 'file.nfo']
+    assert (result.data_path / 'release' / 'file.mkv').resolve() == fuse_path / 'release' / 'file.mkv'
+    assert (result.data_path / 'release' / 'file.nfo').read_bytes() == b'info'
@@ -630,4 +630,283 @@ def test_hardlink(tmp_path, indexer, matcher, client, client2, client3, include_
     assert map_result.total_size == 1000
     assert len(map_result.files) == 2
     for f, mf in map_result.files.items():
-        assert len(mf.clients) == 1
\ No newline at end of file
+        assert len(mf.clients) == 1
+
+def test_hardlink_stored_device(tmp_path, db, indexer, matcher, client):
+    indexer.include_inodes = True
+    matcher.include_inodes = True
+    infohash = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+    download_path = tmp_path / "test torrent 1"
+    download_path.mkdir()
+    (download_path / "file1").write_bytes(b"a" * 400)
+    client._inject_torrent(
+        TorrentData(
+            infohash,
+            "test torrent 1",
+            400,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            "example.com",
+            0,
+            0,
+            None,
+        ),
+        [TorrentFile("file1", 400, 100)],
+        download_path,
+    )
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+
+    hardlink_path = tmp_path / "hardlinked"
+    hardlink_path.mkdir()
+    (hardlink_path / "file1").hardlink_to(download_path / "file1")
+    indexer.scan_paths([hardlink_path])
+
+    stat = (hardlink_path / "file1").stat()
+    assert (stat.st_dev, stat.st_ino) in db.get_seeded_inodes()
+    assert db.db.execute("SELECT dev, inode FROM files").fetchall() == [
+        (stat.st_dev, stat.st_ino)
+    ]
+
+    (download_path / "file1").rename(download_path / "file1.moved")
+    map_result = matcher.map_path_to_clients(hardlink_path)
+    assert map_result.seeded_size == 0
+    assert map_result.indirect_seeded_size == 400
+
+
+def test_hardlink_unknown_device(tmp_path, db, indexer, matcher, client):
+    indexer.include_inodes = True
+    matcher.include_inodes = True
+    infohash = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+    download_path = tmp_path / "test torrent 1"
+    download_path.mkdir()
+    (download_path / "file1").write_bytes(b"a" * 400)
+    (download_path / "file2").write_bytes(b"a" * 600)
+    client._inject_torrent(
+        TorrentData(
+            infohash,
+            "test torrent 1",
+            1000,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            "example.com",
+            0,
+            0,
+            None,
+        ),
+        [TorrentFile("file1", 400, 100), TorrentFile("file2", 600, 100)],
+        download_path,
+    )
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+    db.db.execute("UPDATE client_torrentfiles SET dev = NULL")
+    db.commit()
+
+    hardlink_path = tmp_path / "hardlinked"
+    hardlink_path.mkdir()
+    (hardlink_path / "file1").hardlink_to(download_path / "file1")
+    (hardlink_path / "file2").hardlink_to(download_path / "file2")
+    (download_path / "file2").unlink()
+
+    map_result = matcher.map_path_to_clients(hardlink_path)
+    assert map_result.seeded_size == 0
+    assert map_result.indirect_seeded_size == 400
+    assert map_result.files[hardlink_path / "file1"].indirect_clients == [
+        ("test_client", infohash)
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_map_paths_to_clients(tmp_path, indexer, matcher, client, workers):
+    indexer.include_inodes = True
+    matcher.include_inodes = True
+    infohash = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+    download_path = tmp_path / "test torrent 1"
+    files = []
+    for i in range(12):
+        fp = download_path / f"dir{i % 3}" / f"sub{i % 2}" / f"file{i}"
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fp.write_bytes(b"a" * (i + 1) * 10)
+        files.append(TorrentFile(str(fp.relative_to(download_path)), (i + 1) * 10, 100))
+    client._inject_torrent(
+        TorrentData(
+            infohash,
+            "test torrent 1",
+            780,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            "example.com",
+            0,
+            0,
+            None,
+        ),
+        files[:8],
+        download_path,
+    )
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+
+    (download_path / "dir0" / "hardlinked").hardlink_to(
+        download_path / "dir0" / "sub0" / "file0"
+    )
+    (tmp_path / "symlinked").symlink_to(download_path / "dir1")
+    (tmp_path / "loop").mkdir()
+    (tmp_path / "loop" / "loop").symlink_to(tmp_path / "loop")
+
+    paths = [
+        download_path,
+        download_path / "dir0",
+        tmp_path / "symlinked",
+        download_path / "dir2" / "sub1" / "file11",
+        tmp_path / "loop",
+    ]
+    map_results = list(matcher.map_paths_to_clients(paths, workers=workers))
+    assert map_results == [matcher.map_path_to_clients(p) for p in paths]
+
+    assert map_results[0].total_size == 790
+    assert map_results[0].seeded_size == 360
+    assert map_results[0].indirect_seeded_size == 10
+    hardlinked = map_results[0].files[download_path / "dir0" / "hardlinked"]
+    assert hardlinked.clients == []
+    assert hardlinked.indirect_clients == [("test_client", infohash)]
+    assert map_results[1].indirect_seeded_size == 10
+    assert map_results[2].total_size == 260
+    assert map_results[2].seeded_size == 0
+    assert map_results[2].indirect_seeded_size == 150
+    assert map_results[3].total_size == 120
+    assert map_results[3].seeded_size == 0
+    assert map_results[4].total_size == 0
+
+
+@pytest.mark.parametrize("include_inodes", [False, True])
+def test_map_path_from_index(tmp_path, db, indexer, matcher, client, include_inodes):
+    indexer.include_inodes = include_inodes
+    matcher.include_inodes = include_inodes
+    infohash = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+    data_path = tmp_path / "data"
+    download_path = data_path / "test torrent 1"
+    download_path.mkdir(parents=True)
+    (download_path / "file1").write_bytes(b"a" * 400)
+    (download_path / "file2").write_bytes(b"a" * 600)
+    (download_path / "file3").write_bytes(b"a" * 100)
+    client._inject_torrent(
+        TorrentData(
+            infohash,
+            "test torrent 1",
+            1000,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            "example.com",
+            0,
+            0,
+            None,
+        ),
+        [TorrentFile("file1", 400, 100), TorrentFile("file2", 600, 100)],
+        download_path,
+    )
+    hardlink_path = data_path / "hardlinked"
+    hardlink_path.mkdir()
+    (hardlink_path / "file1").hardlink_to(download_path / "file1")
+    (data_path / "test torrent 10").mkdir()
+    (data_path / "test torrent 10" / "file1").write_bytes(b"a" * 50)
+
+    assert db.get_scanned("files") is None
+    assert db.get_scanned("client_files") is None
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+    indexer.scan_paths([data_path])
+    assert db.get_scanned("files") is not None
+    assert db.get_scanned("client_files") is not None
+
+    for path in [
+        download_path,
+        hardlink_path,
+        download_path / "file1",
+        data_path / "test torrent 10",
+    ]:
+        assert matcher.map_path_to_clients_from_index(
+            path
+        ) == matcher.map_path_to_clients(path)
+
+    map_result = matcher.map_path_to_clients_from_index(data_path)
+    assert map_result.total_size == 1550
+    assert map_result.seeded_size == 1000
+    assert map_result.indirect_seeded_size == (include_inodes and 400 or 0)
+
+    map_result = matcher.map_path_to_clients_from_index(download_path)
+    assert map_result.total_size == 1100
+    assert map_result.seeded_size == 1000
+    assert sorted(map_result.files) == [
+        download_path / "file1",
+        download_path / "file2",
+        download_path / "file3",
+    ]
+
+    map_result = matcher.map_path_to_clients_from_index(hardlink_path)
+    assert map_result.indirect_seeded_size == (include_inodes and 400 or 0)
+
+    map_result = matcher.map_path_to_clients_from_index(tmp_path / "not scanned")
+    assert map_result.total_size == 0
+    assert map_result.files == {}
+
+
+def test_directory_sizes(tmp_path, db, indexer, matcher, client):
+    indexer.include_inodes = True
+    matcher.include_inodes = True
+    infohash = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+    data_path = tmp_path / "data"
+    download_path = data_path / "test torrent 1"
+    (download_path / "sub").mkdir(parents=True)
+    (download_path / "file1").write_bytes(b"a" * 400)
+    (download_path / "sub" / "file2").write_bytes(b"a" * 600)
+    (download_path / "sub" / "file3").write_bytes(b"a" * 100)
+    hardlink_path = data_path / "hardlinked"
+    hardlink_path.mkdir()
+    (hardlink_path / "file1").hardlink_to(download_path / "file1")
+    indexer.scan_paths([data_path])
+
+    def assert_directory_sizes(path, sizes):
+        map_result = matcher.map_path_to_clients_from_index(path)
+        assert (
+            map_result.total_size,
+            map_result.seeded_size,
+            map_result.indirect_seeded_size,
+        ) == sizes
+        assert matcher.map_directory_to_clients_from_index(path) == (*sizes, {})
+
+    assert_directory_sizes(data_path, (1500, 0, 0))
+    assert matcher.map_directory_to_clients_from_index(tmp_path / "other") is None
+
+    client._inject_torrent(
+        TorrentData(
+            infohash,
+            "test torrent 1",
+            1000,
+            TorrentState.ACTIVE,
+            100,
+            1000,
+            datetime(2020, 1, 1, 1, 1),
+            "example.com",
+            0,
+            0,
+            None,
+        ),
+        [TorrentFile("file1", 400, 100), TorrentFile("sub/file2", 600, 100)],
+        download_path,
+    )
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+    assert_directory_sizes(data_path, (1500, 1000, 400))
+    assert_directory_sizes(download_path / "sub", (700, 600, 0))
+    assert_directory_sizes(hardlink_path, (400, 0, 400))
+
+    (download_path / "sub" / "file4").write_bytes(b"a" * 50)
+    indexer.scan_paths([download_path / "sub"], full_scan=False)
+    assert_directory_sizes(data_path, (1550, 1000, 400))
+
+    del client._torrents[infohash]
+    indexer.scan_clients({"test_client": client}, full_scan=False, fast_scan=False)
+    assert_directory_sizes(data_path, (1550, 0, 0))
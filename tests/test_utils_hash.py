@@ -1,3 +1,4 @@
+import hashlib
 import shutil
 from datetime import datetime
 from pathlib import Path, PurePosixPath
@@ -6,6 +7,8 @@ import pytest
 from libtc import TorrentData, TorrentFile, TorrentState, bdecode
 
 from .fixtures import *
+import autotorrent.hashing
+import autotorrent.utils
 from autotorrent.utils import parse_torrent
 
 
@@ -188,3 +191,265 @@ def test_verify_hash_bad_files(testfiles, indexer, matcher, client):
         PurePosixPath('testfiles/file_b.txt'): 'touch-failed',
         PurePosixPath('testfiles/file_c.txt'): 'touch-failed',
     }
+
+
+def test_verify_hash_piece_aligned_last_file(tmp_path):
+    data = b'0123456789abcdef'
+    (tmp_path / 'aligned.bin').write_bytes(data)
+    torrent = parse_torrent({
+        b'info': {
+            b'name': b'aligned.bin',
+            b'length': len(data),
+            b'piece length': 8,
+            b'pieces': hashlib.sha1(data[:8]).digest() + hashlib.sha1(data[8:]).digest(),
+        }
+    })
+    torrent_file = torrent.filelist[0]
+    assert torrent.piece_calculations[torrent_file.path].last_complete_piece == 1
+    hash_result, touch_result = torrent.verify_hash(['*'], {torrent_file.path: tmp_path / 'aligned.bin'})
+    assert hash_result == {torrent_file: 'hash-success'}
+
+def test_piece_layout_matches_calculate_offsets(testfiles):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    for torrent_file in torrent.filelist:
+        piece_calculation = torrent.piece_calculations[torrent_file.path]
+        expected = torrent_file.pieces.calculate_offsets(
+            torrent_file.size, is_last_file=torrent_file.is_last_file
+        )
+        assert piece_calculation[:6] == expected[:6]
+        assert list(piece_calculation.pieces) == list(expected.pieces)
+        assert list(piece_calculation.complete_pieces) == list(expected.complete_pieces)
+
+    pieces = torrent.pieces
+    assert len(pieces) * 20 == len(pieces.data)
+    assert list(pieces[1:]) == list(pieces)[1:]
+    assert pieces[-1] == list(pieces)[-1]
+    assert isinstance(pieces[0], bytes)
+
+
+def test_verify_hash_parallel_batches(testfiles, monkeypatch):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    bad_file_b = testfiles / 'file_b_bad.txt'
+    shutil.copy(testfiles / 'file_b.txt', bad_file_b)
+    with bad_file_b.open('rb+') as f:
+        f.seek(5)
+        f.write(b'\x00')
+
+    file_mapping = {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): bad_file_b,
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }
+    serial_result = torrent.verify_hash(['*'], file_mapping, workers=1)
+    monkeypatch.setattr(autotorrent.hashing, "HASHER_BATCH_SIZE", 1)
+    parallel_result = torrent.verify_hash(['*'], file_mapping, workers=3)
+    assert parallel_result == serial_result
+    assert {k.path: v for (k, v) in parallel_result[0].items()}[PurePosixPath('testfiles/file_b.txt')] == 'hash-failed'
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_verify_hash_truncated_files(testfiles, tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(autotorrent.hashing, "HASHER_BATCH_SIZE", 1)
+    data_a, data_b = bytes(range(20)), bytes(range(100, 120))
+    data = data_a + data_b
+    torrent = parse_torrent({
+        b'info': {
+            b'name': b't',
+            b'piece length': 16,
+            b'pieces': b''.join(hashlib.sha1(data[i:i + 16]).digest() for i in range(0, len(data), 16)),
+            b'files': [{b'length': 20, b'path': [b'a']}, {b'length': 20, b'path': [b'b']}],
+        }
+    })
+    file_mapping = {
+        PurePosixPath('t/a'): tmp_path / 'a',
+        PurePosixPath('t/b'): tmp_path / 'b',
+    }
+
+    def verify(truncate_a, truncate_b):
+        (tmp_path / 'a').write_bytes(data_a[:truncate_a])
+        (tmp_path / 'b').write_bytes(data_b[:truncate_b])
+        hash_result, touch_result = torrent.verify_hash(['*'], file_mapping, workers=workers)
+        return (
+            {str(k.path): v for (k, v) in hash_result.items()},
+            {str(k.path): v for (k, v) in touch_result.items()},
+        )
+
+    # the piece shared by a and b continues in b where a ends
+    assert verify(17, 20) == (
+        {'t/a': 'hash-success', 't/b': 'hash-success'},
+        {'t/a': 'touch-failed', 't/b': 'touch-failed'},
+    )
+    assert verify(10, 20) == (
+        {'t/a': 'hash-failed', 't/b': 'hash-success'},
+        {'t/a': 'touch-failed', 't/b': 'touch-failed'},
+    )
+    assert verify(20, 15) == (
+        {'t/a': 'hash-success', 't/b': 'hash-failed'},
+        {'t/b': 'touch-failed'},
+    )
+
+    truncated_file_b = tmp_path / 'file_b.txt'
+    truncated_file_b.write_bytes((testfiles / 'file_b.txt').read_bytes()[:6])
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    hash_result, touch_result = torrent.verify_hash(['*'], {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): truncated_file_b,
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }, workers=workers)
+    assert {k.path: v for (k, v) in hash_result.items()} == {
+        PurePosixPath('testfiles/file_a.txt'): 'hash-success',
+        PurePosixPath('testfiles/file_b.txt'): 'hash-failed',
+        PurePosixPath('testfiles/file_c.txt'): 'hash-failed',
+    }
+    assert {k.path: v for (k, v) in touch_result.items()} == {
+        PurePosixPath('testfiles/file_b.txt'): 'touch-failed',
+        PurePosixPath('testfiles/file_c.txt'): 'touch-failed',
+    }
+
+def test_hash_pieces_schedule_several_torrents(testfiles, monkeypatch):
+    data_a = (testfiles / 'file_a.txt').read_bytes()
+    data_b = (testfiles / 'file_b.txt').read_bytes()
+    piece_segments = {
+        ('b', 1): [(testfiles / 'file_b.txt', 5, 6)],
+        ('a', 0): [(testfiles / 'file_a.txt', 0, 4)],
+        ('b', 0): [(testfiles / 'file_b.txt', 0, 5)],
+        ('a', 1): [(testfiles / 'file_a.txt', 4, 7), (testfiles / 'file_b.txt', 0, 2)],
+    }
+    piece_hashes = {
+        ('a', 0): hashlib.sha1(data_a[:4]).digest(),
+        ('a', 1): hashlib.sha1(data_a[4:] + data_b[:2]).digest(),
+        ('b', 0): hashlib.sha1(data_b[:5]).digest(),
+        ('b', 1): hashlib.sha1(b'not the data').digest(),
+    }
+
+    device_batches = autotorrent.hashing.schedule_batches(piece_segments)
+    assert list(device_batches.values()) == [[[('a', 0), ('a', 1), ('b', 0), ('b', 1)]]]
+
+    monkeypatch.setattr(autotorrent.hashing, "HASHER_BATCH_SIZE", 1)
+    assert autotorrent.hashing.hash_pieces(piece_segments, piece_hashes, workers=2) == {
+        ('a', 0): True,
+        ('a', 1): True,
+        ('b', 0): True,
+        ('b', 1): False,
+    }
+
+
+def test_verify_hash_piece_cache(testfiles, db, indexer, monkeypatch):
+    indexer.scan_paths([testfiles])
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    piece_cache = autotorrent.hashing.PieceHashCache(db)
+    file_mapping = {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): testfiles / 'file_b.txt',
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }
+    expected_result = torrent.verify_hash(['*'], file_mapping, piece_cache=piece_cache)
+    assert set(expected_result[0].values()) == {'hash-success'}
+    assert db.get_piece_hashes(testfiles / 'file_a.txt', 11, (testfiles / 'file_a.txt').stat().st_mtime_ns)
+
+    hashed_segments = []
+    original_hash_piece = autotorrent.hashing.PieceHasher.hash_piece
+
+    def hash_piece(self, segments):
+        hashed_segments.append(segments)
+        return original_hash_piece(self, segments)
+
+    # only pieces within a single file are cached
+    monkeypatch.setattr(autotorrent.hashing.PieceHasher, "hash_piece", hash_piece)
+    assert torrent.verify_hash(['*'], file_mapping, piece_cache=piece_cache) == expected_result
+    assert [len(segments) for segments in hashed_segments] == [2, 2]
+
+    with (testfiles / 'file_a.txt').open('rb+') as f:
+        f.seek(1)
+        f.write(b'\x00')
+    hash_result, _ = torrent.verify_hash(['*'], file_mapping, piece_cache=piece_cache)
+    assert [(testfiles / 'file_a.txt', 0, 8)] in hashed_segments
+    assert {k.path: v for (k, v) in hash_result.items()}[PurePosixPath('testfiles/file_a.txt')] == 'hash-failed'
+
+    (testfiles / 'file_a.txt').unlink()
+    indexer.scan_paths([testfiles])
+    assert not db.get_piece_hashes(testfiles / 'file_a.txt', 11, 0) and db.prune_piece_hashes() == 0
+    assert not db.db.execute("SELECT 1 FROM piece_hash_cache WHERE name = 'file_a.txt'").fetchall()
+
+
+def test_probe_policy_select_pieces():
+    probe_policy = autotorrent.hashing.ProbePolicy()
+    assert probe_policy.select_pieces(10) == [0, 9]
+    assert probe_policy.select_pieces(10, ambiguous=True) == [0, 9, 4, 2]
+    assert probe_policy.select_pieces(10, cached_pieces={5}) == [5, 0]
+    assert probe_policy.select_pieces(1, ambiguous=True) == [0]
+    assert autotorrent.hashing.ProbePolicy("high").select_pieces(3) == [0, 2, 1]
+    with pytest.raises(ValueError):
+        autotorrent.hashing.ProbePolicy("absolute")
+
+
+def test_probe_hash_prefers_cached_pieces(testfiles, db):
+    piece_length = 4
+    data = (testfiles / 'file_a.txt').read_bytes() * 3
+    (testfiles / 'data.bin').write_bytes(data)
+    pieces = autotorrent.utils.Pieces(piece_length, b"".join(
+        hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length)
+    ))
+    piece_cache = autotorrent.hashing.PieceHashCache(db)
+    probe_policy = autotorrent.hashing.ProbePolicy()
+
+    with (testfiles / 'data.bin').open('rb') as fp:
+        assert pieces.probe_hash(len(data), fp, piece_cache=piece_cache, probe_policy=probe_policy)
+    assert (probe_policy.probed_pieces, probe_policy.cached_pieces, probe_policy.bytes_read) == (2, 0, 8)
+
+    with (testfiles / 'data.bin').open('rb') as fp:
+        assert pieces.probe_hash(len(data), fp, piece_cache=piece_cache, probe_policy=probe_policy, ambiguous=True)
+    assert (probe_policy.probed_pieces, probe_policy.cached_pieces, probe_policy.bytes_read) == (4, 2, 16)
+
+
+def test_have_pieces_excludes_missing_and_failed_files(testfiles):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    file_mapping = {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): testfiles / 'file_b.txt',
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }
+    assert torrent.have_pieces(file_mapping) == [True] * 5
+    assert torrent.have_pieces(file_mapping, {PurePosixPath('testfiles/file_c.txt')}) == [True, True, False, False, False]
+    file_mapping[PurePosixPath('testfiles/file_a.txt')] = None
+    assert torrent.have_pieces(file_mapping) == [False, False, True, True, True]
+    assert autotorrent.utils.bitfield_to_bytes([False, False, True, True, True, False, False, False, True]) == bytes([0b00111000, 0b10000000])
+
+
+def test_have_pieces_excludes_unreadable_pieces(tmp_path):
+    data = bytes(range(35))
+    torrent = parse_torrent({
+        b'info': {
+            b'name': b't',
+            b'piece length': 8,
+            b'pieces': b''.join(hashlib.sha1(data[i:i + 8]).digest() for i in range(0, len(data), 8)),
+            b'files': [
+                {b'length': 19, b'path': [b'a']},
+                {b'length': 5, b'path': [b'b']},
+                {b'length': 11, b'path': [b'c']},
+            ],
+        }
+    })
+    (tmp_path / 'a').write_bytes(data[:19])
+    (tmp_path / 'b').write_bytes(data[19:23])
+    (tmp_path / 'c').write_bytes(data[24:])
+    file_mapping = {
+        PurePosixPath('t/a'): tmp_path / 'a',
+        PurePosixPath('t/b'): tmp_path / 'b',
+        PurePosixPath('t/c'): tmp_path / 'c',
+    }
+
+    # the only piece of the truncated b cannot be read, the files around it are fine
+    pieces_to_verify, piece_segments = torrent.plan_verify_hash(['*'], file_mapping)
+    piece_results = autotorrent.hashing.hash_pieces(piece_segments, torrent.pieces)
+    hash_result, touch_result = torrent.verify_hash_results(['*'], file_mapping, pieces_to_verify, piece_results)
+    assert {tf.path.name: r for (tf, r) in hash_result.items()} == {
+        'a': 'hash-success',
+        'b': 'hash-failed',
+        'c': 'hash-success',
+    }
+    assert {tf.path.name: r for (tf, r) in touch_result.items()} == {'b': 'touch-failed'}
+
+    piece_results = {p: piece_results.get(p) for p in pieces_to_verify}
+    assert torrent.have_pieces(file_mapping) == [True] * 5
+    assert torrent.have_pieces(file_mapping, piece_results=piece_results) == [True, True, False, True, True]
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from pathlib import PurePosixPath
+
+import pytest
+from libtc import bdecode, bencode
+
+from .fixtures import *
+import autotorrent.verify
+from autotorrent.utils import parse_torrent
+from autotorrent.verify import verify_torrent
+
+
+def _test_mapping(testfiles):
+    return {
+        PurePosixPath('testfiles/file_a.txt'): testfiles / 'file_a.txt',
+        PurePosixPath('testfiles/file_b.txt'): testfiles / 'file_b.txt',
+        PurePosixPath('testfiles/file_c.txt'): testfiles / 'file_c.txt',
+    }
+
+
+def test_verify_torrent_bad_and_missing_pieces(testfiles, db):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    (testfiles / 'file_a.txt').write_bytes(b'x' + (testfiles / 'file_a.txt').read_bytes()[1:])
+    file_mapping = _test_mapping(testfiles)
+    file_mapping[PurePosixPath('testfiles/file_c.txt')] = None
+
+    result = verify_torrent(torrent, "infohash", file_mapping, db)
+    assert result.pieces == "01---"
+    assert {tf.path.name: r for (tf, r) in result.files.items()} == {
+        'file_a.txt': ('hash-failed', 1, 1, 0),
+        'file_b.txt': ('hash-failed', 1, 0, 1),
+        'file_c.txt': ('missing', 0, 0, 3),
+    }
+    assert db.get_verify_progress("infohash", autotorrent.verify.file_mapping_fingerprint(torrent, file_mapping)) is None
+
+
+def test_verify_torrent_file_ending_on_piece_boundary(tmp_path, db):
+    data = bytes(range(42))
+    torrent = parse_torrent({
+        b'info': {
+            b'name': b't',
+            b'piece length': 16,
+            b'pieces': b''.join(hashlib.sha1(data[i:i + 16]).digest() for i in range(0, len(data), 16)),
+            b'files': [
+                {b'length': 20, b'path': [b'a']},
+                {b'length': 12, b'path': [b'b']},
+                {b'length': 10, b'path': [b'c']},
+            ],
+        }
+    })
+    (tmp_path / 'a').write_bytes(data[:20])
+    (tmp_path / 'b').write_bytes(data[20:32])
+    (tmp_path / 'c').write_bytes(b'x' * 10)
+    file_mapping = {tf.path: tmp_path / tf.path.name for tf in torrent.filelist}
+
+    b_calculation = torrent.piece_calculations[PurePosixPath('t/b')]
+    assert (b_calculation.end_piece, b_calculation.last_complete_piece) == (1, 1)
+    assert [list(torrent.file_pieces(tf)) for tf in torrent.filelist] == [[0, 1], [1], [2]]
+
+    result = verify_torrent(torrent, "infohash", file_mapping, db)
+    assert result.pieces == "110"
+    assert {tf.path.name: r for (tf, r) in result.files.items()} == {
+        'a': ('hash-success', 2, 0, 0),
+        'b': ('hash-success', 1, 0, 0),
+        'c': ('hash-failed', 0, 1, 0),
+    }
+
+    hash_result, touch_result = torrent.verify_hash(['*'], file_mapping)
+    assert {tf.path.name: r for (tf, r) in hash_result.items()} == {
+        'a': 'hash-success',
+        'b': 'hash-success',
+        'c': 'hash-failed',
+    }
+    assert {tf.path.name: r for (tf, r) in touch_result.items()} == {'c': 'touch-failed'}
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_verify_torrent_resume(testfiles, db, monkeypatch):
+    torrent = parse_torrent(bdecode((testfiles / "test.torrent").read_bytes()))
+    file_mapping = _test_mapping(testfiles)
+
+    def interrupt(progress):
+        if progress.verified_pieces == 2:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        verify_torrent(torrent, "infohash", file_mapping, db, checkpoint_size=8, progress=interrupt)
+
+    hashed_pieces = []
+    hash_pieces = autotorrent.verify.hash_pieces
+    def counting_hash_pieces(piece_segments, *args, **kwargs):
+        hashed_pieces.extend(piece_segments)
+        return hash_pieces(piece_segments, *args, **kwargs)
+    monkeypatch.setattr(autotorrent.verify, "hash_pieces", counting_hash_pieces)
+
+    progress = []
+    result = verify_torrent(torrent, "infohash", file_mapping, db, checkpoint_size=8, progress=progress.append)
+    assert result.pieces == "11111"
+    assert result.resumed_pieces == 2
+    assert sorted(hashed_pieces) == [2, 3, 4]
+    assert [p.verified_pieces for p in progress] == [3, 4, 5]
+    assert progress[-1].bytes_left == 0
+    assert set(r.status for r in result.files.values()) == {'hash-success'}
+
+    hashed_pieces.clear()
+    with pytest.raises(Interrupted):
+        verify_torrent(torrent, "infohash", file_mapping, db, checkpoint_size=8, progress=interrupt)
+    os.utime(testfiles / 'file_c.txt', ns=(0, 0))
+    verify_torrent(torrent, "infohash", file_mapping, db, checkpoint_size=8)
+    assert sorted(hashed_pieces) == [0, 0, 1, 1, 2, 3, 4]
+